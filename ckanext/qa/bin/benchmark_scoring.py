@@ -0,0 +1,101 @@
+'''
+Benchmark of the scoring engine (ckanext.qa.scoring) on its own - it scores
+--number synthetic resource records, with a mix of sniffed formats, URL
+extensions, format fields, broken links and closed licenses, and reports how
+many records per minute it scores.
+
+It needs no CKAN site or database. The formats are those with a score in the
+openness scores JSON file (this extension's one, by default), which is all
+that the format index needs for these records.
+'''
+
+from optparse import OptionParser
+import datetime
+import json
+import logging
+import os
+import random
+import time
+
+from ckanext.qa.scoring import Scorer, ResourceRecord, ArchivalRecord
+
+DEFAULT_SCORES_FILEPATH = os.path.join(
+    os.path.dirname(__file__), os.pardir,
+    'resource_format_openness_scores.json')
+
+
+def load_format_scores(filepath):
+    with open(filepath) as f:
+        return dict(format_line for format_line in json.load(f)
+                    if format_line[0] != '_comment')
+
+
+def make_records(number, formats, seed=0):
+    '''Returns a list of records, as varied as the resources that are
+    typically scored.'''
+    rand = random.Random(seed)
+    extensions = [format_.lower() for format_ in formats] + ['zar', 'html']
+    broken = ArchivalRecord(
+        is_broken=True, status='Download error',
+        reason='Server returned 404 error',
+        updated=datetime.datetime(2015, 1, 2), failure_count=3,
+        first_failure=datetime.datetime(2014, 12, 1))
+    records = []
+    for i in range(number):
+        kind = rand.random()
+        record = ResourceRecord(
+            id='resource-%i' % i,
+            url='http://data.example.com/dataset/%i/data.%s' %
+                (i, rand.choice(extensions)),
+            format=rand.choice(formats + [None, 'Unknown']),
+            is_open=rand.random() < 0.9)
+        if kind < 0.5:
+            record.sniffed_format = rand.choice(formats)
+        elif kind < 0.6:
+            record.archival = broken
+        else:
+            record.sniff_reasons = [
+                'The format of the file was not recognized from its '
+                'contents.']
+        records.append(record)
+    return records
+
+
+def benchmark(options):
+    format_scores = load_format_scores(options.scores)
+    format_index = dict((format_.lower(), (format_, score))
+                        for format_, score in format_scores.iteritems())
+    scorer = Scorer(format_index, format_scores)
+    records = make_records(options.number, sorted(format_scores))
+    print 'Scoring %i records, best of %i:' % (len(records), options.repeat)
+    best = None
+    for i in range(options.repeat):
+        start = time.time()
+        scorer.score_records(records)
+        seconds = time.time() - start
+        best = seconds if best is None else min(best, seconds)
+    print '  %9.3fs  %12.0f records/minute' % \
+        (best, len(records) * 60 / max(best, 1e-9))
+
+
+if __name__ == '__main__':
+    usage = """Benchmark the QA scoring engine, without a database
+
+    usage: %prog [options]
+    """
+    parser = OptionParser(usage=usage)
+    parser.add_option('-n', '--number', dest='number', type='int',
+                      default=100000,
+                      help='Number of records to score')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int', default=3,
+                      help='Number of times to score them (the fastest time '
+                           'is reported)')
+    parser.add_option('--scores', dest='scores',
+                      default=DEFAULT_SCORES_FILEPATH,
+                      help='Openness scores JSON file (default: this '
+                           'extension\'s)')
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error('No arguments expected')
+    logging.basicConfig(level=logging.ERROR)
+    benchmark(options)
@@ -0,0 +1,556 @@
+'''
+Benchmark of sniffing the format of the test fixture files.
+
+For each file in ckanext/qa/tests/data (or the files/directories given) it
+reports the time taken to sniff it, and how much file access that needed:
+
+  opens   - files opened by Python code (open() and libmagic's from_file)
+  forks   - subprocesses started (e.g. the "file" command)
+  syscr   - read syscalls, from /proc/self/io (Linux only)
+  rchar   - bytes read, from /proc/self/io (Linux only)
+
+so that the cost of sniffing can be compared between versions of the
+sniffer.
+
+With --json it instead compares the JSON detector with the regex-based one
+it replaced, on worst-case inputs. Similarly --ttl compares the Turtle
+detector with turtle_regex(), which it replaced, giving up on the regex
+after --timeout seconds, as it can take exponential time.
+
+With --suite it runs each detector on its own, and the whole of
+sniff_file_format, over every file and over copies of them enlarged
+--enlarge times, reporting time, peak memory and file opens for each
+detector and for each format sniffed. Each measurement is made in a forked
+process, so that peak memory can be measured. Save the results with
+--output and compare a later run against them with --compare, which exits
+with an error if anything got slower by more than --threshold.
+'''
+
+from optparse import OptionParser
+from collections import defaultdict
+import __builtin__
+import cPickle as pickle
+import datetime
+import json
+import logging
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import common
+
+# NB put no CKAN imports here, or logging breaks
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), os.pardir, 'tests',
+                           'data')
+
+
+class AccessCounter(object):
+    '''Counts file opens and forks, by wrapping the functions that do them.'''
+    def __init__(self):
+        self.opens = 0
+        self.forks = 0
+
+    def install(self):
+        import magic
+        self._originals = (__builtin__.open, magic.from_file,
+                           subprocess.Popen)
+
+        original_open, original_from_file, original_popen = self._originals
+        counter = self
+
+        def open_(*args, **kwargs):
+            counter.opens += 1
+            return original_open(*args, **kwargs)
+
+        def from_file(*args, **kwargs):
+            counter.opens += 1
+            return original_from_file(*args, **kwargs)
+
+        class Popen(original_popen):
+            def __init__(self, *args, **kwargs):
+                counter.forks += 1
+                original_popen.__init__(self, *args, **kwargs)
+
+        __builtin__.open = open_
+        magic.from_file = from_file
+        subprocess.Popen = Popen
+
+    def uninstall(self):
+        import magic
+        __builtin__.open, magic.from_file, subprocess.Popen = self._originals
+
+    def reset(self):
+        self.opens = self.forks = 0
+
+
+def read_proc_io():
+    '''Returns a dict of the I/O counters for this process, or {} if they
+    are not available.'''
+    try:
+        with open('/proc/self/io') as f:
+            return dict((key, int(value)) for key, value in
+                        (line.split(': ') for line in f))
+    except (IOError, ValueError):
+        return {}
+
+
+def get_filepaths(paths):
+    filepaths = []
+    for path in paths:
+        if os.path.isdir(path):
+            for filename in sorted(os.listdir(path)):
+                filepath = os.path.join(path, filename)
+                if os.path.isfile(filepath):
+                    filepaths.append(filepath)
+        else:
+            filepaths.append(path)
+    return filepaths
+
+
+def benchmark(filepaths, options):
+    from ckanext.qa.sniff_format import sniff_file_format
+    log = logging.getLogger('ckanext.qa.sniffer')
+    counter = AccessCounter()
+    totals = dict(time=0.0, opens=0, forks=0, syscr=0, rchar=0)
+    print '%-50s %-10s %8s %5s %5s %6s %10s' % (
+        'File', 'Format', 'ms', 'opens', 'forks', 'syscr', 'rchar')
+    counter.install()
+    try:
+        for filepath in filepaths:
+            timings = []
+            for i in range(options.repeat):
+                io_before = read_proc_io()
+                counter.reset()
+                start = time.time()
+                format_ = sniff_file_format(filepath, log)
+                timings.append(time.time() - start)
+                result = dict(opens=counter.opens, forks=counter.forks)
+                io_after = read_proc_io()
+            result['time'] = min(timings)
+            for key in ('syscr', 'rchar'):
+                result[key] = io_after.get(key, 0) - io_before.get(key, 0)
+            for key in totals:
+                totals[key] += result[key]
+            print '%-50s %-10s %8.1f %5i %5i %6i %10i' % (
+                os.path.basename(filepath)[:50],
+                format_['format'] if format_ else '-',
+                result['time'] * 1000, result['opens'], result['forks'],
+                result['syscr'], result['rchar'])
+    finally:
+        counter.uninstall()
+    print '%-50s %-10s %8.1f %5i %5i %6i %10i' % (
+        'TOTAL', '', totals['time'] * 1000, totals['opens'],
+        totals['forks'], totals['syscr'], totals['rchar'])
+
+
+def is_json_regex(buf, log):
+    '''The previous JSON detector, kept for comparison. It slices the
+    buffer for every token, and compiles its regexes on every call.'''
+    string = '"[^"]*"'
+    string_re = re.compile(string)
+    number_re = re.compile('-?\d+(\.\d+)?([eE][+-]?\d+)?')
+    extra_values_re = re.compile('true|false|null')
+    object_start_re = re.compile('{%s:\s?' % string)
+    object_middle_re = re.compile('%s:\s?' % string)
+    object_end_re = re.compile('}')
+    comma_re = re.compile(',\s?')
+    array_start_re = re.compile('\[')
+    array_end_re = re.compile('\]')
+    any_value_regexs = [string_re, number_re, object_start_re,
+                        array_start_re, extra_values_re]
+    pos = 0
+    state_stack = []
+    number_of_matches = 0
+    while pos < len(buf):
+        part_of_buf = buf[pos:]
+        if pos == 0:
+            potential_matches = (object_start_re, array_start_re, string_re,
+                                 number_re, extra_values_re)
+        elif not state_stack:
+            return False
+        elif state_stack[-1] == 'object':
+            potential_matches = [comma_re, object_middle_re, object_end_re] \
+                + any_value_regexs
+        elif state_stack[-1] == 'array':
+            potential_matches = any_value_regexs + [comma_re, array_end_re]
+        for matcher in potential_matches:
+            if matcher.match(part_of_buf):
+                if matcher == object_start_re:
+                    state_stack.append('object')
+                elif matcher == array_start_re:
+                    state_stack.append('array')
+                elif matcher in (object_end_re, array_end_re):
+                    try:
+                        state_stack.pop()
+                    except IndexError:
+                        return False
+                break
+        else:
+            return False
+        pos += matcher.match(part_of_buf).end()
+        number_of_matches += 1
+        if number_of_matches > 5:
+            return True
+    return True
+
+
+def json_worst_cases(size):
+    '''Returns (name, buffer) of inputs that are slow to detect.'''
+    return [
+        ('long string', '["%s"]' % ('x' * size)),
+        ('unterminated string', '["%s' % ('x' * size)),
+        ('long key', '{"%s": 1}' % ('k' * size)),
+        ('long number', '[%s]' % ('1' * size)),
+        ('deep nesting', '[' * size),
+        ('typical', '[{"a": 1, "b": [1, 2, 3], "c": "x"}, ' * (size / 35)),
+        ('not json', 'x' * size),
+        ]
+
+
+def benchmark_is_json(options):
+    from ckanext.qa.sniff_format import is_json, JsonSniffer
+    log = logging.getLogger('ckanext.qa.sniffer')
+    log.setLevel(logging.ERROR)
+
+    def streamed(buf, log):
+        sniffer = JsonSniffer(log)
+        for i in range(0, len(buf), 4096):
+            result = sniffer.feed(buf[i:i + 4096])
+            if result is not None:
+                return result
+        return sniffer.feed('', final=True)
+
+    detectors = (('regex (old)', is_json_regex), ('is_json', is_json),
+                 ('4KB chunks', streamed))
+    print '%-20s' % 'Input (%i bytes)' % options.size + \
+        ''.join('%14s' % name for name, detector in detectors)
+    for name, buf in json_worst_cases(options.size):
+        timings = []
+        results = set()
+        for detector_name, detector in detectors:
+            start = time.time()
+            for i in range(options.repeat):
+                results.add(detector(buf, log))
+            timings.append((time.time() - start) / options.repeat)
+        assert len(results) == 1, 'Detectors disagree on %s' % name
+        print '%-20s' % name + ''.join('%11.3fms' % (timing * 1000)
+                                       for timing in timings)
+
+
+def ttl_worst_cases(size):
+    '''Returns (name, buffer) of inputs that are slow to detect as Turtle or
+    not.'''
+    return [
+        ('quoted words', '"x"' + ' "x"' * (size / 4)),
+        ('after semicolon', ';' + ' "x"' * (size / 4)),
+        ('many quotes', '<s> <p> "' + '"' * size),
+        ('unclosed strings', '<s> <p> "x\n' * (size / 11)),
+        ('long string', '<s> <p> """' + 'x"' * (size / 2)),
+        ('typical', '<s> <p> "o" ;\n    <p> 1.5 .\n' * (size / 27)),
+        ('text', 'Some text; with semicolons. And more.\n' * (size / 38)),
+        ]
+
+
+def call_with_timeout(func, timeout):
+    '''Returns how long func() took, or None if it did not finish within
+    timeout seconds. It runs in a forked process, as a regex cannot be
+    interrupted.'''
+    pid = os.fork()
+    if pid == 0:
+        # child
+        try:
+            func()
+        finally:
+            os._exit(0)
+    start = time.time()
+    while time.time() - start < timeout:
+        if os.waitpid(pid, os.WNOHANG)[0]:
+            return time.time() - start
+        time.sleep(0.001)
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+    return None
+
+
+def benchmark_is_ttl(options):
+    from ckanext.qa.sniff_format import count_turtle_triples, turtle_regex
+    num_required_triples = 5
+
+    def regex(buf):
+        return turtle_regex().subn('', buf, num_required_triples)[1]
+
+    def scanner(buf):
+        return count_turtle_triples(buf, num_required_triples)
+
+    print '%-20s%14s%14s' % ('Input (%i bytes)' % options.size,
+                             'regex (old)', 'scanner')
+    for name, buf in ttl_worst_cases(options.size):
+        timings = []
+        for detector in (regex, scanner):
+            timing = call_with_timeout(
+                lambda: [detector(buf) for i in range(options.repeat)],
+                options.timeout)
+            timings.append('%11.3fms' % (timing * 1000 / options.repeat)
+                           if timing is not None else
+                           '%14s' % ('>%is' % options.timeout))
+        print '%-20s' % name + ''.join(timings)
+
+
+def get_detectors():
+    '''Returns (name, function) for magic and each registered detector,
+    where the function takes a FilePrefix and runs the detector on it (on
+    every file, whatever its MIME type).'''
+    import magic
+    from ckanext.qa import sniff_format
+
+    def run_detector(detector):
+        def run(prefix, log):
+            if detector.prefix_size is None:
+                # whole-file detectors may depend on the MIME type
+                prefix.mime_type = magic.from_buffer(prefix.read(1024),
+                                                     mime=True)
+            return detector.detect(prefix, log)
+        return run
+    detectors = [
+        ('magic', lambda prefix, log: magic.from_buffer(
+            prefix.read(sniff_format.MAGIC_PREFIX_SIZE), mime=True))]
+    for detector in sniff_format.get_detectors():
+        detectors.append((detector.name, run_detector(detector)))
+    return detectors
+
+
+def current_rss_kb():
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024
+
+
+def measure(func, repeat):
+    '''Runs func() in a forked process and returns a dict of how long it
+    took (fastest of "repeat" runs), the peak memory it used on top of what
+    was in use already, the files it opened and its result.'''
+    read_fd, write_fd = os.pipe()
+    rss_before = current_rss_kb()
+    pid = os.fork()
+    if pid == 0:
+        # child
+        try:
+            os.close(read_fd)
+            counter = AccessCounter()
+            counter.install()
+            timings = []
+            error = None
+            for i in range(repeat):
+                counter.reset()
+                start = time.time()
+                try:
+                    result = func()
+                except Exception, e:
+                    # detectors are run on files they would not be given
+                    # normally, so may raise
+                    result = None
+                    error = '%s: %s' % (e.__class__.__name__, e)
+                timings.append(time.time() - start)
+            counter.uninstall()
+            measurement = dict(ms=min(timings) * 1000, opens=counter.opens,
+                               forks=counter.forks, result=result)
+            if error:
+                measurement['error'] = error
+            with os.fdopen(write_fd, 'wb') as f:
+                pickle.dump(measurement, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as f:
+        data = f.read()
+    pid, status, rusage = os.wait4(pid, 0)
+    if not data:
+        raise Exception('Measurement process failed')
+    measurement = pickle.loads(data)
+    measurement['peak_kb'] = max(rusage.ru_maxrss - rss_before, 0)
+    return measurement
+
+
+def enlarge_files(filepaths, factor, tmp_dir):
+    '''Returns copies of the files, with their contents repeated "factor"
+    times.'''
+    enlarged_filepaths = []
+    for filepath in filepaths:
+        root, ext = os.path.splitext(os.path.basename(filepath))
+        enlarged_filepath = os.path.join(tmp_dir, '%s.x%i%s' %
+                                         (root, factor, ext))
+        with open(filepath, 'rb') as f:
+            content = f.read()
+        with open(enlarged_filepath, 'wb') as f:
+            for i in range(factor):
+                f.write(content)
+        enlarged_filepaths.append(enlarged_filepath)
+    return enlarged_filepaths
+
+
+def run_suite(filepaths, options):
+    from ckanext.qa.sniff_format import sniff_file_format, FilePrefix
+    log = logging.getLogger('ckanext.qa.sniffer')
+    log.setLevel(logging.ERROR)
+    results = {'detectors': {}, 'formats': {}, 'files': {},
+               'run': {'date': datetime.datetime.now().isoformat(),
+                       'enlarge': options.enlarge,
+                       'repeat': options.repeat}}
+
+    def detector_call(detector, filepath):
+        def call():
+            with FilePrefix(filepath) as prefix:
+                return bool(detector(prefix, log))
+        return call
+
+    for name, detector in get_detectors():
+        per_file = {}
+        for filepath in filepaths:
+            measurement = measure(detector_call(detector, filepath),
+                                  options.repeat)
+            del measurement['result']
+            per_file[os.path.basename(filepath)] = measurement
+        results['detectors'][name] = summarize(per_file)
+        results['detectors'][name]['files'] = per_file
+        print_summary(name, results['detectors'][name])
+
+    by_format = defaultdict(dict)
+    for filepath in filepaths:
+        measurement = measure(lambda: sniff_file_format(filepath, log),
+                              options.repeat)
+        format_ = measurement.pop('result')
+        format_name = format_['format'] if format_ else 'unknown'
+        measurement['format'] = format_name
+        filename = os.path.basename(filepath)
+        results['files'][filename] = measurement
+        by_format[format_name][filename] = measurement
+    for format_name, per_file in sorted(by_format.items()):
+        results['formats'][format_name] = summarize(per_file)
+        print_summary('sniff %s' % format_name,
+                      results['formats'][format_name])
+    return results
+
+
+def summarize(per_file):
+    measurements = per_file.values()
+    return dict(
+        count=len(measurements),
+        total_ms=sum(m['ms'] for m in measurements),
+        max_ms=max(m['ms'] for m in measurements),
+        max_peak_kb=max(m['peak_kb'] for m in measurements),
+        opens=sum(m['opens'] for m in measurements),
+        forks=sum(m['forks'] for m in measurements),
+        )
+
+
+def print_summary(name, summary):
+    print '%-45s %4i files %9.1fms total %8.1fms max %8ikB peak ' \
+        '%4i opens %3i forks' % (
+            name, summary['count'], summary['total_ms'], summary['max_ms'],
+            summary['max_peak_kb'], summary['opens'], summary['forks'])
+
+
+def compare(old_results, new_results, threshold):
+    '''Prints the differences between two sets of suite results, and
+    returns a list of the regressions - things that are slower by more
+    than the threshold factor, or use more file opens.'''
+    regressions = []
+    for section in ('detectors', 'formats'):
+        for name, new in sorted(new_results[section].items()):
+            old = old_results[section].get(name)
+            if not old:
+                print '%-45s new' % name
+                continue
+            ratio = new['total_ms'] / old['total_ms'] \
+                if old['total_ms'] else 1.0
+            line = '%-45s %9.1fms -> %9.1fms (x%.2f) %8ikB -> %8ikB ' \
+                '%4i -> %4i opens' % (
+                    name, old['total_ms'], new['total_ms'], ratio,
+                    old['max_peak_kb'], new['max_peak_kb'],
+                    old['opens'], new['opens'])
+            # ignore noise in tiny timings
+            if (ratio > threshold and
+                    new['total_ms'] - old['total_ms'] > 1.0) or \
+                    new['opens'] > old['opens']:
+                line += '  REGRESSION'
+                regressions.append(name)
+            print line
+    return regressions
+
+
+if __name__ == '__main__':
+    usage = """Benchmark sniffing the format of files
+
+    usage: %prog [options] [file or directory ...]
+    """
+    parser = OptionParser(usage=usage)
+    parser.add_option('-c', '--config', dest='config',
+                      help='CKAN config file, if resource formats are '
+                           'configured differently to the default')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int', default=3,
+                      help='Number of times to sniff each file (the fastest '
+                           'time is reported)')
+    parser.add_option('--json', dest='json', action='store_true',
+                      help='Benchmark the JSON detector on worst-case inputs')
+    parser.add_option('--ttl', dest='ttl', action='store_true',
+                      help='Benchmark the Turtle detector on worst-case '
+                           'inputs')
+    parser.add_option('--size', dest='size', type='int', default=10000,
+                      help='Size of the worst-case inputs (bytes)')
+    parser.add_option('--timeout', dest='timeout', type='int', default=10,
+                      help='Seconds to wait for each of the old Turtle '
+                           'regex\'s worst cases')
+    parser.add_option('--suite', dest='suite', action='store_true',
+                      help='Run the per-detector benchmark suite')
+    parser.add_option('--enlarge', dest='enlarge', type='int', default=10,
+                      help='Also benchmark copies of the files enlarged this '
+                           'many times (suite only, 1 to disable)')
+    parser.add_option('-o', '--output', dest='output',
+                      help='Save the suite results to this JSON file')
+    parser.add_option('--compare', dest='compare',
+                      help='Compare the suite results with ones saved in '
+                           'this JSON file')
+    parser.add_option('--threshold', dest='threshold', type='float',
+                      default=1.2,
+                      help='Factor by which something has to be slower to '
+                           'count as a regression (default 1.2)')
+    (options, args) = parser.parse_args()
+    if options.config:
+        print 'Loading CKAN config...'
+        common.load_config(options.config)
+        print 'Done'
+    logging.basicConfig(level=logging.ERROR)
+    if options.json:
+        benchmark_is_json(options)
+    elif options.ttl:
+        benchmark_is_ttl(options)
+    elif options.suite:
+        filepaths = get_filepaths(args or [FIXTURE_DIR])
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            if options.enlarge > 1:
+                filepaths += enlarge_files(filepaths, options.enlarge,
+                                           tmp_dir)
+            results = run_suite(filepaths, options)
+        finally:
+            shutil.rmtree(tmp_dir)
+        if options.output:
+            with open(options.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            print 'Results saved: %s' % options.output
+        if options.compare:
+            with open(options.compare) as f:
+                old_results = json.load(f)
+            regressions = compare(old_results, results, options.threshold)
+            if regressions:
+                print 'Regressions: %s' % ', '.join(regressions)
+                sys.exit(1)
+    else:
+        filepaths = get_filepaths(args or [FIXTURE_DIR])
+        benchmark(filepaths, options)
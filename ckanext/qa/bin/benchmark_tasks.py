@@ -0,0 +1,124 @@
+'''
+Benchmark of the overhead of each QA Celery task - loading the CKAN
+environment and registering the translator - with and without the
+per-process cache of it (see tasks.load_config).
+
+It runs against a local CKAN config, by default this extension's
+test-core.ini, so it needs no running CKAN site:
+
+  uncached  - the environment is loaded by every task, as it used to be
+  cached    - the environment is loaded once per process
+
+and then reports the throughput that results for scoring the resources in
+the config's database (the first --resources of them, if there are any),
+i.e. the per-task setup followed by tasks.resource_score(). Results are not
+saved and the search index is not touched.
+'''
+
+from optparse import OptionParser
+import logging
+import os
+import sys
+import time
+
+import common
+
+# NB put no CKAN imports here, or logging breaks
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(__file__), os.pardir,
+                              os.pardir, os.pardir, 'test-core.ini')
+
+
+def forget_environment():
+    '''Makes the next task load the environment again, as before it was
+    cached.'''
+    from ckanext.qa import tasks
+    tasks._LOADED_CONFIG = None
+    tasks._thread_state.translator = None
+
+
+def task_setup(config_filepath):
+    '''What each task does before it starts scoring.'''
+    from ckanext.qa import tasks, lib
+    tasks.load_config(config_filepath)
+    tasks.register_translator()
+    lib.reload_format_index_if_changed()
+
+
+def time_calls(func, number, cached):
+    '''Returns the seconds that each call of func took, on average.'''
+    func()  # warm up
+    total = 0.0
+    for i in range(number):
+        if not cached:
+            forget_environment()
+        start = time.time()
+        func()
+        total += time.time() - start
+    return total / number
+
+
+def benchmark_setup(options):
+    print 'Per-task environment setup (%i tasks each):' % options.number
+    timings = {}
+    for cached in (False, True):
+        name = 'cached' if cached else 'uncached'
+        timings[name] = time_calls(lambda: task_setup(options.config),
+                                   options.number, cached)
+        print '  %-10s %9.2fms per task' % (name, timings[name] * 1000)
+    print '  %.0fx less overhead' % \
+        (timings['uncached'] / max(timings['cached'], 1e-9))
+
+
+def benchmark_throughput(options):
+    from ckan import model
+    from ckanext.qa import tasks
+    resource_ids = [resource.id for resource in
+                    common.get_resources()[:options.resources]]
+    if not resource_ids:
+        print 'No resources in the database, so no throughput to measure'
+        return
+    log = logging.getLogger('ckanext.qa.benchmark')
+
+    def score_resources():
+        for resource_id in resource_ids:
+            task_setup(options.config)
+            tasks.resource_score(model.Resource.get(resource_id), log)
+            model.Session.remove()
+
+    print 'Scoring %i resources:' % len(resource_ids)
+    rates = {}
+    for cached in (False, True):
+        name = 'cached' if cached else 'uncached'
+        seconds = time_calls(score_resources, 1, cached)
+        rates[name] = len(resource_ids) / max(seconds, 1e-9)
+        print '  %-10s %9.1f tasks/s' % (name, rates[name])
+    print '  %.1fx the throughput' % (rates['cached'] / rates['uncached'])
+
+
+if __name__ == '__main__':
+    usage = """Benchmark the per-task overhead of the QA Celery tasks
+
+    usage: %prog [options]
+    """
+    parser = OptionParser(usage=usage)
+    parser.add_option('-c', '--config', dest='config',
+                      default=DEFAULT_CONFIG,
+                      help='CKAN config file (default: test-core.ini)')
+    parser.add_option('-n', '--number', dest='number', type='int',
+                      default=20,
+                      help='Number of tasks to time the setup of')
+    parser.add_option('--resources', dest='resources', type='int',
+                      default=50,
+                      help='Number of resources to score, for the '
+                           'throughput')
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error('No arguments expected')
+    options.config = os.path.abspath(options.config)
+    if not os.path.exists(options.config):
+        print 'Config file not found: %s' % options.config
+        sys.exit(1)
+    logging.basicConfig(level=logging.ERROR)
+    benchmark_setup(options)
+    benchmark_throughput(options)
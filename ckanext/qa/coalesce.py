@@ -0,0 +1,127 @@
+'''
+Collects work that arrives in bursts, such as the same dataset being
+updated many times over during a bulk rescore, and does it in batches after
+a short window, so that repeats of the same item are only done once.
+'''
+import threading
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class CoalescingBuffer(object):
+    '''Collects distinct items, and processes them once "window" seconds
+    have passed since the first was added, or as soon as "batch_size" of
+    them are waiting, whichever is sooner. A window of 0 means each is
+    processed straight away.
+
+    :param process: func(items) that processes a batch of the items
+    :param window: seconds to wait for more items
+    :param batch_size: most items to process in one go
+    '''
+    # for log messages
+    action = 'Processing'
+
+    def __init__(self, process, window=10, batch_size=100):
+        self.process = process
+        self.window = window
+        self.batch_size = batch_size
+        self._items = []
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, item):
+        with self._lock:
+            if item not in self._items:
+                self._items.append(item)
+            due = self.window <= 0 or len(self._items) >= self.batch_size
+            if not due and self._timer is None:
+                self._start_timer()
+        if due:
+            self.flush()
+
+    def _start_timer(self):
+        self._timer = threading.Timer(self.window, self._flush_on_timer)
+        # don't keep the process alive - it flushes as it shuts down
+        self._timer.daemon = True
+        self._timer.start()
+
+    def flush(self):
+        '''Processes the items that are waiting, now. Returns how many there
+        were.
+
+        If processing them fails, they are kept to try again at the next
+        flush, and the exception is raised.'''
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            items = self._items
+            self._items = []
+        count = 0
+        while items:
+            batch = items[:self.batch_size]
+            try:
+                self.process(batch)
+            except Exception:
+                with self._lock:
+                    self._items = items + [
+                        item for item in self._items if item not in items]
+                raise
+            items = items[self.batch_size:]
+            count += len(batch)
+        return count
+
+    def _flush_on_timer(self):
+        try:
+            self.flush()
+        except Exception, e:
+            log.error('%s failed, will try again in %ss: %s: %s',
+                      self.action, self.window, e.__class__.__name__, e)
+            with self._lock:
+                if self._timer is None and self._items:
+                    self._start_timer()
+
+
+def merge_qa_requests(requests, resource_package_ids):
+    '''Merges requests for QA into as few tasks as possible. Requests for
+    several resources of the same dataset (on the same queue) become one
+    request for the dataset, as do any for a resource of a dataset that is
+    itself requested.
+
+    :param requests: list of (queue, 'package' or 'resource', id)
+    :param resource_package_ids: {resource_id: package_id} for the resources
+                                 requested. Resources missing from it (e.g.
+                                 deleted) are dropped.
+    :returns: list of (queue, package_id, resource_id) in the order first
+              requested - resource_id is None for the whole dataset
+    '''
+    merged = {}  # (queue, package_id): [resource_id, ...] or None
+    order = []
+    for queue, type_, id_ in requests:
+        if type_ == 'package':
+            key, resource_id = (queue, id_), None
+        else:
+            package_id = resource_package_ids.get(id_)
+            if not package_id:
+                log.warning('Resource not found, so not QA\'d: %s', id_)
+                continue
+            key, resource_id = (queue, package_id), id_
+        if key not in merged:
+            order.append(key)
+            merged[key] = [] if resource_id else None
+        if merged[key] is not None:
+            if resource_id is None:
+                merged[key] = None
+            elif resource_id not in merged[key]:
+                merged[key].append(resource_id)
+    tasks = []
+    for queue, package_id in order:
+        resource_ids = merged[(queue, package_id)]
+        tasks.append((queue, package_id,
+                      resource_ids[0] if resource_ids and
+                      len(resource_ids) == 1 else None))
+    return tasks
@@ -1,11 +1,19 @@
+import datetime
+import itertools
+import json
 import logging
+import os
 import sys
+import time
 
 import ckan.plugins as p
 
 REQUESTS_HEADER = {'content-type': 'application/json',
                    'User-Agent': 'ckanext-qa commands'}
 
+# Datasets that each worker scores at a time, with --local
+LOCAL_CHUNK_SIZE = 20
+
 
 class CkanApiError(Exception):
     pass
@@ -23,14 +31,37 @@ class QACommand(p.toolkit.CkanCommand):
 
         paster qa [options] update [dataset/group name/id]
            - QA analysis on all resources in a given dataset, or on all
-           datasets if no dataset given
-
-        paster qa sniff {filepath}
-           - Opens the file and determines its type by the contents
+           datasets if no dataset given. On the bulk queue, resources that
+           have not changed since they were last scored are skipped,
+           unless --force is given.
+
+           With --local, the datasets are scored by this command, in a
+           pool of --workers processes, rather than queued for Celery, so
+           no message broker or Celery workers are needed. Unchanged
+           resources are skipped, as on the bulk queue. Progress,
+           throughput and an ETA are printed as it goes.
+
+        paster qa [options] schedule
+           - Queues the QA of the datasets whose resources have not been
+           scored, or have been archived or modified since they were.
+           The most urgent (never scored, then most viewed, then longest
+           since scored) go first, up to --budget resources (default
+           qa.schedule_budget), spread out over an hour. Run it hourly,
+           e.g. from cron. Use --dry-run to list them instead.
+
+        paster qa [options] sniff {filepath|directory|-} ...
+           - Opens the files and determines their types by the contents.
+           Directories are searched recursively and "-" reads a list of
+           filepaths from stdin. Use --workers to sniff with a pool of
+           processes, and --jsonl to output a line of JSON per file.
 
         paster qa view [dataset name/id]
            - See package score information
 
+        paster qa slow-files
+           - Lists the files that went over the time or memory limit when
+           they were sniffed
+
         paster qa clean
            - Remove all package score information
 
@@ -57,6 +88,49 @@ class QACommand(p.toolkit.CkanCommand):
                                action='store',
                                dest='queue',
                                help='Send to a particular queue')
+        self.parser.add_option('--workers',
+                               action='store',
+                               dest='workers',
+                               type='int',
+                               default=1,
+                               help='Number of processes to sniff or '
+                                    'to score --local with')
+        self.parser.add_option('--local',
+                               action='store_true',
+                               dest='local',
+                               default=False,
+                               help='Score datasets in this process (and '
+                                    '--workers), rather than queuing them')
+        self.parser.add_option('--packages-per-task',
+                               action='store',
+                               dest='packages_per_task',
+                               type='int',
+                               default=1,
+                               help='Number of datasets for each queued '
+                                    'task to score')
+        self.parser.add_option('--force',
+                               action='store_true',
+                               dest='force',
+                               default=False,
+                               help='Score resources again even if they '
+                                    'have not changed since last time')
+        self.parser.add_option('--budget',
+                               action='store',
+                               dest='budget',
+                               type='int',
+                               default=None,
+                               help='Most resources to schedule the QA of')
+        self.parser.add_option('--dry-run',
+                               action='store_true',
+                               dest='dry_run',
+                               default=False,
+                               help='List what would be scheduled, without '
+                                    'queuing it')
+        self.parser.add_option('--jsonl',
+                               action='store_true',
+                               dest='jsonl',
+                               default=False,
+                               help='Output sniff results as JSON lines')
 
     def command(self):
         """
@@ -75,6 +149,8 @@ class QACommand(p.toolkit.CkanCommand):
 
         if cmd == 'update':
             self.update()
+        elif cmd == 'schedule':
+            self.schedule()
         elif cmd == 'sniff':
             self.sniff()
         elif cmd == 'view':
@@ -82,6 +158,8 @@ class QACommand(p.toolkit.CkanCommand):
                 self.view(self.args[1])
             else:
                 self.view()
+        elif cmd == 'slow-files':
+            self.slow_files()
         elif cmd == 'clean':
             self.clean()
         elif cmd == 'migrate1':
@@ -99,21 +177,26 @@ class QACommand(p.toolkit.CkanCommand):
     def update(self):
         from ckan import model
         from ckanext.qa import lib
-        packages = []
+        # the package ids are streamed from the database, rather than
+        # loading all the packages first
+        package_ids = []  # iterables of ids
+        total = 0
         resources = []
         if len(self.args) > 1:
             for arg in self.args[1:]:
                 # try arg as a group id/name
                 group = model.Group.get(arg)
                 if group:
-                    packages.extend(group.packages())
+                    package_ids.append(iter_active_package_ids(group.id))
+                    total += count_active_packages(group.id)
                     if not self.options.queue:
                         self.options.queue = 'bulk'
                     continue
                 # try arg as a package id/name
                 pkg = model.Package.get(arg)
                 if pkg:
-                    packages.append(pkg)
+                    package_ids.append([pkg.id])
+                    total += 1
                     if not self.options.queue:
                         self.options.queue = 'priority'
                     continue
@@ -130,48 +213,147 @@ class QACommand(p.toolkit.CkanCommand):
                     sys.exit(1)
         else:
             # all packages
-            pkgs = model.Session.query(model.Package)\
-                        .filter_by(state='active')\
-                        .order_by('name').all()
-            packages.extend(pkgs)
+            package_ids.append(iter_active_package_ids())
+            total += count_active_packages()
             if not self.options.queue:
                 self.options.queue = 'bulk'
+        package_ids = itertools.chain(*package_ids)
 
-        if packages:
-            self.log.info('Datasets to QA: %d', len(packages))
+        if total:
+            self.log.info('Datasets to QA: %d', total)
         if resources:
             self.log.info('Resources to QA: %d', len(resources))
-        if not (packages or resources):
+        if not (total or resources):
             self.log.error('No datasets or resources to process')
             sys.exit(1)
 
-        self.log.info('Queue: %s', self.options.queue)
-        for package in packages:
-            lib.create_qa_update_package_task(package, self.options.queue)
-            self.log.info('Queuing dataset %s (%s resources)',
-                          package.name, len(package.resources))
+        if self.options.local:
+            if resources:
+                self.log.error('Only datasets and groups can be scored '
+                               '--local, not resources')
+                sys.exit(1)
+            self.update_local(package_ids, total)
+            return
 
-        for resource in resources:
-            package = resource.resource_group.package
-            self.log.info('Queuing resource %s/%s', package.name, resource.id)
-            lib.create_qa_update_task(resource, self.options.queue)
+        self.log.info('Queue: %s', self.options.queue)
+        # a bulk rescore skips the resources that have not changed
+        incremental = self.options.queue == 'bulk' and not self.options.force
+        if incremental:
+            self.log.info('Skipping unchanged resources (use --force to '
+                          'score them all)')
+        packages_queued = tasks_queued = 0
+        with lib.celery_producer() as producer:
+            for chunk in iter_chunks(package_ids,
+                                     self.options.packages_per_task):
+                lib.create_qa_update_packages_task(
+                    chunk, self.options.queue, incremental=incremental,
+                    producer=producer)
+                packages_queued += len(chunk)
+                tasks_queued += 1
+                if tasks_queued % 1000 == 0:
+                    self.log.info('Queued %i/%i datasets', packages_queued,
+                                  total)
+
+            for resource in resources:
+                self.log.info('Queuing resource %s', resource.id)
+                lib.create_qa_update_task(resource, self.options.queue,
+                                          producer=producer)
+
+        self.log.info('Completed queueing %i datasets in %i tasks',
+                      packages_queued, tasks_queued)
+
+    def update_local(self, package_ids, total):
+        '''Scores the packages in this process, or with --workers, in a
+        pool of processes that each load the CKAN environment once. The
+        package ids are handed out in chunks, and each worker indexes the
+        packages of a chunk together once it has scored them.'''
+        from ckan import model
+        from pylons import config
+        from ckanext.qa import tasks
+        incremental = not self.options.force
+        self.log.info('Scoring %i datasets here, with %i worker(s)%s', total,
+                      self.options.workers,
+                      ' - skipping unchanged resources (use --force to '
+                      'score them all)' if incremental else '')
+        chunks = ((chunk, incremental) for chunk in
+                  iter_chunks(package_ids, LOCAL_CHUNK_SIZE))
+        if self.options.workers > 1:
+            import multiprocessing
+            # the workers must not share this process's database connections
+            model.Session.remove()
+            model.meta.engine.dispose()
+            ckan_ini_filepath = os.path.abspath(config.__file__)
+            pool = multiprocessing.Pool(
+                self.options.workers, initializer=init_local_worker,
+                initargs=(ckan_ini_filepath,))
+            results = pool.imap_unordered(score_packages_locally, chunks)
+        else:
+            pool = None
+            tasks.register_translator()
+            results = itertools.imap(score_packages_locally, chunks)
+        progress = Progress(total)
+        errors = 0
+        try:
+            for packages_done, resources_scored, chunk_errors in results:
+                for error in chunk_errors:
+                    self.log.error(error)
+                errors += len(chunk_errors)
+                progress.update(packages_done, resources_scored)
+            if pool:
+                pool.close()
+                pool.join()
+        finally:
+            if pool:
+                pool.terminate()
+        progress.print_summary(final=True)
+        if errors:
+            self.log.error('There were %i errors', errors)
+            sys.exit(1)
 
-        self.log.info('Completed queueing')
+    def schedule(self):
+        from ckanext.qa import lib
+        queue = self.options.queue or 'bulk'
+        plan = lib.schedule_rescoring(queue, budget=self.options.budget,
+                                      dry_run=self.options.dry_run)
+        for package_id, resources in plan:
+            print '%s %s' % ('Would queue' if self.options.dry_run
+                             else 'Queued', package_id)
+            for resource_id, reason in resources:
+                print '    %s - %s' % (resource_id, reason)
+        print '%i datasets (%i stale resources)%s' % (
+            len(plan), sum(len(resources) for package_id, resources in plan),
+            '' if self.options.dry_run else ' queued on %s' % queue)
 
     def sniff(self):
-        from ckanext.qa.sniff_format import sniff_file_format
-
         if len(self.args) < 2:
             print 'Not enough arguments', self.args
             sys.exit(1)
-        for filepath in self.args[1:]:
-            format_ = sniff_file_format(
-                filepath, logging.getLogger('ckanext.qa.sniffer'))
-            if format_:
-                print 'Detected as: %s - %s' % (format_['display_name'],
-                                                filepath)
-            else:
-                print 'ERROR: Could not recognise format of: %s' % filepath
+        filepaths = iter_filepaths(self.args[1:])
+        if self.options.workers > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(self.options.workers)
+            results = pool.imap_unordered(sniff_file, filepaths, chunksize=8)
+        else:
+            pool = None
+            results = (sniff_file(filepath) for filepath in filepaths)
+        try:
+            for result in results:
+                if self.options.jsonl:
+                    print json.dumps(result)
+                elif result['format']:
+                    print 'Detected as: %s%s - %s' % (
+                        result['format'],
+                        ' (in %s)' % result['container']
+                        if result['container'] else '',
+                        result['filepath'])
+                else:
+                    print 'ERROR: Could not recognise format of: %s%s' % (
+                        result['filepath'],
+                        ' (%s)' % result['error'] if 'error' in result else '')
+                sys.stdout.flush()
+        finally:
+            if pool:
+                pool.terminate()
 
     def view(self, package_ref=None):
         from ckan import model
@@ -189,6 +371,26 @@ class QACommand(p.toolkit.CkanCommand):
                     print '* %s = %r error=%r' % (row.key, row.value,
                                                   row.error)
 
+    def slow_files(self):
+        from ckan import model
+        from pylons import config
+        from ckanext.qa.model import SlowFile
+        from ckanext.qa.sniff_format import DETECTOR_VERSION
+
+        threshold = int(config.get('qa.sniff_slow_file_threshold', 2))
+        q = model.Session.query(SlowFile) \
+            .order_by(SlowFile.failure_count.desc(), SlowFile.updated.desc())
+        print '%i files went over the sniffing limits' % q.count()
+        for slow_file in q:
+            skipped = slow_file.failure_count >= threshold and \
+                slow_file.detector_version == DETECTOR_VERSION
+            print '%s %i failures%s - %s' % (
+                slow_file.updated.strftime('%Y-%m-%d %H:%M'),
+                slow_file.failure_count,
+                ' (no longer sniffed)' if skipped else '',
+                slow_file.filepath)
+            print '    %s' % slow_file.reason
+
     def clean(self):
         from ckan import model
 
@@ -262,3 +464,174 @@ class QACommand(p.toolkit.CkanCommand):
         model.Session.flush()
         model.Session.remove()
         print 'Migration succeeded'
+
+
+def iter_filepaths(paths):
+    '''Yields the filepaths given, searching directories recursively. A path
+    of "-" means read filepaths from stdin, one per line.'''
+    for path in paths:
+        if path == '-':
+            for line in sys.stdin:
+                line = line.rstrip('\n')
+                if line:
+                    for filepath in iter_filepaths([line]):
+                        yield filepath
+        elif os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    yield os.path.join(dirpath, filename)
+        else:
+            yield path
+
+
+def select_active_package_ids(group_id=None):
+    '''Returns the SQL select of the ids of the active packages, in name
+    order - all of them, or the ones in the given group.'''
+    import sqlalchemy as sa
+    from ckan import model
+    package_table = model.package_table
+    q = sa.select([package_table.c.id]) \
+        .where(package_table.c.state == 'active')
+    if group_id:
+        member_table = model.member_table
+        q = q.where(sa.and_(member_table.c.table_id == package_table.c.id,
+                            member_table.c.table_name == 'package',
+                            member_table.c.group_id == group_id,
+                            member_table.c.state == 'active'))
+    return q.order_by(package_table.c.name)
+
+
+def count_active_packages(group_id=None):
+    '''Returns the number of ids that iter_active_package_ids gives.'''
+    import sqlalchemy as sa
+    from ckan import model
+    q = select_active_package_ids(group_id).order_by(None).alias()
+    return model.Session.execute(
+        sa.select([sa.func.count()]).select_from(q)).scalar()
+
+
+def iter_active_package_ids(group_id=None, batch_size=1000):
+    '''Yields the ids of the active packages, in name order - all of them,
+    or the ones in the given group. They are streamed from the database with
+    a server-side cursor, a batch at a time, over a connection of their own,
+    so that scoring can commit and close its sessions meanwhile.'''
+    from ckan import model
+    connection = model.meta.engine.connect()
+    try:
+        result = connection.execution_options(stream_results=True).execute(
+            select_active_package_ids(group_id))
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row[0]
+    finally:
+        connection.close()
+
+
+def iter_chunks(iterable, size):
+    '''Yields lists of up to "size" of the items, in order.'''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def init_local_worker(ckan_ini_filepath):
+    '''Loads the CKAN environment in a worker process of update --local,
+    once, before it scores anything.'''
+    from ckanext.qa import tasks
+    tasks.load_config(ckan_ini_filepath)
+    tasks.register_translator()
+
+
+def score_packages_locally(args):
+    '''Scores a chunk of packages for update --local and indexes them
+    together. Returns (number of packages, number of resources scored,
+    [error message, ...]). (It is a module-level function so
+    that it can be run in a multiprocessing pool.)'''
+    from ckan import model
+    from ckanext.qa import tasks, lib
+    package_ids, incremental = args
+    log = logging.getLogger('ckanext.qa.local')
+    lib.reload_format_index_if_changed()
+    resources_scored = 0
+    errors = []
+    for package_id in package_ids:
+        try:
+            resources_scored += tasks.score_package_by_id(package_id, log,
+                                                          incremental)
+        except Exception, e:
+            model.Session.rollback()
+            errors.append('Could not score dataset %s: %s: %s' %
+                          (package_id, e.__class__.__name__, e))
+    tasks.flush_reindex_buffer()
+    model.Session.remove()
+    return len(package_ids), resources_scored, errors
+
+
+class Progress(object):
+    '''Prints how far through scoring it is - datasets and resources done,
+    the rate and the estimated time left - at most every "interval"
+    seconds.'''
+    def __init__(self, total, interval=5, out=None):
+        self.total = total
+        self.interval = interval
+        self.out = out or sys.stdout
+        self.packages_done = 0
+        self.resources_scored = 0
+        self.start = self.last_printed = time.time()
+
+    def update(self, packages_done, resources_scored):
+        self.packages_done += packages_done
+        self.resources_scored += resources_scored
+        if time.time() - self.last_printed >= self.interval:
+            self.print_summary()
+
+    def print_summary(self, final=False):
+        now = time.time()
+        self.last_printed = now
+        elapsed = max(now - self.start, 1e-9)
+        rate = self.packages_done / elapsed
+        if final:
+            eta = 'took %s' % format_seconds(elapsed)
+        elif rate:
+            eta = 'ETA %s' % format_seconds(
+                max(self.total - self.packages_done, 0) / rate)
+        else:
+            eta = 'ETA unknown'
+        print >>self.out, \
+            '%i/%i datasets (%i resources scored) - %.1f datasets/s, ' \
+            '%.1f resources/s - %s' % (
+                self.packages_done, self.total, self.resources_scored, rate,
+                self.resources_scored / elapsed, eta)
+        self.out.flush()
+
+
+def format_seconds(seconds):
+    '''e.g. 3725.2 -> "1:02:05"'''
+    return str(datetime.timedelta(seconds=int(round(seconds))))
+
+
+def sniff_file(filepath):
+    '''Sniffs the format of a file for the sniff command, returning a dict
+    of the result. (It is a module-level function so that it can be run in a
+    multiprocessing pool.)'''
+    from ckanext.qa.sniff_format import sniff_file_format
+    log = logging.getLogger('ckanext.qa.sniffer')
+    result = {'filepath': filepath}
+    start = time.time()
+    try:
+        format_ = sniff_file_format(filepath, log) or {}
+    except Exception, e:
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+        log.error('Error sniffing %s: %s', filepath, result['error'])
+        format_ = {}
+    result['ms'] = round((time.time() - start) * 1000, 1)
+    for key in ('format', 'container', 'detector'):
+        result[key] = format_.get(key)
+    return result
@@ -0,0 +1,28 @@
+from ckan.plugins.interfaces import Interface
+
+
+class IFormatDetectors(Interface):
+    '''
+    Add detectors for file formats, that are used when sniffing the format
+    of resources' files.
+    '''
+
+    def get_format_detectors(self):
+        '''
+        Returns a list of ckanext.qa.sniff_format.Detector objects. They are
+        run along with the built-in ones, in order of cost, and the first
+        that recognises the file decides its format. e.g.
+
+            from ckanext.qa.sniff_format import Detector, COST_CHEAP
+
+            def is_geojson(buf, log):
+                return '"FeatureCollection"' in buf
+
+            def get_format_detectors(self):
+                return [Detector('is_geojson', is_geojson,
+                                 mime_types=('text/*',),
+                                 formats=('TXT', 'JSON', None),
+                                 cost=COST_CHEAP, prefix_size=1000,
+                                 format='GeoJSON')]
+        '''
+        return []
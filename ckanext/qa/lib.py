@@ -1,7 +1,10 @@
 import os
 import json
 import re
+import atexit
+import hashlib
 import logging
+import threading
 
 from pylons import config
 
@@ -9,10 +12,30 @@ from ckan import plugins as p
 from ckan.lib.celery_app import celery
 from ckan.model.types import make_uuid
 
+from ckanext.qa.coalesce import CoalescingBuffer, merge_qa_requests
+
 
 log = logging.getLogger(__name__)
 
 _RESOURCE_FORMAT_SCORES = None
+_RESOURCE_FORMAT_SCORES_MTIME = None
+_FORMAT_INDEX = None
+_SNIFFER_FORMAT_INDEX = None  # (format_index it extends, index)
+_RESOURCE_FORMAT_SCORES_VERSION = None
+_MUNGED_FORMATS = {}
+MAX_MUNGED_FORMATS = 10000
+_QA_REQUEST_BUFFER = None
+
+
+def resource_format_scores_filepath():
+    json_filepath = config.get('qa.resource_format_openness_scores_json')
+    if not json_filepath:
+        import ckanext.qa.plugin
+        json_filepath = os.path.join(
+            os.path.dirname(os.path.realpath(ckanext.qa.plugin.__file__)),
+            'resource_format_openness_scores.json'
+        )
+    return json_filepath
 
 
 def resource_format_scores():
@@ -28,16 +51,11 @@ def resource_format_scores():
     Fuller description of the fields are described in
     `ckan/config/resource_formats.json`.
     '''
-    global _RESOURCE_FORMAT_SCORES
+    global _RESOURCE_FORMAT_SCORES, _RESOURCE_FORMAT_SCORES_MTIME
     if not _RESOURCE_FORMAT_SCORES:
         _RESOURCE_FORMAT_SCORES = {}
-        json_filepath = config.get('qa.resource_format_openness_scores_json')
-        import ckanext.qa.plugin
-        if not json_filepath:
-            json_filepath = os.path.join(
-                os.path.dirname(os.path.realpath(ckanext.qa.plugin.__file__)),
-                'resource_format_openness_scores.json'
-            )
+        json_filepath = resource_format_scores_filepath()
+        _RESOURCE_FORMAT_SCORES_MTIME = os.stat(json_filepath).st_mtime
         with open(json_filepath) as format_file:
             try:
                 file_resource_formats = json.loads(format_file.read())
@@ -62,6 +80,17 @@ def resource_format_scores():
     return _RESOURCE_FORMAT_SCORES
 
 
+def resource_format_scores_version():
+    '''Returns a short hash of the openness scores, which changes when they
+    are configured differently.'''
+    global _RESOURCE_FORMAT_SCORES_VERSION
+    if _RESOURCE_FORMAT_SCORES_VERSION is None:
+        _RESOURCE_FORMAT_SCORES_VERSION = hashlib.md5(
+            json.dumps(sorted(resource_format_scores().items()))
+            ).hexdigest()[:12]
+    return _RESOURCE_FORMAT_SCORES_VERSION
+
+
 def munge_format_to_be_canonical(format_name):
     '''Tries some things to help try and get a resource format to match one of
     the canonical ones
@@ -72,17 +101,117 @@ def munge_format_to_be_canonical(format_name):
     return re.sub('[^a-z/+]', '', format_name)
 
 
-def create_qa_update_package_task(package, queue):
+def format_index():
+    '''Returns a dict for looking up formats. It maps every name, extension,
+    MIME type and alternative name of a format in ckan's
+    resource_formats.json, in lower case, to a tuple: (format short name,
+    openness score). The score is None if it is not configured.
+
+    It is built once per process, so do not modify it. Use lookup_format() to
+    also find formats that need munging first.
+    '''
+    global _FORMAT_INDEX
+    if _FORMAT_INDEX is None:
+        import ckan.lib.helpers as ckan_helpers
+        scores = resource_format_scores()
+        index = {}
+        for key, format_tuple in ckan_helpers.resource_formats().iteritems():
+            index[key] = (format_tuple[1], scores.get(format_tuple[1]))
+        _FORMAT_INDEX = index
+    return _FORMAT_INDEX
+
+
+def sniffer_format_index():
+    '''Returns format_index(), plus the formats that are only in the
+    openness scores file (e.g. TTL, ICS), so that the sniffer can recognise
+    them by name (e.g. as an XML root element). Scoring by URL extension and
+    format field only uses format_index(), so these names do not affect
+    those scores.
+    '''
+    global _SNIFFER_FORMAT_INDEX
+    index = format_index()
+    if _SNIFFER_FORMAT_INDEX is None or \
+            _SNIFFER_FORMAT_INDEX[0] is not index:
+        sniffer_index = dict(index)
+        for format_, score in resource_format_scores().iteritems():
+            sniffer_index.setdefault(format_.lower(), (format_, score))
+        _SNIFFER_FORMAT_INDEX = (index, sniffer_index)
+    return _SNIFFER_FORMAT_INDEX[1]
+
+
+def lookup_format(format_name):
+    '''Returns (format short name, openness score) for the given format name,
+    extension or MIME type, or None if it is not a known format. Names that
+    are not known as they are (in lower case) are tried again after munging
+    them with munge_format_to_be_canonical.
+    '''
+    if not format_name:
+        return None
+    index = format_index()
+    key = format_name.lower()
+    if key in index:
+        return index[key]
+    if key not in _MUNGED_FORMATS:
+        # remember the result, as the same odd names come up again and again
+        if len(_MUNGED_FORMATS) >= MAX_MUNGED_FORMATS:
+            _MUNGED_FORMATS.clear()
+        _MUNGED_FORMATS[key] = index.get(munge_format_to_be_canonical(key))
+    return _MUNGED_FORMATS[key]
+
+
+def reload_format_index_if_changed():
+    '''Forgets the openness scores and the format index if the scores JSON
+    file has been changed since it was read, so that they are read again
+    when next needed.'''
+    global _RESOURCE_FORMAT_SCORES, _FORMAT_INDEX, \
+        _RESOURCE_FORMAT_SCORES_VERSION
+    if _RESOURCE_FORMAT_SCORES is None:
+        return
+    mtime = os.stat(resource_format_scores_filepath()).st_mtime
+    if mtime != _RESOURCE_FORMAT_SCORES_MTIME:
+        log.info('Openness scores file has changed - reloading it')
+        _RESOURCE_FORMAT_SCORES = None
+        _FORMAT_INDEX = None
+        _RESOURCE_FORMAT_SCORES_VERSION = None
+        _MUNGED_FORMATS.clear()
+
+
+def create_qa_update_packages_task(package_ids, queue, incremental=False,
+                                   producer=None, countdown=None):
+    '''Queues the QA of the packages, given by id - as one qa.update_package
+    task if there is only one, or else one qa.update_packages task for all of
+    them. If incremental, resources that have not changed since they were
+    last scored are skipped. When queuing many tasks, pass the same producer
+    (see celery_producer) to publish them all over one broker connection.
+    Give a countdown (seconds) for the task not to run until then.'''
     from pylons import config
-    task_id = '%s-%s' % (package.name, make_uuid()[:4])
     ckan_ini_filepath = os.path.abspath(config.__file__)
-    celery.send_task('qa.update_package', args=[ckan_ini_filepath, package.id],
-                     task_id=task_id, queue=queue)
-    log.debug('QA of package put into celery queue %s: %s',
-              queue, package.name)
+    if len(package_ids) == 1:
+        task_id = '%s-%s' % (package_ids[0], make_uuid()[:4])
+        celery.send_task('qa.update_package',
+                         args=[ckan_ini_filepath, package_ids[0]],
+                         kwargs={'incremental': incremental},
+                         task_id=task_id, queue=queue, producer=producer,
+                         countdown=countdown)
+    else:
+        task_id = 'packages-%s-%i-%s' % (package_ids[0], len(package_ids),
+                                         make_uuid()[:4])
+        celery.send_task('qa.update_packages',
+                         args=[ckan_ini_filepath, list(package_ids)],
+                         kwargs={'incremental': incremental},
+                         task_id=task_id, queue=queue, producer=producer,
+                         countdown=countdown)
+    log.debug('QA of %i packages put into celery queue %s',
+              len(package_ids), queue)
+
 
+def celery_producer():
+    '''Returns a context manager giving a producer to queue tasks with, over
+    a single broker connection.'''
+    return celery.producer_or_acquire()
 
-def create_qa_update_task(resource, queue):
+
+def create_qa_update_task(resource, queue, producer=None):
     from pylons import config
     if p.toolkit.check_ckan_version(max_version='2.2.99'):
         package = resource.resource_group.package
@@ -91,6 +220,157 @@ def create_qa_update_task(resource, queue):
     task_id = '%s/%s/%s' % (package.name, resource.id[:4], make_uuid()[:4])
     ckan_ini_filepath = os.path.abspath(config.__file__)
     celery.send_task('qa.update', args=[ckan_ini_filepath, resource.id],
-                     task_id=task_id, queue=queue)
+                     task_id=task_id, queue=queue, producer=producer)
     log.debug('QA of resource put into celery queue %s: %s/%s url=%r',
               queue, package.name, resource.id, resource.url)
+
+
+def request_qa(queue, resource_id=None, package_id=None):
+    '''Asks for the QA of a resource or of a whole package (give one of the
+    ids). Rather than being queued straight away, requests are collected for
+    qa.coalesce_window seconds, so that several for the same package (e.g.
+    as the archiver finishes each of its resources) are queued as one task.
+    '''
+    if resource_id:
+        request = (queue, 'resource', resource_id)
+    else:
+        request = (queue, 'package', package_id)
+    get_qa_request_buffer().add(request)
+
+
+def get_qa_request_buffer():
+    '''Returns the buffer of QA requests waiting to be queued, creating it
+    on first use. They are queued qa.coalesce_window seconds after the first
+    is added, or as soon as qa.coalesce_batch_size are waiting.'''
+    global _QA_REQUEST_BUFFER
+    if _QA_REQUEST_BUFFER is None:
+        buffer_ = CoalescingBuffer(
+            queue_qa_requests,
+            window=float(config.get('qa.coalesce_window', 5)),
+            batch_size=int(config.get('qa.coalesce_batch_size', 100)))
+        buffer_.action = 'Queuing QA'
+        _QA_REQUEST_BUFFER = buffer_
+        atexit.register(flush_qa_request_buffer)
+    return _QA_REQUEST_BUFFER
+
+
+def flush_qa_request_buffer():
+    '''Queues the QA requests that are waiting, now.'''
+    if _QA_REQUEST_BUFFER is None or not len(_QA_REQUEST_BUFFER):
+        return
+    try:
+        _QA_REQUEST_BUFFER.flush()
+    except Exception, e:
+        log.error('Queuing QA failed: %s: %s', e.__class__.__name__,
+                  unicode(e))
+
+
+def queue_qa_requests(requests):
+    '''Queues tasks for a batch of QA requests (see request_qa), merged so
+    that each package gets at most one task per queue, over one broker
+    connection.'''
+    from ckan import model
+    try:
+        resource_package_ids = get_resource_package_ids(
+            [id_ for queue, type_, id_ in requests if type_ == 'resource'])
+        tasks = merge_qa_requests(requests, resource_package_ids)
+        with celery_producer() as producer:
+            for queue, package_id, resource_id in tasks:
+                if resource_id:
+                    create_qa_update_resource_task(
+                        resource_id, package_id, queue, producer=producer)
+                else:
+                    # resources that are unchanged since they were scored
+                    # (i.e. were not the ones archived) are skipped
+                    create_qa_update_packages_task(
+                        [package_id], queue, incremental=True,
+                        producer=producer)
+    finally:
+        # this may be run in the buffer's timer thread
+        if threading.current_thread().name != 'MainThread':
+            model.Session.remove()
+    log.info('Queued %i QA tasks for %i requests', len(tasks), len(requests))
+
+
+def get_resource_package_ids(resource_ids):
+    '''Returns {resource_id: package_id} for the resources, with one
+    query.'''
+    from ckan import model
+    if not resource_ids:
+        return {}
+    if p.toolkit.check_ckan_version(max_version='2.2.99'):
+        q = model.Session.query(model.Resource.id,
+                                model.ResourceGroup.package_id) \
+            .join(model.ResourceGroup,
+                  model.Resource.resource_group_id == model.ResourceGroup.id)
+    else:
+        q = model.Session.query(model.Resource.id, model.Resource.package_id)
+    return dict(q.filter(model.Resource.id.in_(resource_ids)))
+
+
+def create_qa_update_resource_task(resource_id, package_id, queue,
+                                   producer=None):
+    '''Queues the QA of a resource, given its id and its package's id.'''
+    task_id = '%s/%s/%s' % (package_id, resource_id[:4], make_uuid()[:4])
+    ckan_ini_filepath = os.path.abspath(config.__file__)
+    celery.send_task('qa.update', args=[ckan_ini_filepath, resource_id],
+                     task_id=task_id, queue=queue, producer=producer)
+    log.debug('QA of resource put into celery queue %s: %s/%s',
+              queue, package_id, resource_id)
+
+
+def staleness_reason(qa_updated, archival_updated, resource_last_modified):
+    '''Returns why a resource needs scoring again (string), given the times
+    it was last scored, archived and modified.'''
+    if qa_updated is None:
+        return 'not scored'
+    if archival_updated and archival_updated > qa_updated:
+        return 'archived since it was scored'
+    if resource_last_modified and resource_last_modified > qa_updated:
+        return 'modified since it was scored'
+    return 'up to date'
+
+
+def plan_rescoring(stale_resources):
+    '''Groups the stale resources (as given by model.get_stale_resources,
+    most urgent first) by their package. Returns a list of (package_id,
+    [(resource_id, reason), ...]), with the package of the most urgent
+    resource first.'''
+    plan = []
+    resources_by_package = {}
+    for resource_id, package_id, qa_updated, archival_updated, \
+            resource_last_modified, views in stale_resources:
+        if package_id not in resources_by_package:
+            resources_by_package[package_id] = []
+            plan.append((package_id, resources_by_package[package_id]))
+        resources_by_package[package_id].append(
+            (resource_id, staleness_reason(qa_updated, archival_updated,
+                                           resource_last_modified)))
+    return plan
+
+
+def schedule_rescoring(queue, budget=None, period=3600, dry_run=False):
+    '''Queues the QA of the packages with the most urgent stale resources
+    (see model.get_stale_resources) - up to "budget" resources (default
+    qa.schedule_budget, per hour) - with the tasks spread out evenly over
+    "period" seconds, so that they do not all run at once. Run it every
+    period, e.g. hourly from cron.
+
+    Returns the plan, as plan_rescoring does.'''
+    from ckanext.qa.model import get_stale_resources
+    if budget is None:
+        budget = int(config.get('qa.schedule_budget', 500))
+    plan = plan_rescoring(get_stale_resources(budget))
+    if dry_run or not plan:
+        return plan
+    interval = float(period) / len(plan)
+    with celery_producer() as producer:
+        for i, (package_id, resources) in enumerate(plan):
+            # unchanged resources of the package are skipped
+            create_qa_update_packages_task(
+                [package_id], queue, incremental=True, producer=producer,
+                countdown=int(i * interval))
+    log.info('Scheduled QA of %i stale resources in %i packages over %is',
+             sum(len(resources) for package_id, resources in plan),
+             len(plan), period)
+    return plan
@@ -1,7 +1,9 @@
+import os
 import uuid
 import datetime
 
 from sqlalchemy import Column
+from sqlalchemy.engine.reflection import Inspector
 from sqlalchemy import types
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -34,9 +36,14 @@ class QA(Base):
     openness_score = Column(types.Integer)
     openness_score_reason = Column(types.UnicodeText)
     format = Column(types.UnicodeText)
+    # hash of everything the score depends on (see tasks.resource_fingerprint)
+    # so that an unchanged resource need not be scored again
+    fingerprint = Column(types.UnicodeText)
 
     created = Column(types.DateTime, default=datetime.datetime.now)
-    updated = Column(types.DateTime, default=datetime.datetime.now)
+    # indexed for finding the stale QAs (see get_stale_resources)
+    updated = Column(types.DateTime, default=datetime.datetime.now,
+                     index=True)
 
     def __repr__(self):
         summary = 'score=%s format=%s' % (self.openness_score, self.format)
@@ -57,6 +64,16 @@ class QA(Base):
                     .filter(cls.resource_id == resource_id) \
                     .first()
 
+    @classmethod
+    def get_for_resources(cls, resource_ids):
+        '''Returns the QA for each of the given resources, in one query, as a
+        dict {resource_id: QA}. Resources without any are left out.'''
+        if not resource_ids:
+            return {}
+        return dict(
+            (qa.resource_id, qa) for qa in model.Session.query(cls)
+            .filter(cls.resource_id.in_(resource_ids)))
+
     @classmethod
     def get_for_package(cls, package_id):
         '''Returns the QA for the given package. May not be any if the package
@@ -69,9 +86,14 @@ class QA(Base):
             .all()
 
     @classmethod
-    def create(cls, resource_id):
+    def create(cls, resource_id, package_id=None):
+        '''Returns a new QA for the resource. Give its package_id if it is
+        known, to save looking it up.'''
         c = cls()
         c.resource_id = resource_id
+        if package_id:
+            c.package_id = package_id
+            return c
 
         # Find the package_id for the resource.
         q = model.Session.query(model.Package.id)
@@ -86,6 +108,96 @@ class QA(Base):
         return c
 
 
+class SniffResult(Base):
+    """
+    Caches the format that the sniffer detected for a file's contents, so
+    that an unchanged file does not need sniffing again. Keyed by the hash of
+    the file's contents, or if that is not known, by its path, size and
+    modification time.
+    """
+    __tablename__ = 'qa_sniff_result'
+
+    key = Column(types.UnicodeText, primary_key=True)
+    # sniff_format.DETECTOR_VERSION at the time of sniffing
+    detector_version = Column(types.Integer, nullable=False)
+    format = Column(types.UnicodeText)  # None if it was not recognized
+    container = Column(types.UnicodeText)
+
+    created = Column(types.DateTime, default=datetime.datetime.now)
+    updated = Column(types.DateTime, default=datetime.datetime.now)
+
+    def __repr__(self):
+        return '<SniffResult %s format=%s container=%s v%s>' % \
+            (self.key, self.format, self.container, self.detector_version)
+
+    @classmethod
+    def key_for_file(cls, filepath, hash_=None):
+        if hash_:
+            return u'hash:%s' % hash_
+        stat = os.stat(filepath)
+        return u'file:%s:%s:%s' % (filepath, stat.st_size, stat.st_mtime)
+
+    @classmethod
+    def get(cls, key):
+        return model.Session.query(cls).get(key)
+
+    @classmethod
+    def get_for_keys(cls, keys):
+        '''Returns the rows for the given keys, in one query, as a dict
+        {key: SniffResult}. Keys without one are left out.'''
+        if not keys:
+            return {}
+        return dict((row.key, row) for row in model.Session.query(cls)
+                    .filter(cls.key.in_(keys)))
+
+    def as_format_dict(self):
+        '''Returns the result in the form that sniff_file_format does.'''
+        if not self.format:
+            return None
+        format_ = {'format': self.format}
+        if self.container:
+            format_['container'] = self.container
+        return format_
+
+
+class SlowFile(Base):
+    """
+    Records files that went over the time or memory limit when they were
+    sniffed. Once a file has done so qa.sniff_slow_file_threshold times, it
+    is not sniffed again (until its contents or the detectors change). Keyed
+    in the same way as SniffResult.
+    """
+    __tablename__ = 'qa_slow_file'
+
+    key = Column(types.UnicodeText, primary_key=True)
+    filepath = Column(types.UnicodeText)
+    # sniff_format.DETECTOR_VERSION at the time of the last failure
+    detector_version = Column(types.Integer, nullable=False)
+    failure_count = Column(types.Integer, nullable=False, default=0)
+    reason = Column(types.UnicodeText)  # of the last failure
+
+    created = Column(types.DateTime, default=datetime.datetime.now)
+    updated = Column(types.DateTime, default=datetime.datetime.now)
+
+    def __repr__(self):
+        return '<SlowFile %s failures=%s v%s %s>' % \
+            (self.filepath, self.failure_count, self.detector_version,
+             self.reason)
+
+    @classmethod
+    def get(cls, key):
+        return model.Session.query(cls).get(key)
+
+    @classmethod
+    def get_for_keys(cls, keys):
+        '''Returns the rows for the given keys, in one query, as a dict
+        {key: SlowFile}. Keys without one are left out.'''
+        if not keys:
+            return {}
+        return dict((row.key, row) for row in model.Session.query(cls)
+                    .filter(cls.key.in_(keys)))
+
+
 def aggregate_qa_for_a_dataset(qa_objs):
     '''Returns aggregated archival info for a dataset, given the archivals for
     its resources (returned by get_for_package).
@@ -115,6 +227,89 @@ def aggregate_qa_for_a_dataset(qa_objs):
     return qa_dict
 
 
+def get_stale_resources(limit):
+    '''Returns the resources (of active datasets) whose QA is missing or out
+    of date - they have been archived or modified since they were last
+    scored - most urgent first, using a single query.
+
+    Those that have never been scored come first, then those of the datasets
+    most viewed recently (according to CKAN's page view tracking, if it is
+    enabled), then those that were scored longest ago. The recent views are
+    those in the latest tracking summary, so that only its rows are read,
+    rather than the whole history. (A dataset not viewed that day counts as
+    not viewed.)
+
+    :param limit: the most resources to return
+    :returns: list of (resource_id, package_id, qa_updated, archival_updated,
+              resource_last_modified, views) tuples, where qa_updated is
+              None if it has not been scored
+    '''
+    import sqlalchemy as sa
+    from ckanext.archiver.model import Archival
+    latest_tracking_date = model.Session.query(
+        sa.func.max(model.TrackingSummary.tracking_date)) \
+        .as_scalar()
+    views = model.Session.query(
+        model.TrackingSummary.package_id.label('package_id'),
+        sa.func.max(model.TrackingSummary.recent_views).label('views')) \
+        .filter(model.TrackingSummary.tracking_date == latest_tracking_date) \
+        .group_by(model.TrackingSummary.package_id) \
+        .subquery()
+    package_views = sa.func.coalesce(views.c.views, 0)
+    q = model.Session.query(
+        model.Resource.id, model.Package.id, QA.updated, Archival.updated,
+        model.Resource.last_modified, package_views)
+    if toolkit.check_ckan_version(max_version='2.2.99'):
+        q = q.join(model.ResourceGroup,
+                   model.Resource.resource_group_id ==
+                   model.ResourceGroup.id) \
+             .join(model.Package,
+                   model.ResourceGroup.package_id == model.Package.id)
+    else:
+        q = q.join(model.Package,
+                   model.Resource.package_id == model.Package.id)
+    q = q.outerjoin(QA, QA.resource_id == model.Resource.id) \
+         .outerjoin(Archival, Archival.resource_id == model.Resource.id) \
+         .outerjoin(views, views.c.package_id == model.Package.id) \
+         .filter(model.Resource.state == 'active') \
+         .filter(model.Package.state == 'active') \
+         .filter(sa.or_(QA.id == None,
+                        Archival.updated > QA.updated,
+                        model.Resource.last_modified > QA.updated)) \
+         .order_by(sa.case([(QA.id == None, 0)], else_=1),
+                   package_views.desc(),
+                   QA.updated) \
+         .limit(limit)
+    return q.all()
+
+
 def init_tables(engine):
     Base.metadata.create_all(engine)
+    add_new_columns(engine)
+    add_new_indexes(engine)
     log.info('QA database tables are set-up')
+
+
+def add_new_columns(engine):
+    '''Adds the columns that are newer than the tables, if they were created
+    by an earlier version.'''
+    inspector = Inspector.from_engine(engine)
+    existing_columns = [column['name'] for column in
+                        inspector.get_columns('qa')]
+    for column in QA.__table__.columns:
+        if column.name not in existing_columns:
+            log.info('Adding column qa.%s', column.name)
+            engine.execute('ALTER TABLE qa ADD COLUMN %s %s' % (
+                column.name, column.type.compile(dialect=engine.dialect)))
+
+
+def add_new_indexes(engine):
+    '''Adds the indexes that are newer than the tables, if they were created
+    by an earlier version.'''
+    inspector = Inspector.from_engine(engine)
+    existing_indexes = [index['name'] for index in
+                        inspector.get_indexes('qa')]
+    for index in QA.__table__.indexes:
+        if index.name not in existing_indexes:
+            log.info('Adding index %s', index.name)
+            index.create(engine)
@@ -0,0 +1,232 @@
+'''
+Minimal reader for OLE2 Compound Document files (the container used by
+Microsoft Office 97-2003 .xls, .doc and .ppt files).
+
+It reads just the directory and the SummaryInformation stream, which is
+enough to tell which Office application made the file, without loading the
+whole document (as xlrd does) or running the "file" command.
+
+Format reference: [MS-CFB] Compound File Binary File Format and
+[MS-OLEPS] Object Linking and Embedding Property Set Data Structures.
+'''
+import struct
+
+SIGNATURE = '\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+
+ENDOFCHAIN = 0xFFFFFFFE
+MAX_REGULAR_SECTOR = 0xFFFFFFFA
+
+STREAM = 2
+ROOT_STORAGE = 5
+
+SUMMARY_INFORMATION = u'\x05SummaryInformation'
+PIDSI_APPNAME = 0x12
+VT_LPSTR = 0x1E
+
+# "Name of Creating Application" (as reported by the "file" command) mapped to
+# the file extension
+APP_NAME_TO_EXTENSION = {
+    'Microsoft Office PowerPoint': 'ppt',
+    'Microsoft PowerPoint': 'ppt',
+    'Microsoft Excel': 'xls',
+    'Microsoft Office Word': 'doc',
+    'Microsoft Word 10.0': 'doc',
+    'Microsoft Macintosh Word': 'doc',
+    }
+
+# Names of the main stream of each type of document, mapped to the file
+# extension
+STREAM_NAME_TO_EXTENSION = {
+    u'workbook': 'xls',  # BIFF8
+    u'book': 'xls',  # BIFF5
+    u'worddocument': 'doc',
+    u'powerpoint document': 'ppt',
+    }
+
+
+class Ole2Error(Exception):
+    pass
+
+
+def is_ole2(buf):
+    return buf[:8] == SIGNATURE
+
+
+class Ole2File(object):
+    '''Read-only access to the directory and small streams of an OLE2 file.
+
+    :param fileobj: the file, opened for reading in binary mode. It is read
+                    with seeks, and only the sectors that are needed - the
+                    header, the directory, the parts of the FAT that cover
+                    their chains and the SummaryInformation stream - so a
+                    large file is not read (or mapped into memory) in full.
+    '''
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        fileobj.seek(0)
+        header = fileobj.read(512)
+        if not is_ole2(header):
+            raise Ole2Error('Not an OLE2 file')
+        if len(header) < 512:
+            raise Ole2Error('Truncated header')
+        sector_shift, mini_sector_shift = struct.unpack('<HH', header[30:34])
+        if sector_shift not in (9, 12) or mini_sector_shift != 6:
+            raise Ole2Error('Bad sector size')
+        self.sector_size = 1 << sector_shift
+        self.mini_sector_size = 1 << mini_sector_shift
+        (num_fat_sectors, self.first_directory_sector, _,
+         self.mini_stream_cutoff, self.first_mini_fat_sector,
+         num_mini_fat_sectors, first_difat_sector, num_difat_sectors) = \
+            struct.unpack('<IIIIIIII', header[44:76])
+        # the most sectors the file could have - used to stop chains looping
+        fileobj.seek(0, 2)
+        self.max_sectors = fileobj.tell() / self.sector_size
+
+        # the DIFAT lists the FAT sectors - the first 109 are in the header
+        fat_sectors = list(struct.unpack('<109I', header[76:512]))
+        sector = first_difat_sector
+        self.entries_per_sector = self.sector_size / 4
+        for i in xrange(num_difat_sectors):
+            if sector > MAX_REGULAR_SECTOR or \
+                    len(fat_sectors) >= num_fat_sectors:
+                break
+            entries = struct.unpack('<%iI' % self.entries_per_sector,
+                                    self._sector(sector))
+            fat_sectors.extend(entries[:-1])
+            sector = entries[-1]
+        self.fat_sectors = fat_sectors[:num_fat_sectors]
+        self._fat = {}  # index of FAT sector: its entries
+        self.mini_fat = None
+        self.directory = self._read_directory()
+
+    def _sector(self, sector):
+        self.fileobj.seek((sector + 1) * self.sector_size)
+        buf = self.fileobj.read(self.sector_size)
+        if len(buf) < self.sector_size:
+            raise Ole2Error('Sector %i is beyond the end of the file' % sector)
+        return buf
+
+    def _next_sector(self, sector):
+        '''Returns the entry in the FAT for the sector - the next sector in
+        its chain. Each sector of the FAT is read when it is first needed.'''
+        index, offset = divmod(sector, self.entries_per_sector)
+        if index not in self._fat:
+            if index >= len(self.fat_sectors) or \
+                    self.fat_sectors[index] > MAX_REGULAR_SECTOR:
+                raise Ole2Error('Bad sector chain')
+            self._fat[index] = struct.unpack(
+                '<%iI' % self.entries_per_sector,
+                self._sector(self.fat_sectors[index]))
+        return self._fat[index][offset]
+
+    def _chain(self, start, next_sector, max_length):
+        '''Returns the list of sectors in the chain starting at start.'''
+        chain = []
+        sector = start
+        while sector != ENDOFCHAIN:
+            if sector > MAX_REGULAR_SECTOR or len(chain) > max_length:
+                raise Ole2Error('Bad sector chain')
+            chain.append(sector)
+            sector = next_sector(sector)
+        return chain
+
+    def _read_chain(self, start, size=None):
+        data = ''.join(self._sector(s) for s in
+                       self._chain(start, self._next_sector,
+                                   self.max_sectors))
+        return data if size is None else data[:size]
+
+    def _read_directory(self):
+        data = self._read_chain(self.first_directory_sector)
+        entries = []
+        for offset in xrange(0, len(data) - 127, 128):
+            entry = data[offset:offset + 128]
+            name_length, type_ = struct.unpack('<HB', entry[64:67])
+            name = entry[:max(name_length - 2, 0)].decode('utf-16-le',
+                                                          'replace')
+            start, size = struct.unpack('<II', entry[116:124])
+            entries.append((name, type_, start, size))
+        if not entries or entries[0][1] != ROOT_STORAGE:
+            raise Ole2Error('No root entry')
+        return entries
+
+    def stream_names(self):
+        return [name for name, type_, start, size in self.directory
+                if type_ == STREAM]
+
+    def read_stream(self, name):
+        '''Returns the contents of the named stream, or None if there is no
+        such stream.'''
+        for entry_name, type_, start, size in self.directory:
+            if type_ == STREAM and entry_name == name:
+                break
+        else:
+            return None
+        if size >= self.mini_stream_cutoff:
+            return self._read_chain(start, size)
+        # small streams are stored in mini sectors, in the mini stream (which
+        # is the root entry's data)
+        if self.mini_fat is None:
+            mini_fat = self._read_chain(self.first_mini_fat_sector) \
+                if self.first_mini_fat_sector <= MAX_REGULAR_SECTOR else ''
+            self.mini_fat = struct.unpack('<%iI' % (len(mini_fat) / 4),
+                                          mini_fat[:len(mini_fat) / 4 * 4])
+            root_start, root_size = self.directory[0][2:4]
+            self.mini_stream = self._read_chain(root_start, root_size)
+        chain = self._chain(start, self._next_mini_sector,
+                            len(self.mini_stream) / self.mini_sector_size)
+        return ''.join(
+            self.mini_stream[s * self.mini_sector_size:
+                             (s + 1) * self.mini_sector_size]
+            for s in chain)[:size]
+
+    def _next_mini_sector(self, sector):
+        if sector >= len(self.mini_fat):
+            raise Ole2Error('Bad mini sector chain')
+        return self.mini_fat[sector]
+
+    def app_name(self):
+        '''Returns the "Name of Creating Application" property from the
+        SummaryInformation stream, or None.'''
+        stream = self.read_stream(SUMMARY_INFORMATION)
+        if not stream or len(stream) < 48:
+            return None
+        section_offset, = struct.unpack('<I', stream[44:48])
+        section = stream[section_offset:]
+        if len(section) < 8:
+            return None
+        num_properties, = struct.unpack('<I', section[4:8])
+        for i in xrange(min(num_properties, (len(section) - 8) / 8)):
+            property_id, offset = struct.unpack('<II',
+                                                section[8 + i * 8:16 + i * 8])
+            if property_id != PIDSI_APPNAME:
+                continue
+            type_, length = struct.unpack('<II', section[offset:offset + 8])
+            if type_ != VT_LPSTR:
+                return None
+            return section[offset + 8:offset + 8 + length].split('\0')[0]
+        return None
+
+
+def get_office_extension(fileobj, log):
+    '''Given an OLE2 file (a file object), returns the extension of the
+    Office format it is ('xls', 'doc' or 'ppt'), or None if it is not one of
+    those.'''
+    try:
+        ole = Ole2File(fileobj)
+        app_name = ole.app_name()
+        stream_names = [name.lower() for name in ole.stream_names()]
+    except (Ole2Error, struct.error), e:
+        log.info('Could not read OLE2 file: %s', e)
+        return None
+    if app_name in APP_NAME_TO_EXTENSION:
+        log.info('OLE2 Name of Creating Application: %s', app_name)
+        return APP_NAME_TO_EXTENSION[app_name]
+    for stream_name in stream_names:
+        if stream_name in STREAM_NAME_TO_EXTENSION:
+            log.info('OLE2 file has a "%s" stream (application: %s)',
+                     stream_name, app_name)
+            return STREAM_NAME_TO_EXTENSION[stream_name]
+    log.info('OLE2 file not recognised as Office format. Application: %s '
+             'Streams: %r', app_name, stream_names)
+    return None
@@ -1,7 +1,6 @@
 import logging
 import types
 
-import ckan.model as model
 import ckan.plugins as p
 
 from ckanext.archiver.interfaces import IPipe
@@ -45,16 +44,13 @@ class QAPlugin(p.SingletonPlugin, p.toolkit.DefaultDatasetForm):
 
     def receive_data(self, operation, queue, **params):
         '''Receive notification from ckan-archiver that a resource has been
-        archived.
+        archived. The QA is requested, rather than queued straight away, so
+        that when several resources of a dataset are archived at about the
+        same time, they are QA'd with one task (see lib.request_qa).
         '''
         if not operation == 'archived':
             return
-        resource_id = params['resource_id']
-
-        resource = model.Resource.get(resource_id)
-        assert resource
-
-        lib.create_qa_update_task(resource, queue=queue)
+        lib.request_qa(queue, resource_id=params['resource_id'])
 
     # IReport
 
@@ -0,0 +1,26 @@
+'''
+Refreshes the search index for the datasets whose QA has changed, in
+batches. During a bulk rescore the same dataset's QA changes many times over
+(once per resource), so rather than reindexing it (and committing Solr)
+after each one, the dataset ids are collected for a short window and then
+indexed together, with a single commit.
+'''
+from ckanext.qa.coalesce import CoalescingBuffer
+
+
+class ReindexBuffer(CoalescingBuffer):
+    '''Collects the ids of packages to reindex, and indexes them once
+    "window" seconds have passed since the first was added, or as soon as
+    "batch_size" of them are waiting, whichever is sooner. A window of 0
+    means each is indexed straight away.
+
+    :param index_packages: func(package_ids) that indexes the packages and
+                           then commits the index once
+    :param window: seconds to wait for more packages
+    :param batch_size: most packages to index in one go
+    '''
+    action = 'Search indexing'
+
+    def __init__(self, index_packages, window=10, batch_size=100):
+        super(ReindexBuffer, self).__init__(index_packages, window=window,
+                                            batch_size=batch_size)
@@ -0,0 +1,297 @@
+'''
+Scores resources on Sir Tim Berners-Lee\'s five stars of openness, from the
+facts about them - their URL, format field, archival and sniffed format, and
+whether their dataset's license is open - as plain records. It needs no
+database or CKAN, so whole batches can be scored at once, and it can be
+tested and benchmarked on its own. The tasks gather the facts (and do the
+sniffing) and then score them here.
+'''
+
+# What the content of the file appeared to be, depending on whether it was
+# sniffed from the whole file or just the start of it, fetched from its URL
+SNIFFED_FORMAT_REASONS = {
+    False: 'Content of file appeared to be format "%s" which receives '
+           'openness score: %s.',
+    True: 'Content of the start of the file appeared to be format "%s" which '
+          'receives openness score: %s.',
+}
+
+
+class ArchivalRecord(object):
+    '''What the archiver found when it last tried to download a resource -
+    the attributes of an Archival that scoring uses.'''
+    __slots__ = ('is_broken', 'status', 'reason', 'updated', 'last_success',
+                 'failure_count', 'first_failure')
+
+    def __init__(self, is_broken=None, status=None, reason=None,
+                 updated=None, last_success=None, failure_count=0,
+                 first_failure=None):
+        self.is_broken = is_broken
+        self.status = status
+        self.reason = reason
+        self.updated = updated
+        self.last_success = last_success
+        self.failure_count = failure_count
+        self.first_failure = first_failure
+
+    @classmethod
+    def from_object(cls, archival):
+        '''Copies the fields from an object that has them, such as an
+        Archival. Returns None for None.'''
+        if archival is None:
+            return None
+        return cls(*[getattr(archival, name) for name in cls.__slots__])
+
+
+class ResourceRecord(object):
+    '''The facts about a resource that its score depends on.
+
+    :ivar id: resource id, only used in log messages
+    :ivar url: its URL
+    :ivar format: its format field
+    :ivar is_open: whether its dataset's license is open
+    :ivar archival: ArchivalRecord, or None if it has not been archived
+    :ivar sniffed_format: format that its contents appeared to be, or None
+    :ivar sniffed_by_url: whether that was sniffed from just the start of
+                          the file, fetched from its URL
+    :ivar sniff_reasons: list of strings saying how the sniffing went
+    :ivar previous_format: its format when it was scored before, if any
+    '''
+    __slots__ = ('id', 'url', 'format', 'is_open', 'archival',
+                 'sniffed_format', 'sniffed_by_url', 'sniff_reasons',
+                 'previous_format')
+
+    def __init__(self, id=None, url='', format=None, is_open=False,
+                 archival=None, sniffed_format=None, sniffed_by_url=False,
+                 sniff_reasons=(), previous_format=None):
+        self.id = id
+        self.url = url
+        self.format = format
+        self.is_open = is_open
+        self.archival = archival
+        self.sniffed_format = sniffed_format
+        self.sniffed_by_url = sniffed_by_url
+        self.sniff_reasons = sniff_reasons
+        self.previous_format = previous_format
+
+
+class Scorer(object):
+    '''Scores ResourceRecords (or tuples of their fields, in order).
+
+    :param format_index: {lower case format name, extension or MIME type:
+                          (format short name, score or None)} as given by
+                          lib.format_index()
+    :param format_scores: {format short name: score} as given by
+                          lib.resource_format_scores()
+    :param lookup_format: func(format_field) that returns (format short name,
+                          score) or None - by default it is looked up in
+                          format_index as it is, in lower case
+    '''
+    def __init__(self, format_index, format_scores, lookup_format=None):
+        self.format_index = format_index
+        self.format_scores = format_scores
+        self.lookup_format = lookup_format or self._lookup_format
+
+    def _lookup_format(self, format_name):
+        if not format_name:
+            return None
+        return self.format_index.get(format_name.lower())
+
+    def score_records(self, records, log=None):
+        '''Scores each of the records. Returns a list of (score, reason,
+        format) tuples, in the same order.'''
+        score = self.score
+        return [score(record, log) for record in records]
+
+    def score(self, record, log=None):
+        '''Returns (score, reason, format) for the record - the openness
+        score (int), the reason for it (string) and the format of the data
+        (string or None).'''
+        if not isinstance(record, ResourceRecord):
+            record = ResourceRecord(*record)
+        score_reasons = []  # a list of strings detailing how we scored it
+        score, format_ = score_if_link_broken(record, score_reasons, log)
+        if score is None:
+            # we don't want to take the publisher's word for it, in case the
+            # link is only to a landing page, so highest priority is the
+            # sniffed type
+            score, format_ = self.score_by_sniffed_format(record,
+                                                          score_reasons)
+            if score is None:
+                # Fall-backs are user-given data
+                score, format_ = self.score_by_url_extension(record,
+                                                             score_reasons)
+                if score is None:
+                    score, format_ = self.score_by_format_field(
+                        record, score_reasons)
+                    if score is None:
+                        if log:
+                            log.warning('Could not score resource: "%s" '
+                                        'with url: "%s"',
+                                        record.id, record.url)
+                        score_reasons.append('Could not understand the file format, therefore score is 1.')
+                        score = 1
+                        if format_ is None:
+                            # use any previously stored format value for
+                            # this resource
+                            format_ = record.previous_format
+        score_reason = ' '.join(score_reasons)
+        format_ = format_ or None
+
+        # Even if we can get the link, we should still treat the resource
+        # as having a score of 0 if the license isn't open.
+        #
+        # It is important we do this check after the link check, otherwise
+        # the link checker won't get the chance to see if the resource
+        # is broken.
+        if score > 0 and not record.is_open:
+            score_reason = 'License not open'
+            score = 0
+        return score, score_reason, format_
+
+    def score_by_sniffed_format(self, record, score_reasons):
+        '''
+        Scores the format that the data file\'s contents appeared to be.
+
+        It adds the reasons from sniffing it to score_reasons, and a string
+        about how it came to the conclusion.
+
+        Return values:
+          * It returns a tuple: (score, format_string)
+          * If the format could not be sniffed then format_string is None
+          * If it cannot score it, then score is None
+        '''
+        score_reasons.extend(record.sniff_reasons)
+        if not record.sniffed_format:
+            return (None, None)
+        score = self.format_scores.get(record.sniffed_format)
+        score_reasons.append(SNIFFED_FORMAT_REASONS[record.sniffed_by_url] %
+                             (record.sniffed_format, score))
+        return score, record.sniffed_format
+
+    def score_by_url_extension(self, record, score_reasons):
+        '''
+        Looks at the URL for a resource to determine its format and score.
+
+        It adds strings to score_reasons list about how it came to the
+        conclusion.
+
+        Return values:
+          * It returns a tuple: (score, format_string)
+          * If it cannot work out the format then format is None
+          * If it cannot score it, then score is None
+        '''
+        extension_variants_ = extension_variants(record.url.strip())
+        if not extension_variants_:
+            score_reasons.append('Could not determine a file extension in the URL.')
+            return (None, None)
+        for extension in extension_variants_:
+            format_info = self.format_index.get(extension.lower())
+            if format_info:
+                format_, score = format_info
+                if score:
+                    score_reasons.append('URL extension "%s" relates to format "%s" and receives score: %s.' % (extension, format_, score))
+                    return score, format_
+                else:
+                    score = 1
+                    score_reasons.append('URL extension "%s" relates to format "%s" but a score for that format is not configured, so giving it default score %s.' % (extension, format_, score))
+                    return score, format_
+            score_reasons.append('URL extension "%s" is an unknown format.' % extension)
+        return (None, None)
+
+    def score_by_format_field(self, record, score_reasons):
+        '''
+        Looks at the format field of a resource to determine its format and
+        score.
+
+        It adds strings to score_reasons list about how it came to the
+        conclusion.
+
+        Return values:
+          * It returns a tuple: (score, format_string)
+          * If it cannot work out the format then format_string is None
+          * If it cannot score it, then score is None
+        '''
+        format_field = record.format or ''
+        if not format_field:
+            score_reasons.append('Format field is blank.')
+            return (None, None)
+        format_info = self.lookup_format(format_field)
+        if not format_info:
+            score_reasons.append('Format field "%s" does not correspond to a known format.' % format_field)
+            return (None, None)
+        format_, score = format_info
+        score_reasons.append('Format field "%s" receives score: %s.' %
+                             (format_field, score))
+        return (score, format_)
+
+
+def score_if_link_broken(record, score_reasons, log=None):
+    '''
+    Looks to see if the archiver said it was broken, and if so, writes to
+    the score_reasons and returns a score.
+
+    Return values:
+      * Returns a tuple: (score, format_)
+      * score is an integer or None if it cannot be determined
+      * format_ is a string or None
+    '''
+    archival = record.archival
+    if archival and archival.is_broken:
+        # Score 0 since we are sure the link is currently broken
+        score_reasons.append(broken_link_error_message(archival))
+        format_ = record.previous_format
+        if log:
+            log.info('Archiver says link is broken. Previous format: %r' %
+                     format_)
+        return (0, format_)
+    return (None, None)
+
+
+def broken_link_error_message(archival):
+    '''Given an archival for a broken link, it returns a helpful
+    error message (string) describing the attempts.'''
+    def format_date(date):
+        if date:
+            return date.strftime('%d/%m/%Y')
+        else:
+            return ''
+    messages = ['File could not be downloaded.',
+                'Reason: %s.' % archival.status,
+                'Error details: %s.' % archival.reason,
+                'Attempted on %s.' % format_date(archival.updated)]
+    last_success = format_date(archival.last_success)
+    if archival.failure_count == 1:
+        if last_success:
+            messages.append('This URL worked the previous time: %s.' % last_success)
+        else:
+            messages.append('This was the first attempt.')
+    else:
+        messages.append('Tried %s times since %s.' % \
+                        (archival.failure_count,
+                         format_date(archival.first_failure)))
+        if last_success:
+            messages.append('This URL last worked on: %s.' % last_success)
+        else:
+            messages.append('This URL has not worked in the history of this tool.')
+    return ' '.join(messages)
+
+
+def extension_variants(url):
+    '''
+    Returns a list of extensions, in order of which would more
+    significant.
+
+    >>> extension_variants('http://dept.gov.uk/coins.data.1996.csv.zip')
+    ['csv.zip', 'zip']
+    >>> extension_variants('http://dept.gov.uk/data.csv?callback=1')
+    ['csv']
+    '''
+    url = url.split('?')[0] # get rid of params
+    url = url.split('/')[-1] # get rid of path - leaves filename
+    split_url = url.split('.')
+    results = []
+    for number_of_sections in [2, 1]:
+        if len(split_url) > number_of_sections:
+            results.append('.'.join(split_url[-number_of_sections:]))
+    return results
@@ -1,211 +1,616 @@
 import re
+import fnmatch
+import codecs
 import zipfile
+import tarfile
+import zlib
+import bz2
 import os
+import struct
 from collections import defaultdict
-import subprocess
 import StringIO
 
-import xlrd
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        # xz files are still detected, but not what is inside them
+        lzma = None
+
 import magic
 import messytables
 
 from ckanext.qa import lib
-from ckan.lib import helpers as ckan_helpers
+from ckanext.qa import ole2
+from ckanext.qa.interfaces import IFormatDetectors
+import ckan.plugins as p
+
+# Increment this when a change to the detectors could change the format
+# detected for a file, so that cached results (see model.SniffResult) are
+# discarded.
+DETECTOR_VERSION = 9
+
+# Size of the prefix of each file that is read (with a single read) and shared
+# between libmagic and all the content detectors. libmagic itself only looks
+# at the first 1MB or so of a file.
+MAGIC_PREFIX_SIZE = 1024 * 1024
+
+# Size of the prefix that the HTML detectors look at (mostly just the
+# start of it, but RDFa attributes could be anywhere)
+MARKUP_PREFIX_SIZE = 100000
+
+# How much of a file inside a zip, tar or compressed file is decompressed to
+# sniff its format. Only this much is held in memory, however big the file is.
+MEMBER_PREFIX_SIZE = 64 * 1024
+
+# How many containers deep to look, e.g. a csv.gz in a zip is 2 deep
+MAX_CONTAINER_DEPTH = 2
+
+# How much of a compressed tar file is decompressed to list the files in it,
+# to choose which to sniff. A compressed tar can only be read forwards, so
+# for a bigger one the choice is made from the files listed by then.
+TAR_LISTING_SIZE = 256 * 1024 * 1024
+
+
+class FilePrefix(object):
+    '''The start of a file, read lazily and only once, so that the file
+    format detectors can all share it, rather than each reopening the file.
+
+    The file is only opened and read when a detector first asks for some of
+    it, and then up to max_size bytes are read in one go. For the detectors
+    that need the whole file (e.g. zip and OLE2), fileobj() provides it
+    without reopening the file.
+    '''
+    def __init__(self, filepath, max_size=MAGIC_PREFIX_SIZE):
+        self.filepath = filepath
+        self.max_size = max_size
+        self._buf = ''
+        self._file = None
+        self.complete = False  # whether the buffer holds the whole file
+        self.depth = 0  # how many containers (zip etc) this file is inside
+        self.mime_type = None  # as libmagic detects it
+        self._text = {}  # size: translated text
+        self._markup = {}  # size: MarkupSignature
+        self._xml_root = None  # XmlRootSniffer
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _grow(self, size):
+        size = min(size, self.max_size)
+        if self.complete or len(self._buf) >= size:
+            return
+        if self._file is None:
+            self._file = open(self.filepath, 'rb')
+        # read a whole max_size chunk in one go, as a second read usually
+        # costs a round-trip to the file server
+        self._buf += self._file.read(self.max_size - len(self._buf))
+        if len(self._buf) < self.max_size:
+            self.complete = True
+
+    def read(self, size):
+        '''Returns the first "size" bytes of the file.'''
+        self._grow(size)
+        return self._buf[:size]
+
+    def text(self, size):
+        '''Returns the first "size" characters of the file, with newlines
+        translated, the same as reading it with open(filepath, 'rU').'''
+        if size not in self._text:
+            self._text[size] = self._translate_newlines(size)
+        return self._text[size]
+
+    def markup(self, size):
+        '''Returns the MarkupSignature of the first "size" bytes of the
+        file.'''
+        if size not in self._markup:
+            self._markup[size] = MarkupSignature(self.read(size))
+        return self._markup[size]
+
+    def xml_root(self):
+        '''Returns the XmlRootSniffer of the file, having fed it as much of
+        the file as it needs to find the root element.'''
+        if self._xml_root is None:
+            sniffer = XmlRootSniffer()
+            for chunk in self.chunks():
+                if sniffer.feed(chunk) is not None:
+                    break
+            sniffer.feed('', final=True)
+            self._xml_root = sniffer
+        return self._xml_root
+
+    def chunks(self, chunk_size=64 * 1024):
+        '''Yields the whole of the file, in chunks, starting with the prefix
+        that is already read, so only one chunk is in memory at a time.'''
+        self._grow(self.max_size)
+        yield self._buf
+        if not self.complete:
+            self._file.seek(len(self._buf))
+            while True:
+                chunk = self._file.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def _translate_newlines(self, size):
+        buf = self.read(size + 1)
+        buf = buf.replace('\r\n', '\n').replace('\r', '\n')
+        if len(buf) < size and not self.complete:
+            # translation shrank the buffer, so there is more to come
+            buf = self.read(size * 2).replace('\r\n', '\n') \
+                .replace('\r', '\n')
+        return buf[:size]
+
+    def fileobj(self):
+        '''Returns a file object for the whole of the file, positioned at
+        the start, for libraries that want to seek around it (e.g. zipfile).
+        '''
+        self._grow(self.max_size)
+        if self.complete:
+            return StringIO.StringIO(self._buf)
+        self._file.seek(0)
+        return self._file
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class MemberPrefix(FilePrefix):
+    '''The start of a file that is already in memory, having been
+    decompressed from a container (zip, tar, gzip etc) or fetched from a URL.
+
+    :param buf: the start of the file
+    :param name: the file's name inside the container, or its URL (for the
+                 logs)
+    :param complete: whether buf is the whole of the file
+    :param depth: how many containers the file is inside
+    '''
+    def __init__(self, buf, name, complete, depth):
+        super(MemberPrefix, self).__init__(name, max_size=len(buf))
+        self._buf = buf
+        self.complete = complete
+        self.depth = depth
+
+    def _grow(self, size):
+        pass
+
+    def fileobj(self):
+        return StringIO.StringIO(self._buf)
+
+    def chunks(self, chunk_size=None):
+        yield self._buf
 
 
 def sniff_file_format(filepath, log):
     '''For a given filepath, work out what file format it is.
 
     Returns a dict with format as a string, which is the format's canonical
-    shortname (as defined by ckan's resource_formats.json) and a key that says
-    if it is contained in a zip or something.
+    shortname (as defined by ckan's resource_formats.json), a key that says
+    if it is contained in a zip or something, and the name of the check that
+    detected it (for diagnostics).
 
     e.g. {'format': 'CSV',
           'container': 'zip',
+          'detector': 'get_zipped_format',
           }
     or None if it can\'t tell what it is.
 
     Note, log is a logger, either a Celery one or a standard Python logging
     one.
     '''
-    format_ = None
     log.info('Sniffing file format of: %s', filepath)
-    filepath_utf8 = filepath.encode('utf8') if isinstance(filepath, unicode) \
-        else filepath
-    mime_type = magic.from_file(filepath_utf8, mime=True)
+    with FilePrefix(filepath) as prefix:
+        format_, detector = _sniff_file_format(prefix, log)
+    if not format_:
+        log.warning('Could not detect format of file: %s', filepath)
+        return None
+    format_['detector'] = detector
+    return format_
+
+
+def sniff_buffer_format(buf, name, complete, log):
+    '''Like sniff_file_format, but for the start of a file that is already in
+    memory, e.g. fetched from its URL.
+
+    :param name: the file's name or URL (for the logs)
+    :param complete: whether buf is the whole of the file
+    '''
+    log.info('Sniffing file format of: %s (%s bytes)', name,
+             len(buf) if complete else 'first %i' % len(buf))
+    prefix = MemberPrefix(buf, name, complete, depth=0)
+    format_, detector = _sniff_file_format(prefix, log)
+    if not format_:
+        log.warning('Could not detect format of file: %s', name)
+        return None
+    format_['detector'] = detector
+    return format_
+
+
+def _sniff_file_format(prefix, log):
+    '''Returns a tuple of the format dict (or None) and the name of the
+    detector that decided it.
+
+    libmagic gives the MIME type, which suggests a format. Then the
+    detectors that apply to that MIME type and format are run, cheapest
+    first, and the first to recognise the file decides its format. If none
+    do, it is the format that the MIME type suggests.'''
+    mime_type = magic.from_buffer(prefix.read(MAGIC_PREFIX_SIZE), mime=True)
     log.info('Magic detects file as: %s', mime_type)
+    prefix.mime_type = mime_type
+    format_ = None
     if mime_type:
-        if mime_type == 'application/xml':
-            with open(filepath) as f:
-                buf = f.read(5000)
-            format_ = get_xml_variant_including_xml_declaration(buf, log)
-        elif mime_type == 'application/zip':
-            format_ = get_zipped_format(filepath, log)
-        elif mime_type in ('application/msword', 'application/vnd.ms-office'):
-            # In the past Magic gives the msword mime-type for Word and other
-            # MS Office files too, so use BSD File to be sure which it is.
-            format_ = run_bsd_file(filepath, log)
-            if not format_ and is_excel(filepath, log):
-                format_ = {'format': 'XLS'}
-        elif mime_type == 'application/octet-stream':
-            # Excel files sometimes come up as this
-            if is_excel(filepath, log):
-                format_ = {'format': 'XLS'}
-            else:
-                # e.g. Shapefile
-                format_ = run_bsd_file(filepath, log)
-            if not format_:
-                with open(filepath) as f:
-                    buf = f.read(500)
-                format_ = is_html(buf, log)
-        elif mime_type == 'text/html':
-            # Magic can mistake IATI for HTML
-            with open(filepath) as f:
-                buf = f.read(100)
-            if is_iati(buf, log):
-                format_ = {'format': 'IATI'}
-
-        if format_:
-            return format_
-
-        format_tuple = ckan_helpers.resource_formats().get(mime_type)
-        if format_tuple:
-            format_ = {'format': format_tuple[1]}
-
-        if not format_:
-            if mime_type.startswith('text/'):
-                # is it JSON?
-                with open(filepath, 'rU') as f:
-                    buf = f.read(10000)
-                if is_json(buf, log):
-                    format_ = {'format': 'JSON'}
-                # is it CSV?
-                elif is_csv(buf, log):
-                    format_ = {'format': 'CSV'}
-                elif is_psv(buf, log):
-                    format_ = {'format': 'PSV'}
-
-        if not format_:
-            log.warning('Mimetype not recognised by CKAN as a data format: %s',
-                        mime_type)
-
-        if format_:
+        format_info = lib.sniffer_format_index().get(mime_type)
+        if format_info:
+            format_ = {'format': format_info[0]}
             log.info('Mimetype translates to filetype: %s',
                      format_['format'])
+    suggested_format = format_['format'] if format_ else None
 
-            if format_['format'] == 'TXT':
-                # is it JSON?
-                with open(filepath, 'rU') as f:
-                    buf = f.read(10000)
-                if is_json(buf, log):
-                    format_ = {'format': 'JSON'}
-                # is it CSV?
-                elif is_csv(buf, log):
-                    format_ = {'format': 'CSV'}
-                elif is_psv(buf, log):
-                    format_ = {'format': 'PSV'}
-                # XML files without the "<?xml ... ?>" tag end up here
-                elif is_xml_but_without_declaration(buf, log):
-                    format_ = get_xml_variant_without_xml_declaration(buf, log)
-                elif is_ttl(buf, log):
-                    format_ = {'format': 'TTL'}
-
-            elif format_['format'] == 'HTML':
-                # maybe it has RDFa in it
-                with open(filepath) as f:
-                    buf = f.read(100000)
-                if has_rdfa(buf, log):
-                    format_ = {'format': 'RDFa'}
-
-    else:
-        # Excel files sometimes not picked up by magic, so try alternative
-        if is_excel(filepath, log):
-            format_ = {'format': 'XLS'}
-        # BSD file picks up some files that Magic misses
-        # e.g. some MS Word files
-        if not format_:
-            format_ = run_bsd_file(filepath, log)
+    for detector in get_detectors():
+        if not detector.applies_to(mime_type, suggested_format):
+            continue
+        detected_format = detector.detect(prefix, log)
+        if detected_format:
+            log.info('%s detected format: %s', detector.name,
+                     detected_format['format'])
+            return detected_format, detector.name
+
+    if not format_ and mime_type:
+        log.warning('Mimetype not recognised by CKAN as a data format: %s',
+                    mime_type)
+    return format_, 'magic' if format_ else None
+
+
+# Detectors are run in order of cost, and those of the same cost in the order
+# they are registered.
+COST_CHEAP = 0  # e.g. a regex over a small prefix
+COST_MEDIUM = 1  # e.g. parsing a prefix
+COST_EXPENSIVE = 2  # reading the whole file, or decompressing it
+
+ANY = None
+
+
+class Detector(object):
+    '''A check for a file format. It is run on files whose MIME type (as
+    libmagic sees it) and the format that suggests are ones it applies to.
+
+    :param name: identifies the detector, in the logs and sniff results
+    :param func: func(buf, log) returns a format dict, or True to mean the
+                 format given by the "format" param, or None/False if the
+                 file is not in a format it detects. buf is the first
+                 prefix_size bytes of the file, or if prefix_size is None,
+                 the FilePrefix, for access to the whole file.
+    :param mime_types: the MIME types it applies to. Wildcards are allowed
+                       (e.g. 'text/*') and None means libmagic could not
+                       tell. ANY means all of them.
+    :param formats: the formats it applies to - the format suggested by the
+                    MIME type, where None means it suggests no known format.
+                    ANY means all of them.
+    :param cost: COST_CHEAP, COST_MEDIUM or COST_EXPENSIVE
+    :param prefix_size: how many bytes of the file it needs, or None for all
+                        of it
+    :param text: whether the newlines in buf should be translated, as if the
+                 file was opened in 'rU' mode
+    :param markup: whether func is given the MarkupSignature of the prefix,
+                   instead of buf, for XML and HTML based formats
+    :param xml_root: whether func is given the XmlRootSniffer of the file,
+                     instead of buf, for XML based formats. It reads as much
+                     of the file as it takes to find the root element, so
+                     prefix_size does not apply.
+    :param format: the format that func returning True means
+    '''
+    def __init__(self, name, func, mime_types=ANY, formats=ANY,
+                 cost=COST_MEDIUM, prefix_size=10000, text=False,
+                 markup=False, xml_root=False, format=None):
+        self.name = name
+        self.func = func
+        self.mime_types = mime_types
+        self.formats = formats
+        self.cost = cost
+        self.prefix_size = prefix_size
+        self.text = text
+        self.markup = markup
+        self.xml_root = xml_root
+        self.format = format
+
+    def __repr__(self):
+        return '<Detector %s>' % self.name
+
+    def applies_to(self, mime_type, format_):
+        if self.formats is not ANY and format_ not in self.formats:
+            return False
+        if self.mime_types is ANY or mime_type in self.mime_types:
+            return True
+        return bool(mime_type) and any(
+            fnmatch.fnmatchcase(mime_type, pattern)
+            for pattern in self.mime_types if pattern)
+
+    def detect(self, prefix, log):
+        '''Runs the detector on a FilePrefix, returning the format dict or
+        None.'''
+        if self.xml_root:
+            buf = prefix.xml_root()
+        elif self.prefix_size is None:
+            buf = prefix
+        elif self.markup:
+            buf = prefix.markup(self.prefix_size)
+        elif self.text:
+            buf = prefix.text(self.prefix_size)
+        else:
+            buf = prefix.read(self.prefix_size)
+        format_ = self.func(buf, log)
+        if format_ is True:
+            format_ = {'format': self.format}
+        return format_ or None
+
+
+def get_detectors():
+    '''Returns the format detectors - the ones in DETECTORS and those from
+    plugins that implement IFormatDetectors - in the order they are run.'''
+    detectors = list(DETECTORS)
+    for plugin in p.PluginImplementations(IFormatDetectors):
+        detectors.extend(plugin.get_format_detectors())
+    # sorted() is stable, so the registration order is kept for equal costs
+    return sorted(detectors, key=lambda detector: detector.cost)
 
-    if not format_:
-        log.warning('Could not detect format of file: %s', filepath)
-    return format_
 
 def is_json(buf, log):
     '''Returns whether this text buffer (potentially truncated) is in
     JSON format.'''
-    string = '"[^"]*"'
-    string_re = re.compile(string)
-    number_re = re.compile('-?\d+(\.\d+)?([eE][+-]?\d+)?')
-    extra_values_re = re.compile('true|false|null')
-    object_start_re = re.compile('{%s:\s?' % string)
-    object_middle_re = re.compile('%s:\s?' % string)
-    object_end_re = re.compile('}')
-    comma_re = re.compile(',\s?')
-    array_start_re = re.compile('\[')
-    array_end_re = re.compile('\]')
-    any_value_regexs = [string_re, number_re, object_start_re, array_start_re, extra_values_re]
-
-    # simplified state machine - just looks at stack of object/array and
-    # ignores contents of them, beyond just being simple JSON bits
-    pos = 0
-    state_stack = [] # stack of 'object', 'array'
-    number_of_matches = 0
-    while pos < len(buf):
-        part_of_buf = buf[pos:]
-        if pos == 0:
-            potential_matches = (object_start_re, array_start_re, string_re, number_re, extra_values_re)
-        elif not state_stack:
-            # cannot have content beyond the first byte that is not nested
-            return False
-        elif state_stack[-1] == 'object':
-            # any value
-            potential_matches = [comma_re, object_middle_re, object_end_re] + any_value_regexs
-        elif state_stack[-1] == 'array':
-            # any value or end it
-            potential_matches = any_value_regexs + [comma_re, array_end_re]
-        for matcher in potential_matches:
-            if matcher.match(part_of_buf):
-                if matcher in any_value_regexs and state_stack and state_stack[-1] == 'comma':
-                    state_stack.pop()
-                if matcher == object_start_re:
-                    state_stack.append('object')
-                elif matcher == array_start_re:
-                    state_stack.append('array')
-                elif matcher in (object_end_re, array_end_re):
-                    try:
-                        state = state_stack.pop()
-                    except IndexError:
-                        # nothing to pop
-                        log.info('Not JSON - %i matches', number_of_matches)
-                        return False
+    return JsonSniffer(log).feed(buf, final=True)
+
+
+_json_string = '"[^"]*"'
+_json_tokens = dict(
+    string=re.compile(_json_string),
+    number=re.compile('-?\d+(\.\d+)?([eE][+-]?\d+)?'),
+    extra_values=re.compile('true|false|null'),
+    object_start=re.compile('{%s:\s?' % _json_string),
+    object_middle=re.compile('%s:\s?' % _json_string),
+    object_end=re.compile('}'),
+    comma=re.compile(',\s?'),
+    array_start=re.compile('\['),
+    array_end=re.compile('\]'),
+    )
+_json_any_value = ('string', 'number', 'object_start', 'array_start',
+                   'extra_values')
+# the tokens that may come next, in order of precedence, for each state
+_json_next_tokens = {
+    None: ('object_start', 'array_start', 'string', 'number', 'extra_values'),
+    'object': ('comma', 'object_middle', 'object_end') + _json_any_value,
+    'array': _json_any_value + ('comma', 'array_end'),
+    }
+_json_next_tokens = dict(
+    (state, [(token, _json_tokens[token]) for token in tokens])
+    for state, tokens in _json_next_tokens.items())
+# how close to the end of a chunk a token can end and still be certain that
+# it is complete
+_json_lookahead = 3
+# characters that any of the tokens can start with
+_json_token_first_chars = frozenset('"-0123456789tfn{}[],')
+
+
+class JsonSniffer(object):
+    '''Detects JSON incrementally - feed it the file in chunks and it returns
+    True/False as soon as it is confident, or None if it needs more data.
+
+    It is a simplified state machine - it just looks at the stack of
+    object/array and ignores contents of them, beyond just being simple JSON
+    bits. Tokens are matched in place, so the buffer is never copied (apart
+    from an incomplete token left at the end of a chunk).
+    '''
+    matches_required = 6
+
+    def __init__(self, log):
+        self.log = log
+        self.result = None
+        self.number_of_matches = 0
+        self._state_stack = []  # stack of 'object', 'array'
+        # chunks not yet tokenized, and how big they need to get before it is
+        # worth trying to tokenize them again. Doubling this each time means
+        # a long token spread over many chunks is not rescanned for each one.
+        self._pending = []
+        self._pending_size = 0
+        self._retry_size = 0
+
+    def feed(self, data, final=False):
+        '''Add the next chunk of the file. Say final=True when there is no
+        more of the file to come (or you are not going to give any more).'''
+        if self.result is not None:
+            return self.result
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if not final and self._pending_size < self._retry_size:
+            return None
+        if len(self._pending) == 1:
+            buf = self._pending[0]
+        else:
+            buf = ''.join(self._pending)
+        pos = 0
+        state_stack = self._state_stack
+        while pos < len(buf):
+            if not self.number_of_matches:
+                state = None
+            elif not state_stack:
+                # cannot have content beyond the first byte that is not nested
+                return self._conclude(False)
+            else:
+                state = state_stack[-1]
+            for token, matcher in _json_next_tokens[state]:
+                match = matcher.match(buf, pos)
+                if match:
+                    break
+            else:
+                if final or buf[pos] not in _json_token_first_chars:
+                    return self._conclude(False)
+                # a token is probably split between this chunk and the next
+                break
+            if not final and match.end() > len(buf) - _json_lookahead:
+                # the token may continue into the next chunk (e.g. "1" might
+                # become "1.5e-3")
                 break
+            if token == 'object_start':
+                state_stack.append('object')
+            elif token == 'array_start':
+                state_stack.append('array')
+            elif token in ('object_end', 'array_end'):
+                state_stack.pop()
+            pos = match.end()
+            self.number_of_matches += 1
+            if self.number_of_matches >= self.matches_required:
+                return self._conclude(True)
+        if final:
+            return self._conclude(True)
+        tail = buf[pos:]
+        self._pending = [tail]
+        self._pending_size = len(tail)
+        self._retry_size = len(tail) * 2
+        return None
+
+    def _conclude(self, is_json):
+        if is_json:
+            self.log.info('JSON detected: %i matches', self.number_of_matches)
         else:
-            # no match
-            log.info('Not JSON - %i matches', number_of_matches)
+            self.log.info('Not JSON - %i matches', self.number_of_matches)
+        self.result = is_json
+        self._pending = []
+        return is_json
+
+# The delimiters of tabular text formats, in order of preference, and the
+# format each one means. A semicolon is the usual CSV delimiter where the
+# comma is the decimal separator.
+TABULAR_DELIMITERS = ((',', 'CSV'), ('\t', 'TSV'), ('|', 'PSV'), (';', 'CSV'))
+# Apart from commas (the default), a delimiter must also give the same
+# number of cells in this proportion of rows, as csv.Sniffer requires, else
+# indented or punctuated text would pass.
+TABULAR_CONSISTENCY = 0.9
+
+# A quoted field. As with the csv module, a quote only starts one at the
+# start of a field (i.e. at the start of a line or after a delimiter) -
+# elsewhere it is just a character. Delimiters and newlines inside it don't
+# count.
+_quoted_field = re.compile(r'(?:^|(?<=[,\t|;]))"[^"]*(?:""[^"]*)*"',
+                           re.MULTILINE)
+_quoted_field_start = re.compile(r'(?:^|(?<=[,\t|;]))"', re.MULTILINE)
+
+
+def sniff_tabular_format(buf, log):
+    '''If this text buffer (potentially truncated) is tabular data - comma,
+    tab, pipe or semicolon separated - then return its format (CSV, TSV or
+    PSV), else None.
+
+    It counts the cells per row for all the delimiters at once, in one pass
+    over the buffer, and each is judged by the same heuristic as
+    _is_spreadsheet. If more than one passes, the best is the one with the
+    most rows with the usual number of cells, and then the most cells per
+    row.
+    '''
+    text = buf
+    if buf.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        text = buf.decode('utf-16', 'replace')
+    if '\0' in text:
+        log.info('Not tabular - binary')
+        return None
+    # quoted fields become a single character, so they are still a cell
+    sample = _quoted_field.sub('x', text)
+    match = _quoted_field_start.search(sample)
+    if match:
+        # the rest is an unclosed string (probably the buffer was truncated
+        # in the middle of one)
+        sample = sample[:match.start()]
+        if sample.count('\n') < 1:
+            # too little left to judge - fall back on messytables
+            log.info('Unclosed string near the start - trying messytables')
+            return {'format': 'CSV'} if is_csv(buf, log) else None
+    counters = [TabularCounter(delimiter, format_)
+                for delimiter, format_ in TABULAR_DELIMITERS]
+    for line in sample.split('\n'):
+        if line:
+            for counter in counters:
+                counter.add_row(line)
+    tabular = [counter for counter in counters if counter.is_tabular()]
+    if not tabular:
+        log.info('Not tabular - not enough valid cells per row (%s)',
+                 ', '.join('%r: %.1f' % (counter.delimiter,
+                                         counter.cells_per_row())
+                           for counter in counters))
+        return None
+    # max() returns the first of equals, so ties go by TABULAR_DELIMITERS
+    best = max(tabular, key=lambda counter: (counter.usual_rows(),
+                                             counter.cells_per_row()))
+    log.info('Is %s because %.1f cells per row with delimiter %r '
+             '(%i cells, %i rows)', best.format, best.cells_per_row(),
+             best.delimiter, best.num_cells, best.num_rows)
+    return {'format': best.format}
+
+
+class TabularCounter(object):
+    '''Counts the cells per row for one delimiter, and judges whether they
+    look like tabular data, with the same heuristic as _is_spreadsheet.'''
+    def __init__(self, delimiter, format_):
+        self.delimiter = delimiter
+        self.format = format_
+        self.num_cells = self.num_rows = 0
+        self.row_lengths = defaultdict(int)  # num_cells: num_rows
+        self.accepted = False
+
+    def add_row(self, line):
+        if self.delimiter == '\t':
+            # tabs at the start of a line are indentation
+            line = line.lstrip(' \t')
+        num_cells = line.count(self.delimiter) + 1
+        self.num_cells += num_cells
+        self.num_rows += 1
+        self.row_lengths[num_cells] += 1
+        if not self.accepted and \
+                (self.num_cells > 20 or self.num_rows > 10):
+            # over the long term, 2 columns is the minimum
+            self.accepted = self.cells_per_row() > 1.9
+
+    def cells_per_row(self):
+        if not self.num_rows:
+            return 0
+        return float(self.num_cells) / float(self.num_rows)
+
+    def usual_rows(self):
+        '''Returns the number of rows with the most common number of
+        cells.'''
+        return max(self.row_lengths.values()) if self.row_lengths else 0
+
+    def is_consistent(self):
+        usual_rows = self.usual_rows()
+        usual_num_cells = [num_cells for num_cells, num_rows
+                           in self.row_lengths.items()
+                           if num_rows == usual_rows]
+        return max(usual_num_cells) > 1 and \
+            usual_rows >= TABULAR_CONSISTENCY * self.num_rows
+
+    def is_tabular(self):
+        if not self.num_rows:
             return False
-        match_length = matcher.match(part_of_buf).end()
-        #print "MATCHED %r %r %s" % (matcher.match(part_of_buf).string[:match_length], matcher.pattern, state_stack)
-        pos += match_length
-        number_of_matches += 1
-        if number_of_matches > 5:
-            log.info('JSON detected: %i matches', number_of_matches)
+        if self.delimiter != ',' and not self.is_consistent():
+            return False
+        if self.accepted:
             return True
+        # if file is short then be more lenient
+        return (self.num_cells > 3 or self.num_rows > 1) and \
+            self.cells_per_row() > 1.5
 
-    log.info('JSON detected: %i matches', number_of_matches)
-    return True
 
 def is_csv(buf, log):
-    '''If the buffer is a CSV file then return True.'''
+    '''If the buffer is a CSV file then return True. (Uses messytables, which
+    is slower than sniff_tabular_format, but more forgiving.)'''
     buf_rows = StringIO.StringIO(buf)
     table_set = messytables.CSVTableSet(buf_rows)
     return _is_spreadsheet(table_set, 'CSV', log)
 
-def is_psv(buf, log):
-    '''If the buffer is a PSV file then return True.'''
-    buf_rows = StringIO.StringIO(buf)
-    table_set = messytables.CSVTableSet(buf_rows, delimiter='|')
-    return _is_spreadsheet(table_set, 'PSV', log)
-
 def _is_spreadsheet(table_set, format, log):
     def get_cells_per_row(num_cells, num_rows):
         if not num_rows:
@@ -246,106 +651,462 @@ def _is_spreadsheet(table_set, format, log):
              format, num_cells, num_rows, get_cells_per_row(num_cells, num_rows))
     return False
 
-def is_html(buf, log):
-    '''If this buffer is HTML, return that format type, else None.'''
-    xml_re = '.{0,3}\s*(<\?xml[^>]*>\s*)?(<!doctype[^>]*>\s*)?<html[^>]*>'
-    match = re.match(xml_re, buf, re.IGNORECASE)
-    if match:
+# The start of an XML or HTML file: optional byte order mark (or other
+# junk), XML declaration, comments and processing instructions, doctype and
+# then the root element's tag.
+_markup_head_re = re.compile(r'''
+    .{0,3}\s*
+    (?P<declaration><\?xml[^>]*>\s*)?
+    (?:<!--.*?-->\s*|<\?[^>]*>\s*)*
+    (?:<!doctype(?P<doctype>[^>]*)>\s*)?
+    (?:<!--.*?-->\s*|<\?[^>]*>\s*)*
+    <(?P<name>[^>\s]*)(?P<attributes>[^>]*)>
+    ''', re.IGNORECASE | re.DOTALL | re.VERBOSE)
+_xmlns_re = re.compile(r'''\sxmlns(?::([^\s=]+))?\s*=\s*["']([^"']*)["']''')
+_rdfa_attribute_re = re.compile(r'\s(about|property)="[^"]+"')
+
+# Root element names that mean a format, where they are not a format's
+# extension already (they are looked up in ckan's resource formats)
+XML_ROOT_NAME_TO_FORMAT = {
+    'rdf:rdf': 'rdf',
+    'wms_capabilities': 'wms',  # WMS 1.3
+    'wmt_ms_capabilities': 'wms',  # WMS 1.1.1
+    }
+# Namespaces of the root element that mean a format, whatever the root
+# element is called (with the root element's local name, where the namespace
+# has other uses too)
+RDF_NAMESPACE = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
+XML_NAMESPACE_TO_FORMAT = {
+    (RDF_NAMESPACE, 'rdf'): 'rdf',
+    'http://www.opengis.net/kml/2.2': 'kml',
+    'http://earth.google.com/kml/2.0': 'kml',
+    'http://earth.google.com/kml/2.1': 'kml',
+    'http://earth.google.com/kml/2.2': 'kml',
+    'http://www.w3.org/2005/Atom': 'atom feed',
+    'http://www.opengis.net/wms': 'wms',
+    'http://www.opengis.net/gml': 'gml',
+    'http://www.opengis.net/gml/3.2': 'gml',
+    }
+# Parts of the URIs of the schema or DTD that mean a format
+XML_SCHEMA_HINT_TO_FORMAT = (
+    ('iati', 'iati'),
+    ('/wms/', 'wms'),
+    ('/kml/', 'kml'),
+    ('/gml/', 'gml'),
+    )
+IATI_ROOT_NAMES = ('iati-activities', 'iati-organisations')
+
+
+class MarkupSignature(object):
+    '''What the start of a file says about which XML or HTML based format it
+    is. It is found with precompiled regexes, once per file, and all the
+    XML/HTML detectors use it, rather than each searching the file.
+
+    :ivar declaration: whether it has an XML declaration "<?xml ... ?>"
+    :ivar doctype: the contents of the <!DOCTYPE ...>, or None
+    :ivar root_tag_name: the name of the first tag (after the declaration,
+                         doctype, comments and processing instructions), as
+                         written, or None if there are no tags
+    :ivar root_tag_attributes: the rest of the first tag
+    :ivar namespaces: the namespaces declared in the first tag
+                      {prefix: uri} (the default namespace's prefix is None)
+    '''
+    def __init__(self, buf):
+        self.buf = buf
+        self.declaration = False
+        self.doctype = self.root_tag_name = None
+        self.root_tag_attributes = ''
+        self.namespaces = {}
+        self._rdfa = None
+        match = _markup_head_re.match(buf)
+        if match:
+            self.declaration = bool(match.group('declaration'))
+            self.doctype = match.group('doctype')
+            self.root_tag_name = match.group('name')
+            self.root_tag_attributes = match.group('attributes')
+            self.namespaces = dict(
+                (prefix or None, uri) for prefix, uri in
+                _xmlns_re.findall(self.root_tag_attributes))
+
+    def root_name(self):
+        '''Returns the root tag name, in lower case, or None.'''
+        if self.root_tag_name is not None:
+            return self.root_tag_name.lower()
+
+    def has_rdfa(self):
+        '''Returns whether any tags have the RDFa "about" attribute and any
+        the "property" attribute.'''
+        if self._rdfa is None:
+            self._rdfa = False
+            buf = self.buf
+            # quick check for the key words, before looking for them as tag
+            # attributes
+            if 'about=' not in buf or 'property=' not in buf:
+                return False
+            found = set()
+            # one pass for both attributes, keeping track of the last '<' and
+            # '>' before each match, so that the buffer is only walked once
+            last_open = last_close = -1
+            scanned = 0
+            final_close = buf.rfind('>')
+            for match in _rdfa_attribute_re.finditer(buf):
+                if match.group(1) in found:
+                    continue
+                # check it is inside a tag
+                start, end = match.span()
+                last_open = max(last_open, buf.rfind('<', scanned, start))
+                last_close = max(last_close, buf.rfind('>', scanned, start))
+                scanned = start
+                if last_open > last_close and final_close >= end:
+                    found.add(match.group(1))
+                    if len(found) == 2:
+                        self._rdfa = True
+                        break
+        return self._rdfa
+
+
+def is_html(markup, log):
+    '''If this MarkupSignature is HTML, return that format type, else
+    None.'''
+    if markup.root_name() == 'html':
         log.info('HTML tag detected')
         return {'format': 'HTML'}
     log.debug('Not HTML')
 
-def is_iati(buf, log):
-    '''If this buffer is IATI format, return that format type, else None.'''
-    xml_re = '.{0,3}\s*(<\?xml[^>]*>\s*)?(<!doctype[^>]*>\s*)?<iati-(activities|organisations)[^>]*>'
-    match = re.match(xml_re, buf, re.IGNORECASE)
-    if match:
+def is_iati(markup, log):
+    '''If this MarkupSignature is IATI format, return that format type, else
+    None.'''
+    if markup.root_name() in IATI_ROOT_NAMES:
         log.info('IATI tag detected')
         return {'format': 'IATI'}
     log.debug('Not IATI')
 
-def is_xml_but_without_declaration(buf, log):
-    '''Decides if this is a buffer of XML, but missing the usual <?xml ...?>
-    tag.'''
-    xml_re = '.{0,3}\s*(<\?xml[^>]*>\s*)?(<!doctype[^>]*>\s*)?<([^>\s]*)([^>]*)>'
-    match = re.match(xml_re, buf, re.IGNORECASE)
-    if match:
-        top_level_tag_name, top_level_tag_attributes = match.groups()[-2:]
-        if 'xmlns:' not in top_level_tag_attributes and \
-               (len(top_level_tag_name) > 20 or
-                len(top_level_tag_attributes) > 200):
-            log.debug('Not XML (without declaration) - unlikely length first tag: <%s %s>',
-                        top_level_tag_name, top_level_tag_attributes)
-            return False
-        log.info('XML detected - first tag name: <%s>', top_level_tag_name)
+def is_xml_but_without_declaration(xml_root, log):
+    '''Decides if this XmlRootSniffer found XML, but missing the usual
+    <?xml ...?> tag.'''
+    if xml_root.root_tag_name is None:
+        log.debug('Not XML (without declaration) - tag not detected')
+        return False
+    has_prefixed_namespace = [prefix for prefix in xml_root.namespaces
+                              if prefix]
+    if not has_prefixed_namespace and \
+           (len(xml_root.root_tag_name) > 20 or
+            len(xml_root.root_tag_attributes) > 200):
+        log.debug('Not XML (without declaration) - unlikely length first tag: <%s %s>',
+                    xml_root.root_tag_name, xml_root.root_tag_attributes)
+        return False
+    log.info('XML detected - first tag name: <%s>', xml_root.root_tag_name)
+    return True
+
+def get_xml_variant_including_xml_declaration(xml_root, log):
+    '''If this XmlRootSniffer found a format based on XML and it has the
+    <xml> declaration, return the format type.'''
+    if xml_root.declaration:
+        return get_xml_variant_without_xml_declaration(xml_root, log)
+    log.debug('XML declaration not found')
+
+def get_xml_variant_without_xml_declaration(xml_root, log):
+    '''If this XmlRootSniffer found a format based on XML, regardless of
+    any XML declaration, return the format type.'''
+    top_level_tag_name = xml_root.root_name()
+    if top_level_tag_name is None:
+        log.debug('XML tags not found')
+        return None
+    format_name = get_xml_root_format(xml_root)
+    if format_name:
+        log.info('XML variant detected: %s', format_name)
+        return {'format': format_name}
+    log.warning('Did not recognise XML format: %s', top_level_tag_name)
+    return {'format': 'XML'}
+
+def get_xml_root_format(xml_root):
+    '''Returns the name of the format that the root element's name,
+    namespace or schema says it is, or None.'''
+    top_level_tag_name = xml_root.root_name()
+    local_name = top_level_tag_name.split(':')[-1]
+    if top_level_tag_name in IATI_ROOT_NAMES:
+        return 'IATI'
+    names = [XML_ROOT_NAME_TO_FORMAT.get(top_level_tag_name,
+                                         top_level_tag_name)]
+    namespace = xml_root.root_namespace()
+    if namespace:
+        names.append(XML_NAMESPACE_TO_FORMAT.get(
+            (namespace, local_name),
+            XML_NAMESPACE_TO_FORMAT.get(namespace)))
+    names.append(local_name)
+    for schema_location in xml_root.schema_locations:
+        schema_location = schema_location.lower()
+        names.extend(format_name
+                     for hint, format_name in XML_SCHEMA_HINT_TO_FORMAT
+                     if hint in schema_location)
+    for name in names:
+        format_info = lib.sniffer_format_index().get(name) \
+            if name else None
+        if format_info:
+            return format_info[0]
+
+def has_rdfa(markup, log):
+    '''If the MarkupSignature's HTML contains RDFa then this returns True'''
+    if markup.has_rdfa():
+        log.info('RDFA tags found in HTML')
         return True
-    log.debug('Not XML (without declaration) - tag not detected')
+    log.debug('Not RDFA')
     return False
 
-def get_xml_variant_including_xml_declaration(buf, log):
-    '''If this buffer is in a format based on XML and has the <xml>
-    declaration, return the format type.'''
-    xml_re = '.{0,3}\s*<\?xml[^>]*>\s*(<!doctype[^>]*>\s*)?(<[^>]+>)'
-    match = re.match(xml_re, buf, re.IGNORECASE)
-    if match:
-        top_level_tag_name = match.groups()[-1].lower()
-        return get_xml_variant_without_xml_declaration(match.groups()[-1], log)
-    log.debug('XML declaration not found: %s', buf)
-
-def get_xml_variant_without_xml_declaration(buf, log):
-    '''If this buffer is in a format based on XML, without any XML declaration
-    or other boilerplate, return the format type.'''
-    xml_re = '.{0,3}\s*<([^>\s]*)'
-    match = re.match(xml_re, buf)
-    if match:
-        top_level_tag_name = match.groups()[-1].lower()
-        top_level_tag_name = top_level_tag_name.replace('rdf:rdf', 'rdf')
-        top_level_tag_name = top_level_tag_name.replace('wms_capabilities', 'wms')  # WMS 1.3
-        top_level_tag_name = top_level_tag_name.replace('wmt_ms_capabilities', 'wms')  # WMS 1.1.1
-        format_tuple = ckan_helpers.resource_formats().get(top_level_tag_name)
-        if format_tuple:
-            format_ = {'format': format_tuple[1]}
-            log.info('XML variant detected: %s', format_tuple[2])
-            return format_
-        log.warning('Did not recognise XML format: %s', top_level_tag_name)
-        return {'format': 'XML'}
-    log.debug('XML tags not found: %s', buf)
-
-def has_rdfa(buf, log):
-    '''If the buffer HTML contains RDFa then this returns True'''
-    # quick check for the key words
-    if 'about=' not in buf or 'property=' not in buf:
-        log.debug('Not RDFA')
-        return False
 
-    # more rigorous check for them as tag attributes
-    about_re = '<[^>]+\sabout="[^"]+"[^>]*>'
-    property_re = '<[^>]+\sproperty="[^"]+"[^>]*>'
-    # remove CR to catch tags spanning more than one line
-    #buf = re.sub('\r\n', ' ', buf)
-    if not re.search(about_re, buf):
-        log.debug('Not RDFA')
-        return False
-    if not re.search(property_re, buf):
-        log.debug('Not RDFA')
-        return False
-    log.info('RDFA tags found in HTML')
-    return True
+# How much of an XML document may come before its root element (comments,
+# processing instructions and the DTD), and how big any one part of that
+# which has to be held in memory whole (the root element's start tag, or a
+# quoted string in the DTD) may be
+MAX_XML_PROLOG_SIZE = 16 * 1024 * 1024
+MAX_XML_TOKEN_SIZE = 64 * 1024
+
+_xml_space_re = re.compile(r'\s*')
+_xml_doctype_head_re = re.compile(r'''
+    <!DOCTYPE\s+(?P<name>[^\s\[>]+)
+    (?P<ids>(?:\s+(?:"[^"]*"|'[^']*'|[^\s"'\[>]+))*)
+    \s*(?=[\[>])
+    ''', re.IGNORECASE | re.VERBOSE)
+# the parts of a DTD: text, quoted strings, comments and brackets
+_xml_doctype_token_re = re.compile(r'''
+    [^"'\[\]<>]+ | "[^"]*" | '[^']*' | <!--.*?--> | <(?!!-) | [\[\]>]
+    ''', re.DOTALL | re.VERBOSE)
+# the starts of the parts of the prolog that need telling apart
+_xml_prolog_starts = ('<?XML ', '<?XML?', '<!--', '<!DOCTYPE')
+_xml_quoted_re = re.compile(r'''"([^"]*)"|'([^']*)\'''')
+# an XML name, optionally with a namespace prefix (non-ASCII characters are
+# allowed, but not checked)
+_xml_name = r'[A-Za-z_\x80-\xff][-.\w\x80-\xff]*'
+_xml_tag_name_re = re.compile(r'<(%s(?::%s)?)' % (_xml_name, _xml_name))
+_xml_start_tag_re = re.compile(r'''
+    <(?P<name>%s(?::%s)?)
+    (?P<attributes>(?:\s(?:[^>"']|"[^"]*"|'[^']*')*)?/?)>
+    ''' % (_xml_name, _xml_name), re.VERBOSE)
+_xml_attribute_re = re.compile(r'''([^\s=/]+)\s*=\s*(?:"([^"]*)"|'([^']*)')''')
+
+
+class XmlRootSniffer(object):
+    '''Finds the root element of an XML document incrementally - feed it the
+    file in chunks and it returns True as soon as it has found the root
+    element's start tag, False if it is not XML (as far as it can tell), or
+    None if it needs more data.
+
+    Comments, processing instructions and the DTD before the root element
+    are skipped as they stream past, so only a small part of them is held in
+    memory, however long they are.
+
+    Once it has returned True, these say what the root element is:
+
+    :ivar declaration: whether it has an XML declaration "<?xml ... ?>"
+    :ivar doctype: the root element name that the <!DOCTYPE> gives, or None
+    :ivar root_tag_name: the name of the root element, as written
+    :ivar root_tag_attributes: the rest of its start tag
+    :ivar namespaces: the namespaces it declares {prefix: uri} (the default
+                      namespace's prefix is None)
+    :ivar schema_locations: URIs of schemas and DTDs that it and the
+                            <!DOCTYPE> refer to
+    '''
+    def __init__(self):
+        self.result = None
+        self.declaration = False
+        self.doctype = self.root_tag_name = None
+        self.root_tag_attributes = ''
+        self.namespaces = {}
+        self.schema_locations = []
+        self._state = 'start'
+        self._pending = ''
+        self._size = 0
+        self._doctype_depth = 0  # of brackets in the DTD
+        self._need_more = False
+
+    def feed(self, data, final=False):
+        '''Add the next chunk of the file. Say final=True when there is no
+        more of the file to come (or you are not going to give any more).'''
+        if self.result is not None:
+            return self.result
+        self._size += len(data)
+        buf = self._pending + data if self._pending else data
+        pos = 0
+        while self.result is None:
+            pos = getattr(self, '_scan_' + self._state)(buf, pos, final)
+            if self._need_more:
+                self._need_more = False
+                if final or self._size > MAX_XML_PROLOG_SIZE or \
+                        len(buf) - pos > MAX_XML_TOKEN_SIZE:
+                    self.result = False
+                    break
+                self._pending = buf[pos:]
+                return None
+        self._pending = ''
+        return self.result
+
+    def _more(self, pos):
+        '''Says that scanning needs more data, keeping the buffer from
+        pos.'''
+        self._need_more = True
+        return pos
+
+    def _scan_start(self, buf, pos, final):
+        if len(buf) < 3 and not final:
+            return self._more(pos)
+        if buf.startswith(codecs.BOM_UTF8):
+            pos = len(codecs.BOM_UTF8)
+        self._state = 'prolog'
+        return pos
+
+    def _scan_prolog(self, buf, pos, final):
+        pos = _xml_space_re.match(buf, pos).end()
+        rest = buf[pos:pos + 9].upper()
+        if not final and any(len(rest) < len(start) and start.startswith(rest)
+                             for start in _xml_prolog_starts):
+            # not enough to tell what comes next
+            return self._more(pos)
+        if buf[pos:pos + 1] != '<':
+            self.result = False
+        elif buf.startswith('<?', pos):
+            if buf[pos + 2:pos + 5] == 'xml' and \
+                    buf[pos + 5:pos + 6] in ' \t\r\n?':
+                self.declaration = True
+            self._state = 'processing_instruction'
+            return pos + 2
+        elif buf.startswith('<!--', pos):
+            self._state = 'comment'
+            return pos + 4
+        elif buf[pos:pos + 9].upper() == '<!DOCTYPE':
+            match = _xml_doctype_head_re.match(buf, pos)
+            if not match:
+                # it may continue in the next chunk
+                return self._more(pos)
+            self.doctype = match.group('name')
+            self.schema_locations.extend(
+                double or single for double, single in
+                _xml_quoted_re.findall(match.group('ids')))
+            self._state = 'doctype'
+            return match.end()
+        elif buf.startswith('<!', pos):
+            self.result = False
+        else:
+            self._state = 'start_tag'
+        return pos
+
+    def _scan_processing_instruction(self, buf, pos, final):
+        return self._skip_to(buf, pos, '?>')
+
+    def _scan_comment(self, buf, pos, final):
+        return self._skip_to(buf, pos, '-->')
+
+    def _skip_to(self, buf, pos, terminator):
+        end = buf.find(terminator, pos)
+        if end == -1:
+            # keep just enough that the terminator can be found if it is
+            # split between chunks
+            return self._more(max(pos, len(buf) - len(terminator) + 1))
+        self._state = 'prolog'
+        return end + len(terminator)
 
-def get_zipped_format(filepath, log):
+    def _scan_doctype(self, buf, pos, final):
+        while pos < len(buf):
+            if buf[pos] == '<' and len(buf) - pos < 4 and not final:
+                # it may be the start of a comment
+                return self._more(pos)
+            match = _xml_doctype_token_re.match(buf, pos)
+            if not match:
+                # an incomplete string or comment
+                return self._more(pos)
+            token = match.group()
+            pos = match.end()
+            if token == '[':
+                self._doctype_depth += 1
+            elif token == ']':
+                self._doctype_depth -= 1
+            elif token == '>' and self._doctype_depth <= 0:
+                self._state = 'prolog'
+                return pos
+        return self._more(pos)
+
+    def _scan_start_tag(self, buf, pos, final):
+        match = _xml_start_tag_re.match(buf, pos)
+        if not match:
+            match = _xml_tag_name_re.match(buf, pos)
+            if match and (buf[match.end():] in ('', ':') or
+                          buf[match.end()] in ' \t\r\n/>'):
+                # the tag may continue in the next chunk
+                return self._more(pos)
+            self.result = False
+            return pos
+        self.root_tag_name = match.group('name')
+        attributes = match.group('attributes')
+        self.root_tag_attributes = attributes.rstrip('/')
+        for name, double, single in _xml_attribute_re.findall(attributes):
+            value = double or single
+            if name == 'xmlns':
+                self.namespaces[None] = value
+            elif name.startswith('xmlns:'):
+                self.namespaces[name[6:]] = value
+            elif name.split(':')[-1] == 'schemaLocation':
+                # pairs of namespace and schema URI
+                self.schema_locations.extend(value.split()[1::2])
+            elif name.split(':')[-1] == 'noNamespaceSchemaLocation':
+                self.schema_locations.append(value.strip())
+        self.result = True
+        return match.end()
+
+    def root_name(self):
+        '''Returns the root tag name, in lower case, or None.'''
+        if self.root_tag_name is not None:
+            return self.root_tag_name.lower()
+
+    def root_namespace(self):
+        '''Returns the namespace URI of the root element, or None.'''
+        if self.root_tag_name is None:
+            return None
+        prefix = self.root_tag_name.split(':')[0] \
+            if ':' in self.root_tag_name else None
+        return self.namespaces.get(prefix)
+
+
+def get_zipped_format(filepath, log, fileobj=None, depth=0):
     '''For a given zip file, return the format of file inside.
     For multiple files, choose by the most open, and then by the most
-    popular extension.'''
-    # just check filename extension of each file inside
+    popular extension. The start of the largest file of that extension is
+    then decompressed and sniffed, to check the extension is not misleading
+    (and to identify it when no file has a known extension).
+
+    If the file is already open, pass it as fileobj to save opening it
+    again.'''
     try:
         # note: Cannot use "with" with a zipfile before python 2.7
         #       so we have to close it manually.
-        zip = zipfile.ZipFile(filepath, 'r')
+        if fileobj is not None:
+            zip = zipfile.ZipFile(fileobj, 'r')
+        else:
+            zip = zipfile.ZipFile(filepath, 'r')
         try:
-            filenames = zip.namelist()
+            infos = [info for info in zip.infolist()
+                     if not info.filename.endswith('/')]
+            format_ = get_format_from_extensions(
+                [info.filename for info in infos], filepath, log)
+            if format_:
+                extension = format_['extension']
+                infos = [info for info in infos
+                         if os.path.splitext(info.filename)[-1][1:].lower()
+                         == extension]
+            member_format = None
+            if infos and depth < MAX_CONTAINER_DEPTH:
+                # sniff the largest, as it is probably the data rather than
+                # a readme etc.
+                info = max(infos, key=lambda info: info.file_size)
+                member = zip.open(info)
+                try:
+                    member_format = sniff_member_format(
+                        member, info.filename, log, depth + 1)
+                finally:
+                    member.close()
         finally:
             zip.close()
-    except zipfile.BadZipfile, e:
+    except (zipfile.BadZipfile, zipfile.LargeZipFile, zlib.error,
+            RuntimeError), e:
+        # RuntimeError is for encrypted files
         log.info('Zip file open raised error %s: %s',
                     e, e.args)
         return
@@ -353,113 +1114,474 @@ def get_zipped_format(filepath, log):
         log.warning('Zip file open raised exception %s: %s',
                     e, e.args)
         return
+    return combine_container_format(format_, member_format, 'ZIP', log)
+
+
+def get_format_from_extensions(filenames, container_path, log):
+    '''Given the names of the files in a container, returns the format of
+    the most popular extension amongst the most open formats, or None if
+    none have a known extension. The dict includes the 'extension' too.'''
+    format_index = lib.format_index()
     top_score = 0
     top_scoring_extension_counts = defaultdict(int) # extension: number_of_files
     for filename in filenames:
         extension = os.path.splitext(filename)[-1][1:].lower()
-        format_tuple = ckan_helpers.resource_formats().get(extension)
-        if format_tuple:
-            score = lib.resource_format_scores().get(format_tuple[1])
+        format_info = format_index.get(extension)
+        if format_info:
+            score = format_info[1]
             if score is not None and score > top_score:
                 top_score = score
                 top_scoring_extension_counts = defaultdict(int)
             if score == top_score:
                 top_scoring_extension_counts[extension] += 1
         else:
-            log.info('Zipped file of unknown extension: "%s" (%s)', extension, filepath)
+            log.info('Zipped file of unknown extension: "%s" (%s)', extension,
+                     container_path)
     if not top_scoring_extension_counts:
-        log.info('Zip has no known extensions: %s', filepath)
-        return {'format': 'ZIP'}
+        log.info('Zip has no known extensions: %s', container_path)
+        return None
 
     top_scoring_extension_counts = sorted(top_scoring_extension_counts.items(),
                                           key=lambda x: x[1])
     top_extension = top_scoring_extension_counts[-1][0]
     log.info('Zip file\'s most popular extension is "%s" (All extensions: %r)',
              top_extension, top_scoring_extension_counts)
-    format_tuple = ckan_helpers.resource_formats()[top_extension]
-    format_ = {'format': format_tuple[1],
-               'container': 'ZIP'}
-    log.info('Zipped file format detected: %s', format_tuple[2])
+    format_ = format_index[top_extension][0]
+    log.info('Zipped file format from extension: %s', format_)
+    return {'format': format_, 'extension': top_extension}
+
+
+def combine_container_format(extension_format, member_format, container,
+                             log):
+    '''Decides the format of a container's contents, given the format
+    suggested by the file extensions and the format sniffed from the start
+    of the file.
+
+    The sniffed format is used if there is no known extension, the extension
+    is just another container (e.g. .gz), or it scores lower than the
+    extension's (e.g. a .csv that is actually an HTML error page). It is not
+    allowed to raise the score otherwise, as the publisher chose the
+    extension (e.g. a .txt that happens to be comma separated).
+    '''
+    format_ = extension_format or member_format
+    if extension_format and member_format and \
+            member_format['format'] != extension_format['format']:
+        scores = lib.resource_format_scores()
+        member_score = scores.get(member_format['format'])
+        if extension_format['format'] in CONTAINER_FORMATS or \
+                member_score is not None and \
+                member_score < scores.get(extension_format['format']):
+            log.info('Contents sniffed as %s, despite extension (%s)',
+                     member_format['format'], extension_format['format'])
+            format_ = member_format
+    if not format_:
+        return {'format': container}
+    if format_.get('container'):
+        # e.g. a csv.gz inside a zip
+        container = '%s.%s' % (format_['container'], container)
+    log.info('Format inside the %s: %s', container, format_['format'])
+    return {'format': format_['format'], 'container': container}
+
+
+def sniff_member_format(fileobj, name, log, depth):
+    '''Given a file object for a file inside a container, which decompresses
+    it as it is read, sniff the format from the start of it.'''
+    buf = fileobj.read(MEMBER_PREFIX_SIZE)
+    complete = len(buf) < MEMBER_PREFIX_SIZE or not fileobj.read(1)
+    log.info('Sniffing format of contained file: %s (%s bytes)', name,
+             len(buf) if complete else 'first %i' % len(buf))
+    prefix = MemberPrefix(buf, name, complete, depth)
+    format_, detector = _sniff_file_format(prefix, log)
     return format_
 
 
-def is_excel(filepath, log):
+# Compressed formats that hold a single file (which may be a tar)
+COMPRESSION_MIME_TYPES = {
+    'application/gzip': 'GZ',
+    'application/x-gzip': 'GZ',
+    'application/x-bzip2': 'BZ2',
+    'application/x-xz': 'XZ',
+    }
+CONTAINER_FORMATS = frozenset(COMPRESSION_MIME_TYPES.values() +
+                              ['ZIP', 'TAR'])
+
+
+def get_compressed_format(prefix, mime_type, log):
+    '''For a gzip, bz2, xz or tar file, return the format of the file inside
+    (for a tar, the one chosen as get_tar_member_format does), sniffed by
+    decompressing just the start of it.
+
+    Returns None if it cannot be decompressed, so that the format is just
+    that of the container (e.g. GZ).'''
+    if prefix.depth >= MAX_CONTAINER_DEPTH:
+        return None
+    container = COMPRESSION_MIME_TYPES.get(mime_type)
     try:
-        xlrd.open_workbook(filepath)
-    except Exception, e:
-        log.info('Not Excel - failed to load: %s %s', e, e.args)
+        if container:
+            decompressor = get_decompressor(container)
+            if decompressor is None:
+                log.info('Cannot decompress %s - no lzma module', container)
+                return None
+            fileobj = DecompressingFile(prefix.fileobj(), decompressor)
+        else:
+            fileobj = DecompressingFile(prefix.fileobj(), None)
+        if is_tar(fileobj.peek(512)):
+            formats = get_tar_member_format(prefix, container, log)
+            container = 'TAR.%s' % container if container else 'TAR'
+            if formats is None:
+                log.info('Tar file has no files in it')
+                return {'format': container}
+            format_, member_format = formats
+        elif container:
+            name = '(%s contents)' % prefix.filepath
+            format_ = None
+            member_format = sniff_member_format(fileobj, name, log,
+                                                prefix.depth + 1)
+        else:
+            log.info('Not a tar file')
+            return None
+    except (IOError, EOFError, zlib.error, tarfile.TarError), e:
+        log.info('Could not decompress %s: %s', container, e)
+        return None
+    if not (format_ or member_format):
+        # not worth saying it is a GZ in a GZ
+        return None
+    return combine_container_format(format_, member_format, container, log)
+
+
+def get_tar_member_format(prefix, compression, log):
+    '''For a tar file, chooses the file inside it to sniff in the same way as
+    get_zipped_format does for a zip - of the files with the most popular of
+    the most open extensions (or all the files, if none have a known
+    extension), the largest - and sniffs the start of it.
+
+    :param compression: the format that the tar is compressed in (e.g. 'GZ'),
+                        or None
+
+    Returns a tuple of the format suggested by the extensions and the
+    sniffed format of the chosen file (either may be None), or None if the
+    tar has no files in it.
+    '''
+    tar = _open_tar(prefix, compression, listing=True)
+    infos = []
+    try:
+        for info in tar:
+            if info.isfile() and info.size:
+                infos.append(info)
+    except tarfile.ReadError, e:
+        # the listing of a big compressed tar stops part way through (as
+        # does that of a truncated one), so choose from the files so far
+        if not infos:
+            raise
+        log.info('Only listed the first %i files in the tar: %s',
+                 len(infos), e)
+    finally:
+        tar.close()
+    if not infos:
+        return None
+    format_ = get_format_from_extensions([info.name for info in infos],
+                                         prefix.filepath, log)
+    if format_:
+        infos = [info for info in infos
+                 if os.path.splitext(info.name)[-1][1:].lower()
+                 == format_['extension']]
+    # the largest, as it is probably the data rather than a readme etc.
+    chosen_offset = max(infos, key=lambda info: info.size).offset
+    tar = _open_tar(prefix, compression, listing=False)
+    try:
+        for info in tar:
+            if info.offset == chosen_offset:
+                break
+        else:
+            return format_, None
+        member_format = sniff_member_format(tar.extractfile(info), info.name,
+                                            log, prefix.depth + 1)
+    finally:
+        tar.close()
+    return format_, member_format
+
+
+def _open_tar(prefix, compression, listing):
+    '''Returns a TarFile for the tar, reading from the start of it. A
+    compressed tar can only be streamed, and when just listing its files,
+    only TAR_LISTING_SIZE of it is decompressed. An uncompressed one is
+    opened so that listing its files seeks past their contents.'''
+    if compression:
+        fileobj = DecompressingFile(
+            prefix.fileobj(), get_decompressor(compression),
+            limit=TAR_LISTING_SIZE if listing else None)
+        return tarfile.open(fileobj=fileobj, mode='r|')
+    return tarfile.open(fileobj=prefix.fileobj(), mode='r:')
+
+
+def get_decompressor(container):
+    if container == 'GZ':
+        # the extra 16 tells zlib to expect the gzip header
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif container == 'BZ2':
+        return bz2.BZ2Decompressor()
+    elif container == 'XZ' and lzma:
+        return lzma.LZMADecompressor()
+
+
+def is_tar(buf):
+    '''Returns whether the buffer starts with a tar header (POSIX ustar or
+    GNU tar).'''
+    return len(buf) >= 512 and buf[257:262] == 'ustar'
+
+
+class DecompressingFile(object):
+    '''A read-only file object that decompresses another file object as it
+    is read, one chunk at a time, so that reading just the start of a huge
+    compressed file is cheap. It only supports reading forwards, which is
+    all that tarfile's streaming mode needs.
+
+    Memory use is bounded by the amount read, plus (for bz2 and xz, whose
+    decompressors cannot be told to stop early) what one chunk of compressed
+    data expands to.
+
+    :param decompressor: a zlib/bz2/lzma decompressor object, or None to
+                         pass the data through unchanged
+    :param limit: bytes of decompressed data after which it appears to end,
+                  or None
+    '''
+    chunk_size = 16 * 1024
+
+    def __init__(self, fileobj, decompressor, limit=None):
+        self.fileobj = fileobj
+        self.decompressor = decompressor
+        self.limit = limit
+        self._position = 0  # of the next byte to be read
+        self._buf = ''
+        self._input = ''  # compressed data not yet decompressed
+        self._eof = False
+
+    def _decompress(self, max_length):
+        if not self._input:
+            self._input = self.fileobj.read(self.chunk_size)
+            if not self._input:
+                self._eof = True
+                if hasattr(self.decompressor, 'flush'):
+                    return self.decompressor.flush()
+                return ''
+        data, self._input = self._input, ''
+        if self.decompressor is None:
+            return data
+        if hasattr(self.decompressor, 'unconsumed_tail'):
+            # zlib can stop when it has produced enough
+            data = self.decompressor.decompress(data, max_length)
+            self._input = self.decompressor.unconsumed_tail
+            return data
+        try:
+            return self.decompressor.decompress(data)
+        except EOFError:
+            # bz2/lzma raise this for data after the end of the stream
+            self._eof = True
+            return ''
+
+    def _fill(self, size):
+        chunks = [self._buf]
+        length = len(self._buf)
+        while length < size and not self._eof:
+            data = self._decompress(size - length)
+            chunks.append(data)
+            length += len(data)
+        self._buf = ''.join(chunks)
+
+    def peek(self, size):
+        self._fill(size)
+        return self._buf[:size]
+
+    def read(self, size=-1):
+        if size < 0:
+            raise IOError('Reading a whole compressed file is not supported')
+        if self.limit is not None:
+            size = min(size, self.limit - self._position)
+        self._fill(size)
+        data, self._buf = self._buf[:size], self._buf[size:]
+        self._position += len(data)
+        return data
+
+
+def get_binary_format(fileobj, log):
+    '''Detects the binary formats that have no simple signature that libmagic
+    always picks up: Microsoft Office 97-2003 documents (which share the OLE2
+    container), old Excel files (BIFF2-4) and ESRI Shapefiles.
+
+    fileobj is the file - only the headers, and for OLE2 the directory and
+    SummaryInformation stream, are read from it.
+
+    Returns a format dict or None.
+    '''
+    extension = None
+    fileobj.seek(0)
+    header = fileobj.read(32)
+    if ole2.is_ole2(header):
+        extension = ole2.get_office_extension(fileobj, log)
+    elif is_biff(header):
+        log.info('Excel BIFF2-4 file detected')
+        extension = 'xls'
+    elif is_shapefile(header):
+        log.info('ESRI Shapefile header detected')
+        return {'format': 'SHP'}
+    if extension:
+        format_ = lib.format_index()[extension][0]
+        log.info('Binary file format detected: %s', format_)
+        return {'format': format_}
+    log.info('Binary file format not detected')
+
+
+def is_biff(buf):
+    '''Returns whether the buffer starts with the BOF record of an Excel
+    worksheet that is not in an OLE2 container (BIFF2, BIFF3 or BIFF4).'''
+    if len(buf) < 4:
         return False
-    else:
-        log.info('Excel file opened successfully')
-        return True
+    record_type, record_length = struct.unpack('<HH', buf[:4])
+    return record_type in (0x0009, 0x0209, 0x0409) and \
+        record_length in (4, 6, 8)
 
 
-# same as the python 2.7 subprocess.check_output
-def check_output(*popenargs, **kwargs):
-    if 'stdout' in kwargs:
-        raise ValueError('stdout argument not allowed, it will be overridden.')
-    process = subprocess.Popen(stdout=subprocess.PIPE, *popenargs, **kwargs)
-    output, unused_err = process.communicate()
-    retcode = process.poll()
-    if retcode:
-        cmd = kwargs.get("args")
-        if cmd is None:
-            cmd = popenargs[0]
-        raise Exception('Non-zero exit status %s: %s' % (retcode, output))
-    return output
-
-def run_bsd_file(filepath, log):
-    '''Run the BSD command-line tool "file" to determine file type. Returns
-    a format dict or None if it fails.'''
-    result = check_output(['file', filepath])
-    match = re.search('Name of Creating Application: ([^,]*),', result)
-    if match:
-        app_name = match.groups()[0]
-        format_map = {'Microsoft Office PowerPoint': 'ppt',
-                      'Microsoft PowerPoint': 'ppt',
-                      'Microsoft Excel': 'xls',
-                      'Microsoft Office Word': 'doc',
-                      'Microsoft Word 10.0': 'doc',
-                      'Microsoft Macintosh Word': 'doc',
-                      }
-        if app_name in format_map:
-            extension = format_map[app_name]
-            format_tuple = ckan_helpers.resource_formats()[extension]
-            log.info('"file" detected file format: %s',
-                     format_tuple[2])
-            return {'format': format_tuple[1]}
-    match = re.search(': ESRI Shapefile', result)
-    if match:
-        format_ = {'format': 'SHP'}
-        log.info('"file" detected file format: %s',
-                 format_['format'])
-        return format_
-    log.info('"file" could not determine file format of "%s": %s',
-             filepath, result)
+def is_shapefile(buf):
+    '''Returns whether the buffer starts with an ESRI Shapefile header.'''
+    if len(buf) < 32:
+        return False
+    file_code, = struct.unpack('>I', buf[:4])
+    version, = struct.unpack('<I', buf[28:32])
+    return file_code == 9994 and version == 1000
+
+
+_ttl_directive_re = re.compile('^@(prefix|base) ', re.MULTILINE)
+
+# An RDF term, as is_ttl accepts them: <url>, _:blank_node, a literal in
+# single, double or triple quotes with an optional @language or ^^datatype,
+# a number or a boolean. Every repetition is unambiguous, so matching is
+# linear in the length of the term, however the text is arranged.
+_ttl_term_re = re.compile(r'''
+    <[^\s>]+>
+  | _:[^\s;,.]+(?:\.[^\s;,.]+)*
+  | (?:"""[^"\\]*(?:(?:\\.|"(?!""))[^"\\]*)*"""
+     |\'\'\'[^'\\]*(?:(?:\\.|'(?!''))[^'\\]*)*\'\'\'
+     |"[^"\\\n]+(?:\\.[^"\\\n]*)*"
+     |'[^'\\\n]+(?:\\.[^'\\\n]*)*'
+    )
+    (?:@[a-zA-Z]+(?:-[a-zA-Z0-9]+)*
+     |\^\^(?:<[^\s>]+>|[^\s;,.]+(?:\.[^\s;,.]+)*)
+    )?
+  | [+-]?(?:[0-9]+(?:\.[0-9]+)?|\.[0-9]+)(?:[eE][+-]?[0-9]+)?
+  | true | false
+    ''', re.VERBOSE)
+_ttl_space_re = re.compile(r'(?:\s|#[^\n]*)+')
+_ttl_statement_end_re = re.compile(r'\.[ \t\r]*(?:\n|$)')
+_ttl_resync_re = re.compile(r'[;\n]')
+
+# what is expected next, when scanning for triples
+_TTL_SUBJECT, _TTL_PREDICATE, _TTL_OBJECT, _TTL_END = range(4)
 
 
 def is_ttl(buf, log):
     '''If the buffer is a Turtle RDF file then return True.'''
     # Turtle spec: "Turtle documents may have the strings '@prefix' or '@base' (case dependent) near the beginning of the document."
-    at_re = '^@(prefix|base) '
-    match = re.search(at_re, buf, re.MULTILINE)
+    match = _ttl_directive_re.search(buf)
     if match:
         log.info('Turtle RDF detected - @prefix or @base')
         return True
 
     # Alternatively look for several triples
     num_required_triples = 5
-    ignore, num_replacements = turtle_regex().subn('', buf, num_required_triples)
-    if num_replacements >= num_required_triples:
-        log.info('Turtle RDF detected - %s triples' % num_replacements)
+    num_triples = count_turtle_triples(buf, num_required_triples)
+    if num_triples >= num_required_triples:
+        log.info('Turtle RDF detected - %s triples' % num_triples)
         return True
 
-    log.debug('Not Turtle RDF - triples not detected (%i)' % num_replacements)
+    log.debug('Not Turtle RDF - triples not detected (%i)' % num_triples)
+
+def count_turtle_triples(buf, max_triples):
+    '''Counts the Turtle (or N-Triples) triples in the buffer, stopping at
+    max_triples.
+
+    It accepts the same triples as turtle_regex() does: a subject at the
+    start of a line (or a ';' to continue the previous subject), predicate
+    and object, separated by whitespace, and ended by ';' or a '.' at the end
+    of a line. Each predicate-object pair is counted.
+
+    Unlike running turtle_regex(), which can backtrack catastrophically, it
+    runs in time linear in the length of the buffer. It tokenizes from left
+    to right, and when something does not fit it skips to the next ';' or
+    line, never going back.
+    '''
+    num_triples = 0
+    pos = 0
+    length = len(buf)
+    state = _TTL_SUBJECT
+    while pos < length and num_triples < max_triples:
+        if state == _TTL_SUBJECT:
+            if buf[pos] == ';':
+                state = _TTL_PREDICATE
+                pos = _skip_ttl_space(buf, pos + 1)
+                continue
+            if pos == 0 or buf[pos - 1] == '\n':
+                end = _match_ttl_term(buf, pos, space_required=True)
+                if end:
+                    state = _TTL_PREDICATE
+                    pos = end
+                    continue
+        elif state == _TTL_PREDICATE:
+            end = _match_ttl_term(buf, pos, space_required=True)
+            if end:
+                state = _TTL_OBJECT
+                pos = end
+                continue
+        elif state == _TTL_OBJECT:
+            end = _match_ttl_term(buf, pos, space_required=False)
+            if end:
+                state = _TTL_END
+                pos = end
+                continue
+        elif state == _TTL_END:
+            if buf[pos] == ';':
+                num_triples += 1
+                state = _TTL_PREDICATE
+                pos = _skip_ttl_space(buf, pos + 1)
+                continue
+            match = _ttl_statement_end_re.match(buf, pos)
+            if match:
+                num_triples += 1
+                state = _TTL_SUBJECT
+                pos = _skip_ttl_space(buf, match.end())
+                continue
+        # it does not fit, so start again at the next ';' or line
+        match = _ttl_resync_re.search(buf, pos + 1)
+        if not match:
+            break
+        state = _TTL_SUBJECT
+        pos = match.start() if match.group() == ';' else match.end()
+    return num_triples
+
+def _match_ttl_term(buf, pos, space_required):
+    '''Matches an RDF term at pos, and the whitespace after it. Returns the
+    position after them, or None.'''
+    match = _ttl_term_re.match(buf, pos)
+    if not match:
+        return None
+    end = _skip_ttl_space(buf, match.end())
+    if end == len(buf) or (space_required and end == match.end()):
+        return None
+    if end == match.end() and buf[end] not in ';.':
+        # e.g. "falsehood"
+        return None
+    return end
+
+def _skip_ttl_space(buf, pos):
+    match = _ttl_space_re.match(buf, pos)
+    return match.end() if match else pos
 
 turtle_regex_ = None
 def turtle_regex():
     '''Return a compiled regex that matches a turtle triple.
 
+    NB is_ttl uses count_turtle_triples instead, since this regex can take
+    exponential time on some text.
+
     Each RDF term may be in these forms:
          <url>
          "a literal"
@@ -486,3 +1608,71 @@ def turtle_regex():
         triple = '(^T|;)\s*T T\s*(;|\.\s*$)'.replace('T', rdf_term).replace(' ', '\s+')
         turtle_regex_ = re.compile(triple, re.MULTILINE)
     return turtle_regex_
+
+
+def detect_xml_without_declaration(xml_root, log):
+    if is_xml_but_without_declaration(xml_root, log):
+        return get_xml_variant_without_xml_declaration(xml_root, log)
+
+
+def detect_zipped_format(prefix, log):
+    return get_zipped_format(prefix.filepath, log, fileobj=prefix.fileobj(),
+                             depth=prefix.depth)
+
+
+def detect_compressed_format(prefix, log):
+    return get_compressed_format(prefix, prefix.mime_type, log)
+
+
+def detect_binary_format(prefix, log):
+    return get_binary_format(prefix.fileobj(), log)
+
+
+TEXT_MIME_TYPES = ('text/*',)
+OLE2_MIME_TYPES = ('application/msword', 'application/vnd.ms-office',
+                   # what Magic says when the file is bigger than the
+                   # prefix it is given
+                   'application/x-ole-storage')
+
+# The built-in detectors. For the same cost, the first to match wins, so the
+# order matters (e.g. JSON can look like CSV).
+DETECTORS = [
+    # Magic can mistake IATI for HTML
+    Detector('is_iati', is_iati, mime_types=('text/html',),
+             cost=COST_CHEAP, prefix_size=MARKUP_PREFIX_SIZE, markup=True),
+    # Some HTML comes up as octet-stream
+    Detector('is_html', is_html, mime_types=('application/octet-stream',),
+             cost=COST_CHEAP, prefix_size=MARKUP_PREFIX_SIZE, markup=True),
+    # (newer versions of Magic say text/xml)
+    Detector('get_xml_variant_including_xml_declaration',
+             get_xml_variant_including_xml_declaration,
+             mime_types=('application/xml', 'text/xml'), cost=COST_CHEAP,
+             xml_root=True),
+    # Text files that are not a known format, or are just TXT, are often
+    # data formats that Magic does not know
+    Detector('is_json', is_json, mime_types=TEXT_MIME_TYPES,
+             formats=('TXT', None), text=True, format='JSON'),
+    # Magic says CSV for anything tabular, but it may be TSV or PSV
+    Detector('sniff_tabular_format', sniff_tabular_format,
+             mime_types=TEXT_MIME_TYPES, formats=('TXT', 'CSV', None),
+             text=True),
+    # XML files without the "<?xml ... ?>" tag
+    Detector('get_xml_variant_without_xml_declaration',
+             detect_xml_without_declaration, formats=('TXT',),
+             xml_root=True),
+    Detector('is_ttl', is_ttl, formats=('TXT',), text=True, format='TTL'),
+    Detector('has_rdfa', has_rdfa, formats=('HTML',),
+             prefix_size=MARKUP_PREFIX_SIZE, markup=True, format='RDFa'),
+    Detector('get_zipped_format', detect_zipped_format,
+             mime_types=('application/zip',), cost=COST_EXPENSIVE,
+             prefix_size=None),
+    Detector('get_compressed_format', detect_compressed_format,
+             mime_types=tuple(COMPRESSION_MIME_TYPES) + ('application/x-tar',),
+             cost=COST_EXPENSIVE, prefix_size=None),
+    # Magic does not always recognise MS Office files, and in the past gave
+    # msword for all of them, so look inside to be sure which it is.
+    # Shapefiles come up as octet-stream.
+    Detector('get_binary_format', detect_binary_format,
+             mime_types=OLE2_MIME_TYPES + ('application/octet-stream', None),
+             cost=COST_EXPENSIVE, prefix_size=None),
+    ]
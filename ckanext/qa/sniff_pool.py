@@ -0,0 +1,306 @@
+'''
+Runs the sniffing of files in separate, pre-forked helper processes, so that
+a file which takes a long time or a lot of memory to sniff cannot hold up or
+kill the Celery worker that is scoring it.
+
+Each helper has a limit on its address space (rlimit) and each file has a
+wall-clock deadline. A helper that goes over either is killed and replaced,
+and the caller gets a SniffTimeout or SniffMemoryError.
+
+The helpers are forked by a fork server - a process forked when the pool is
+created. By the time a helper needs replacing, the worker may have other
+threads (e.g. the timer of the reindex buffer), and a process forked from a
+multi-threaded one can deadlock on a lock that another thread held at the
+time (e.g. logging's). The fork server has only the one thread.
+'''
+import os
+import errno
+import signal
+import socket
+import select
+import resource
+import time
+import struct
+import logging
+import cPickle
+from multiprocessing import reduction
+
+
+class SniffError(Exception):
+    pass
+
+
+class SniffLimitExceeded(SniffError):
+    pass
+
+
+class SniffTimeout(SniffLimitExceeded):
+    pass
+
+
+class SniffMemoryError(SniffLimitExceeded):
+    pass
+
+
+class SniffForkServer(object):
+    '''A forked process that forks the helpers, when asked to.'''
+    def __init__(self, func, memory_limit=None):
+        parent_sock, child_sock = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            # child - never returns
+            parent_sock.close()
+            _fork_server_main(child_sock, func, memory_limit)
+        child_sock.close()
+        self.pid = pid
+        self.sock = parent_sock
+
+    def start_worker(self):
+        '''Returns a new helper (SniffWorker).
+
+        Raises SniffError if it could not be started.
+        '''
+        try:
+            _send(self.sock, 'fork')
+            pid = _receive(self.sock)
+            if pid is None:
+                raise SniffError('Could not start a sniffing process')
+            fd = reduction.recv_handle(self.sock)
+        except (EOFError, IOError, socket.error):
+            raise SniffError('The sniffing fork server died')
+        sock = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+        os.close(fd)
+        return SniffWorker(pid, sock)
+
+    def stop(self):
+        # closing the socket tells the fork server to exit
+        self.sock.close()
+        try:
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+
+
+def _fork_server_main(sock, func, memory_limit):
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # the helpers are reaped automatically
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        while True:
+            try:
+                _receive(sock)
+            except EOFError:
+                break
+            worker_sock, child_sock = socket.socketpair()
+            try:
+                pid = os.fork()
+            except OSError:
+                worker_sock.close()
+                child_sock.close()
+                _send(sock, None)
+                continue
+            if pid == 0:
+                # child - never returns. Only the worker is to hold the
+                # other end of its socket, so that the helper sees it close.
+                sock.close()
+                worker_sock.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                _worker_main(child_sock, func, memory_limit)
+            child_sock.close()
+            _send(sock, pid)
+            reduction.send_handle(sock, worker_sock.fileno(), pid)
+            worker_sock.close()
+    finally:
+        os._exit(0)
+
+
+class SniffWorker(object):
+    '''A helper process that calls func(filepath, log) for each filepath sent
+    to it (or another function, if one is sent with its arguments), and sends
+    back the result. It is started by SniffForkServer.start_worker.
+    '''
+    def __init__(self, pid, sock):
+        self.pid = pid
+        self.sock = sock
+
+    def send(self, func, args):
+        '''Sends a call for the helper to make. func is None for the
+        helper's own func, else a module-level function (so that it can be
+        pickled).'''
+        _send(self.sock, (func, args))
+
+    def receive(self, timeout):
+        '''Returns the (status, value) sent back by the helper, or None if
+        it did not arrive within timeout seconds.'''
+        readable = select.select([self.sock], [], [], timeout)[0]
+        if not readable:
+            return None
+        try:
+            return _receive(self.sock)
+        except EOFError:
+            return ('died', None)
+
+    def stop(self, kill=False):
+        if kill:
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        # closing the socket tells an idle helper to exit. The fork server
+        # reaps it.
+        self.sock.close()
+
+
+def _send(sock, obj):
+    data = cPickle.dumps(obj, 2)
+    sock.sendall(struct.pack('!I', len(data)) + data)
+
+
+def _receive(sock):
+    '''Returns the next object sent on the socket. Raises EOFError if the
+    other end has closed it.'''
+    length, = struct.unpack('!I', _receive_bytes(sock, 4))
+    return cPickle.loads(_receive_bytes(sock, length))
+
+
+def _receive_bytes(sock, length):
+    chunks = []
+    while length:
+        chunk = sock.recv(min(length, 65536))
+        if not chunk:
+            raise EOFError()
+        chunks.append(chunk)
+        length -= len(chunk)
+    return ''.join(chunks)
+
+
+def _address_space_size():
+    '''Returns the bytes of address space this process uses (VmSize), or 0
+    if it is not known.'''
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[0])
+    except (IOError, ValueError, IndexError):
+        return 0
+    return pages * resource.getpagesize()
+
+
+def _worker_main(sock, func, memory_limit):
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if memory_limit:
+            # the helper starts with the address space of the worker it was
+            # forked from, so the limit is a budget on top of that
+            limit = _address_space_size() + memory_limit
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        sniff_log = logging.getLogger('ckanext.qa.sniffer')
+        while True:
+            try:
+                func_, args = _receive(sock)
+            except EOFError:
+                break
+            try:
+                result = ('ok', (func_ or func)(*(args + (sniff_log,))))
+            except MemoryError:
+                result = ('memory', None)
+            except EnvironmentError, e:
+                # e.g. mmap or a C library failing to allocate under the
+                # address space limit, which is not a MemoryError
+                if e.errno == errno.ENOMEM:
+                    result = ('memory', None)
+                else:
+                    result = ('error', '%s: %s' % (e.__class__.__name__, e))
+            except Exception, e:
+                result = ('error', '%s: %s' % (e.__class__.__name__, e))
+            _send(sock, result)
+    finally:
+        os._exit(0)
+
+
+class SniffPool(object):
+    '''A pool of helper processes that sniff files.
+
+    :param func: function to call in the helper, with (filepath, log),
+                 usually sniff_file_format
+    :param size: number of helper processes to keep ready
+    :param timeout: seconds that sniffing a file may take
+    :param memory_limit: bytes of address space each helper may use for
+                         sniffing a file, on top of what it starts with, or
+                         None
+
+    Create the pool before the process starts any threads, since that is
+    when its fork server is forked.
+    '''
+    def __init__(self, func, size=1, timeout=60, memory_limit=None):
+        self.func = func
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.fork_server = SniffForkServer(func, memory_limit)
+        self.idle = []
+        for i in range(size):
+            self.idle.append(self._start_worker())
+
+    def _start_worker(self):
+        return self.fork_server.start_worker()
+
+    def sniff(self, filepath, log):
+        '''Returns the format of the file, as func does.
+
+        Raises SniffTimeout or SniffMemoryError if it goes over the limits,
+        or SniffError if func raised an exception.
+        '''
+        return self.run(None, (filepath,), log, filepath)
+
+    def run(self, func, args, log, name):
+        '''Calls func(*args, log) in a helper, within the limits, and returns
+        what it returns. It is for sniffing something other than a file,
+        e.g. the start of a file that is in memory.
+
+        :param func: a module-level function (so that it can be pickled), or
+                     None for the pool's func
+        :param name: what is being sniffed, for the logs
+
+        Raises the same exceptions as sniff.
+        '''
+        worker = self.idle.pop() if self.idle else self._start_worker()
+        start = time.time()
+        try:
+            worker.send(func, args)
+            result = worker.receive(self.timeout)
+        except (IOError, socket.error):
+            result = ('died', None)
+        if result is None:
+            worker.stop(kill=True)
+            self.idle.append(self._start_worker())
+            log.warning('Sniffing timed out after %ss: %s',
+                        self.timeout, name)
+            raise SniffTimeout('Sniffing the file took longer than the time '
+                               'limit of %s seconds.' % self.timeout)
+        status, value = result
+        if status in ('memory', 'died'):
+            # the helper may be in a bad state after a MemoryError
+            worker.stop(kill=True)
+            self.idle.append(self._start_worker())
+        else:
+            self.idle.append(worker)
+        log.info('Sniffed in %.1fs: %s', time.time() - start, name)
+        if status == 'ok':
+            return value
+        elif status == 'memory':
+            log.warning('Sniffing ran out of memory: %s', name)
+            if not self.memory_limit:
+                raise SniffMemoryError('Sniffing the file ran out of memory.')
+            raise SniffMemoryError('Sniffing the file needed more than the '
+                                   'memory limit of %sMB.' %
+                                   (self.memory_limit / 1024 / 1024))
+        elif status == 'died':
+            raise SniffError('The sniffing process died')
+        raise SniffError(value)
+
+    def close(self):
+        for worker in self.idle:
+            worker.stop()
+        self.idle = []
+        self.fork_server.stop()
@@ -0,0 +1,206 @@
+'''
+Sniffs the format of a file from just the start of it, fetched from its URL
+with an HTTP Range request. This is for files that the archiver chose not to
+download (e.g. because they are too big), which would otherwise only be
+scored by their URL extension and format field.
+'''
+import os
+import re
+import time
+import errno
+import fcntl
+import tempfile
+import urlparse
+from contextlib import contextmanager
+
+import requests
+
+from ckanext.qa.sniff_format import sniff_buffer_format
+
+USER_AGENT = 'ckanext-qa'
+CHUNK_SIZE = 16 * 1024
+
+
+class SniffUrlError(Exception):
+    pass
+
+
+class HostLimiter(object):
+    '''Limits the number of requests made to each host at once, by all the
+    processes (and threads) on this machine that share the lock_dir - i.e.
+    all the Celery workers, not just this one.
+
+    Each host has max_per_host lock files, and a request holds an exclusive
+    lock on one of them while it is in progress. The operating system
+    releases the lock if the process dies.
+    '''
+    def __init__(self, max_per_host, lock_dir=None):
+        self.max_per_host = max_per_host
+        self.lock_dir = lock_dir or \
+            os.path.join(tempfile.gettempdir(), 'ckanext-qa-hosts')
+
+    @contextmanager
+    def limit(self, host, timeout):
+        '''Waits until there are fewer than max_per_host requests to the host
+        in progress, for up to timeout seconds, else raises SniffUrlError.'''
+        # flock cannot wait with a timeout, so poll
+        deadline = time.time() + timeout
+        lock_file = self._lock_slot(host)
+        while lock_file is None:
+            if time.time() > deadline:
+                raise SniffUrlError('Too many requests to %s at once' % host)
+            time.sleep(0.05)
+            lock_file = self._lock_slot(host)
+        try:
+            yield
+        finally:
+            # closing it releases the lock
+            lock_file.close()
+
+    def _lock_slot(self, host):
+        '''Returns the open lock file of one of the host's slots, having
+        locked it, or None if they are all in use.'''
+        try:
+            os.makedirs(self.lock_dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        filename_base = re.sub(r'[^\w.-]', '_', host)
+        for slot in xrange(self.max_per_host):
+            lock_file = open(os.path.join(
+                self.lock_dir, '%s.%i.lock' % (filename_base, slot)), 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                lock_file.close()
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                continue
+            return lock_file
+        return None
+
+
+class ResultCache(object):
+    '''Remembers the results for each URL for a short time, so that a URL
+    that is in several resources is only fetched once.'''
+    def __init__(self, seconds, max_size=1000):
+        self.seconds = seconds
+        self.max_size = max_size
+        self._results = {}  # url: (expiry time, result)
+
+    def get(self, url):
+        '''Returns (found, result).'''
+        expiry, result = self._results.get(url, (None, None))
+        if expiry is None or expiry < time.time():
+            return False, None
+        return True, result
+
+    def set(self, url, result):
+        now = time.time()
+        if len(self._results) >= self.max_size:
+            self._results = dict(
+                (url_, value) for url_, value in self._results.iteritems()
+                if value[0] >= now)
+            if len(self._results) >= self.max_size:
+                self._results.clear()
+        self._results[url] = (now + self.seconds, result)
+
+
+class UrlSniffer(object):
+    '''Sniffs files by fetching the start of them, over a pool of keep-alive
+    connections.
+
+    :param prefix_size: bytes to fetch from the start of each file
+    :param timeout: seconds to wait for a server (and for a turn to use it)
+    :param max_per_host: most requests to make to one host at once, by all
+                         the processes that share the lock_dir
+    :param cache_seconds: how long to remember each URL's format
+    :param sniff_buffer: func(buf, url, complete, log) that sniffs the start
+                         of the file, as sniff_buffer_format does (e.g. in a
+                         SniffPool)
+    :param lock_dir: directory for the HostLimiter's lock files
+    '''
+    def __init__(self, prefix_size=128 * 1024, timeout=10, max_per_host=2,
+                 cache_seconds=300, sniff_buffer=sniff_buffer_format,
+                 lock_dir=None):
+        self.prefix_size = prefix_size
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = USER_AGENT
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_per_host)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.limiter = HostLimiter(max_per_host, lock_dir)
+        self.cache = ResultCache(cache_seconds)
+        self.sniff_buffer = sniff_buffer
+
+    def sniff(self, url, log):
+        '''Returns the format of the file at the URL, in the form that
+        sniff_file_format does, or None if it is not recognised.
+
+        Raises SniffUrlError if it cannot be fetched, or the errors that
+        sniff_buffer raises (e.g. SniffError).
+        '''
+        found, format_ = self.cache.get(url)
+        if found:
+            log.info('Sniffed format of URL found in cache: %s %r',
+                     url, format_)
+        else:
+            buf, complete = self.fetch_prefix(url)
+            format_ = self.sniff_buffer(buf, url, complete, log)
+            self.cache.set(url, format_)
+        return dict(format_) if format_ else None
+
+    def fetch_prefix(self, url):
+        '''Returns (buf, complete) - the first prefix_size bytes of the file
+        and whether that is the whole of it.'''
+        host = urlparse.urlparse(url).netloc
+        with self.limiter.limit(host, self.timeout):
+            try:
+                response = self.session.get(
+                    url, stream=True, timeout=self.timeout,
+                    headers={'Range': 'bytes=0-%i' % (self.prefix_size - 1)})
+            except requests.RequestException, e:
+                raise SniffUrlError('%s: %s' % (e.__class__.__name__, e))
+            try:
+                if response.status_code not in (200, 206):
+                    response.close()
+                    raise SniffUrlError('Server returned HTTP status %s' %
+                                        response.status_code)
+                # a server that ignores the Range header sends the whole file
+                # (status 200), so stop reading once there is enough. A 206
+                # response is read to the end, so that the connection can be
+                # reused.
+                max_length = self.prefix_size \
+                    if response.status_code == 200 else self.prefix_size + 1
+                chunks = []
+                length = 0
+                exhausted = True
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    chunks.append(chunk)
+                    length += len(chunk)
+                    if length >= max_length:
+                        exhausted = False
+                        break
+            except requests.RequestException, e:
+                response.close()
+                raise SniffUrlError('%s: %s' % (e.__class__.__name__, e))
+            if not exhausted:
+                # the rest of the body is not wanted, so the connection cannot
+                # be reused
+                response.close()
+        buf = ''.join(chunks)[:self.prefix_size]
+        complete = exhausted and (
+            len(buf) < self.prefix_size or
+            content_range_total(response) == len(buf))
+        return buf, complete
+
+
+def content_range_total(response):
+    '''Returns the total size of the file, from the Content-Range header of a
+    206 response, or None.'''
+    if response.status_code != 206:
+        return None
+    match = re.match(r'bytes \d+-\d+/(\d+)',
+                     response.headers.get('Content-Range', ''))
+    return int(match.group(1)) if match else None
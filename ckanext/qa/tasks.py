@@ -2,19 +2,30 @@
 Provide some Quality Assurance by scoring datasets against Sir Tim
 Berners-Lee\'s five stars of openness
 '''
+import atexit
 import datetime
+import hashlib
 import json
+import logging
 import os
+import threading
 import traceback
 
+from celery import signals
 import ckan.lib.celery_app as celery_app
 from ckan.plugins import toolkit
-import ckan.lib.helpers as ckan_helpers
-from ckanext.qa.sniff_format import sniff_file_format
+from ckanext.qa.sniff_format import sniff_file_format, sniff_buffer_format, DETECTOR_VERSION
+from ckanext.qa.sniff_pool import SniffPool, SniffError, SniffLimitExceeded
+from ckanext.qa.sniff_url import UrlSniffer, SniffUrlError
+from ckanext.qa.reindex import ReindexBuffer
+from ckanext.qa.scoring import Scorer, ResourceRecord, ArchivalRecord, extension_variants
 from ckanext.qa import lib
 from ckanext.archiver.model import Archival, Status
 
 
+_log = logging.getLogger(__name__)
+
+
 class QAError(Exception):
     pass
 
@@ -29,18 +40,34 @@ OPENNESS_SCORE_DESCRIPTION = {
 }
 
 
+# The CKAN environment is loaded once per worker process, rather than by
+# every task, and the translator is registered once per thread
+_LOADED_CONFIG = None  # (path, mtime) of the ckan.ini that was loaded
+_thread_state = threading.local()
+
+
 def load_config(ckan_ini_filepath):
-    import paste.deploy
+    '''Loads the CKAN environment (config, plugins, database engine) from the
+    ckan.ini, unless this process has loaded it already and it has not
+    changed since.'''
+    global _LOADED_CONFIG
     config_abs_path = os.path.abspath(ckan_ini_filepath)
+    loaded_config = (config_abs_path, os.stat(config_abs_path).st_mtime)
+    if loaded_config == _LOADED_CONFIG:
+        return
+    import paste.deploy
     conf = paste.deploy.appconfig('config:' + config_abs_path)
     import ckan
     ckan.config.environment.load_environment(conf.global_conf,
                                              conf.local_conf)
+    _LOADED_CONFIG = loaded_config
 
 
 def register_translator():
     # Register a translator in this thread so that
     # the _() functions in logic layer can work
+    if getattr(_thread_state, 'translator', None) is not None:
+        return
     from paste.registry import Registry
     from pylons import translator
     from ckan.lib.cli import MockTranslator
@@ -50,40 +77,125 @@ def register_translator():
     global translator_obj
     translator_obj = MockTranslator()
     registry.register(translator, translator_obj)
+    _thread_state.translator = translator_obj
+
+
+def preload():
+    '''Reads the format index and openness scores, and starts the sniffing
+    processes, so that the first task does not have to. The sniff pool is
+    started here because the worker process has no other threads yet (see
+    SniffPool).'''
+    lib.format_index()
+    get_sniff_pool()
+
+
+@signals.worker_process_init.connect
+def init_worker_process(**kwargs):
+    '''When a Celery worker process starts, loads the CKAN environment from
+    the ckan.ini that the worker was started with (paster celeryd sets
+    CKAN_CONFIG), ready for its tasks.'''
+    ckan_ini_filepath = os.environ.get('CKAN_CONFIG')
+    if not ckan_ini_filepath:
+        return
+    try:
+        load_config(ckan_ini_filepath)
+        register_translator()
+        preload()
+    except Exception, e:
+        # the tasks will try again, and report the error properly
+        _log.error(
+            'Could not load CKAN environment from %s: %s: %s',
+            ckan_ini_filepath, e.__class__.__name__, unicode(e))
+
+
+@signals.worker_process_shutdown.connect
+def shutdown_worker_process(**kwargs):
+    '''Before a Celery worker process exits, queues the QA requests and
+    indexes the packages that are waiting to be.'''
+    lib.flush_qa_request_buffer()
+    flush_reindex_buffer()
 
 
 @celery_app.celery.task(name="qa.update_package")
-def update_package(ckan_ini_filepath, package_id):
+def update_package(ckan_ini_filepath, package_id, incremental=False):
     """
     Given a package, calculates an openness score for each of its resources.
     It is more efficient to call this than 'update' for each resource.
 
     data - package dict (includes its resources)
+    incremental - skip the resources that have not changed since they were
+                  last scored (see resource_fingerprint)
 
     Returns None
     """
     log = update_package.get_logger()
     load_config(ckan_ini_filepath)
     register_translator()
-    from ckan import model
+    lib.reload_format_index_if_changed()
     try:
-        package = model.Package.get(package_id)
-        if not package:
-            raise QAError('Package ID not found: %s' % package_id)
-
-        log.info('Openness scoring package %s (%i resources)', package.name, len(package.resources))
-        for resource in package.resources:
-            qa_result = resource_score(resource, log)
-            log.info('Openness scoring: \n%r\n%r\n%r\n\n', qa_result, resource,
-                     resource.url)
-            save_qa_result(resource.id, qa_result, log)
-            log.info('CKAN updated with openness score')
-        # Refresh the index for this dataset, so that it contains the latest
-        # qa info
-        _update_search_index(package.id, log)
+        score_package_by_id(package_id, log, incremental)
     except Exception, e:
         log.error('Exception occurred during QA update: %s: %s', e.__class__.__name__,  unicode(e))
         raise
+    finally:
+        end_task_session()
+
+
+@celery_app.celery.task(name="qa.update_packages")
+def update_packages(ckan_ini_filepath, package_ids, incremental=False):
+    """
+    Calculates an openness score for each resource of each of the given
+    packages, as update_package does for one. Queuing a task per several
+    packages makes for fewer messages when the whole catalogue is rescored.
+
+    A package that fails does not stop the others being scored - the errors
+    are raised together at the end.
+
+    Returns None
+    """
+    log = update_packages.get_logger()
+    load_config(ckan_ini_filepath)
+    register_translator()
+    lib.reload_format_index_if_changed()
+    from ckan import model
+    errors = []
+    try:
+        for package_id in package_ids:
+            try:
+                score_package_by_id(package_id, log, incremental)
+            except Exception, e:
+                model.Session.rollback()
+                log.error('Exception occurred during QA update of package '
+                          '%s: %s: %s', package_id, e.__class__.__name__,
+                          unicode(e))
+                errors.append('%s: %s: %s' % (
+                    package_id, e.__class__.__name__, unicode(e)))
+    finally:
+        end_task_session()
+    if errors:
+        raise QAError('QA of %i of the %i packages failed: %s' %
+                      (len(errors), len(package_ids), '; '.join(errors)))
+
+
+def score_package_by_id(package_id, log, incremental=False):
+    '''Scores the package's resources, saves the results and queues the
+    package to have its search index updated. This is the work of the
+    update_package task, for running without Celery too.
+
+    Returns the number of resources scored.
+    '''
+    from ckan import model
+    package = model.Package.get(package_id)
+    if not package:
+        raise QAError('Package ID not found: %s' % package_id)
+
+    log.info('Openness scoring package %s (%i resources)', package.name, len(package.resources))
+    count = score_package(package, log, incremental)
+    log.info('CKAN updated with openness scores')
+    # Refresh the index for this dataset, so that it contains the latest
+    # qa info
+    _update_search_index(package.id, log)
+    return count
 
 
 @celery_app.celery.task(name="qa.update")
@@ -102,15 +214,20 @@ def update(ckan_ini_filepath, resource_id):
     log = update.get_logger()
     load_config(ckan_ini_filepath)
     register_translator()
+    lib.reload_format_index_if_changed()
     from ckan import model
     try:
         resource = model.Resource.get(resource_id)
         if not resource:
             raise QAError('Resource ID not found: %s' % resource_id)
-        qa_result = resource_score(resource, log)
+        context = ScoringContext([resource])
+        qa_result = resource_score(resource, log, context)
         log.info('Openness scoring: \n%r\n%r\n%r\n\n', qa_result, resource,
                  resource.url)
-        save_qa_result(resource.id, qa_result, log)
+        fingerprint = None \
+            if resource.id in context.sniff_limit_exceeded \
+            else resource_fingerprint(resource, context)
+        save_qa_result(resource.id, qa_result, log, fingerprint)
         log.info('CKAN updated with openness score')
         if toolkit.check_ckan_version(max_version='2.2.99'):
             package = resource.resource_group.package
@@ -127,17 +244,157 @@ def update(ckan_ini_filepath, resource_id):
         log.error('Exception occurred during QA update: %s: %s',
                   e.__class__.__name__,  unicode(e))
         raise
+    finally:
+        end_task_session()
+
+
+def end_task_session():
+    '''Ends the database session at the end of a task - rolling back
+    anything left uncommitted (e.g. after an error) and forgetting the
+    objects it loaded, so that the next task in this process reads them
+    afresh. (The CKAN environment, and with it the session, is kept between
+    tasks - see load_config.)'''
+    from ckan import model
+    model.Session.remove()
+
 
+def score_package(package, log, incremental=False):
+    '''Scores the package's resources and saves the results. If incremental,
+    the resources whose fingerprint is the same as when they were last
+    scored are not scored again - only their QA's "updated" is changed.
 
-def get_qa_format(resource_id):
+    Returns the number of resources scored.
+    '''
+    context = ScoringContext(package.resources)
+    resources = []
+    fingerprints = {}
+    unchanged_resource_ids = []
+    for resource in package.resources:
+        fingerprint = resource_fingerprint(resource, context)
+        fingerprints[resource.id] = fingerprint
+        qa = context.qas.get(resource.id)
+        if incremental and qa and qa.fingerprint == fingerprint:
+            log.info('Resource unchanged since it was scored, so skipping: '
+                     '%s', resource.id)
+            unchanged_resource_ids.append(resource.id)
+            continue
+        resources.append(resource)
+    qa_results = []
+    for resource, qa_result in zip(resources, score_resources(resources, log,
+                                                              context)):
+        log.info('Openness scoring: \n%r\n%r\n%r\n\n', qa_result, resource,
+                 resource.url)
+        qa_results.append((resource.id, qa_result))
+        if resource.id in context.sniff_limit_exceeded:
+            # so that it is tried again, rather than skipped
+            fingerprints[resource.id] = None
+    save_qa_results(package.id, qa_results, log, context.qas, fingerprints,
+                    unchanged_resource_ids)
+    return len(qa_results)
+
+
+def resource_fingerprint(resource, context):
+    '''Returns a hash of everything that the resource's score depends on:
+    its archival (time and hash of the file), URL, format field, whether its
+    dataset's license is open, the openness scores config, the version of
+    the format detectors and the config for sniffing by URL. If it is the
+    same as when the resource was last scored, scoring it again would give
+    the same result.
+
+    That is not so if sniffing the resource went over the time or memory
+    limit, since the next attempt may not, so such a resource is saved
+    without a fingerprint (see ScoringContext.sniff_limit_exceeded).'''
+    from pylons import config
+    archival = context.archivals.get(resource.id)
+    sniff_by_url = toolkit.asbool(config.get('qa.sniff_by_url', False))
+    parts = [
+        archival.updated.isoformat() if archival and archival.updated
+        else None,
+        archival.hash if archival else None,
+        resource.url,
+        resource.format,
+        context.is_open.get(resource.id),
+        lib.resource_format_scores_version(),
+        DETECTOR_VERSION,
+        sniff_by_url,
+        int(config.get('qa.sniff_by_url_size', 128)) if sniff_by_url
+        else None,
+        ]
+    return unicode(hashlib.md5(json.dumps(parts)).hexdigest())
+
+
+def get_qa_format(resource_id, context=None):
     '''Returns the format of the resource, as recorded in the QA table.'''
     from ckanext.qa.model import QA
-    q = QA.get_for_resource(resource_id)
+    if context:
+        q = context.qas.get(resource_id)
+    else:
+        q = QA.get_for_resource(resource_id)
     if not q:
         return ''
     return q.format
 
 
+class ScoringContext(object):
+    '''What scoring a batch of resources needs from the database - their
+    archivals, their QA from before, whether their datasets' licenses are
+    open and the cached results of sniffing their archived files - fetched
+    with one query of each, rather than several queries per resource.
+
+    :ivar archivals: {resource_id: Archival}
+    :ivar qas: {resource_id: QA}
+    :ivar is_open: {resource_id: whether its dataset's license is open}
+    :ivar sniff_cache_keys: the keys (SniffResult.key_for_file) of the
+                            archived files whose cached results were fetched
+    :ivar sniff_results: {key: SniffResult} of those files
+    :ivar slow_files: {key: SlowFile} of those files
+    :ivar sniff_limit_exceeded: ids of the resources whose sniffing went over
+                                the time or memory limit while scoring them
+    '''
+    def __init__(self, resources):
+        from ckan import model
+        from ckanext.qa.model import QA, SniffResult, SlowFile
+        resource_ids = [resource.id for resource in resources]
+        self.archivals = {}
+        self.qas = {}
+        self.is_open = {}
+        self.sniff_cache_keys = set()
+        self.sniff_results = {}
+        self.slow_files = {}
+        self.sniff_limit_exceeded = set()
+        if not resource_ids:
+            return
+        self.archivals = dict(
+            (archival.resource_id, archival) for archival in
+            model.Session.query(Archival)
+            .filter(Archival.resource_id.in_(resource_ids)))
+        self.qas = QA.get_for_resources(resource_ids)
+        q = model.Session.query(model.Resource.id, model.Package)
+        if toolkit.check_ckan_version(max_version='2.2.99'):
+            q = q.join(model.ResourceGroup,
+                       model.Resource.resource_group_id ==
+                       model.ResourceGroup.id) \
+                 .join(model.Package,
+                       model.ResourceGroup.package_id == model.Package.id)
+        else:
+            q = q.join(model.Package,
+                       model.Resource.package_id == model.Package.id)
+        self.is_open = dict(
+            (resource_id, package.isopen()) for resource_id, package in
+            q.filter(model.Resource.id.in_(resource_ids)))
+        # the files that will be sniffed (those without a hash are keyed by
+        # their stat, so are left to sniff_file_format_cached to look up)
+        self.sniff_cache_keys = set(
+            SniffResult.key_for_file(archival.cache_filepath, archival.hash)
+            for archival in self.archivals.itervalues()
+            if archival.cache_filepath and archival.hash and
+            not archival.is_broken)
+        if self.sniff_cache_keys:
+            self.sniff_results = SniffResult.get_for_keys(
+                self.sniff_cache_keys)
+            self.slow_files = SlowFile.get_for_keys(self.sniff_cache_keys)
+
+
 def format_get(key):
     '''Returns a resource format, as defined in ckan.
 
@@ -146,16 +403,20 @@ def format_get(key):
     :param key: string
     :returns: format string
     '''
-    format_tuple = ckan_helpers.resource_formats().get(key.lower())
-    if not format_tuple:
+    format_info = lib.format_index().get(key.lower())
+    if not format_info:
         return
-    return format_tuple[1]  # short name
+    return format_info[0]  # short name
 
 
-def resource_score(resource, log):
+def resource_score(resource, log, context=None):
     """
     Score resource on Sir Tim Berners-Lee\'s five stars of openness.
 
+    context - ScoringContext for a batch of resources that includes this
+              one. If not given, the data needed is fetched for this
+              resource alone.
+
     Returns a dict with keys:
 
         'openness_score': score (int)
@@ -165,274 +426,475 @@ def resource_score(resource, log):
 
     Raises QAError for reasonable errors
     """
-    score = 0
-    score_reason = ''
-    format_ = None
+    if not resource:
+        raise QAError('Could not find resource "%s"' % resource.id)
+    if context is None:
+        context = ScoringContext([resource])
+    return score_resources([resource], log, context)[0]
+
 
+def score_resources(resources, log, context):
+    '''Scores the resources, as resource_score does, all at once with the
+    Scorer. Returns a list of the results, in the same order.'''
     try:
-        score_reasons = []  # a list of strings detailing how we scored it
-        archival = Archival.get_for_resource(resource_id=resource.id)
-        if not resource:
-            raise QAError('Could not find resource "%s"' % resource.id)
-
-        score, format_ = score_if_link_broken(archival, resource, score_reasons, log)
-        if score == None:
-            # we don't want to take the publisher's word for it, in case the link
-            # is only to a landing page, so highest priority is the sniffed type
-            score, format_ = score_by_sniffing_data(archival, resource,
-                                                    score_reasons, log)
-            if score == None:
-                # Fall-backs are user-given data
-                score, format_ = score_by_url_extension(resource, score_reasons, log)
-                if score == None:
-                    score, format_ = score_by_format_field(resource, score_reasons, log)
-                    if score == None:
-                        log.warning('Could not score resource: "%s" with url: "%s"',
-                                    resource.id, resource.url)
-                        score_reasons.append('Could not understand the file format, therefore score is 1.')
-                        score = 1
-                        if format_ == None:
-                            # use any previously stored format value for this resource
-                            format_ = get_qa_format(resource.id)
-        score_reason = ' '.join(score_reasons)
-        format_ = format_ or None
+        records = [resource_record(resource, log, context)
+                   for resource in resources]
+        scores = get_scorer().score_records(records, log)
     except Exception, e:
         log.error('Unexpected error while calculating openness score %s: %s\nException: %s', e.__class__.__name__,  unicode(e), traceback.format_exc())
-        score_reason = "Unknown error: %s" % str(e)
         raise
-
-    # Even if we can get the link, we should still treat the resource
-    # as having a score of 0 if the license isn't open.
-    #
-    # It is important we do this check after the link check, otherwise
-    # the link checker won't get the chance to see if the resource
-    # is broken.
-    if toolkit.check_ckan_version(max_version='2.2.99'):
-        package = resource.resource_group.package
-    else:
-        package = resource.package
-    if score > 0 and not package.isopen():
-        score_reason = 'License not open'
-        score = 0
-
-    log.info('Score: %s Reason: %s', score, score_reason)
-
-    archival_updated = archival.updated.isoformat() \
-        if archival and archival.updated else None
-    result = {
-        'openness_score': score,
-        'openness_score_reason': score_reason,
-        'format': format_,
-        'archival_timestamp': archival_updated
-    }
-
-    return result
-
-
-def broken_link_error_message(archival):
-    '''Given an archival for a broken link, it returns a helpful
-    error message (string) describing the attempts.'''
-    def format_date(date):
-        if date:
-            return date.strftime('%d/%m/%Y')
-        else:
-            return ''
-    messages = ['File could not be downloaded.',
-                'Reason: %s.' % archival.status,
-                'Error details: %s.' % archival.reason,
-                'Attempted on %s.' % format_date(archival.updated)]
-    last_success = format_date(archival.last_success)
-    if archival.failure_count == 1:
-        if last_success:
-            messages.append('This URL worked the previous time: %s.' % last_success)
-        else:
-            messages.append('This was the first attempt.')
-    else:
-        messages.append('Tried %s times since %s.' % \
-                        (archival.failure_count,
-                         format_date(archival.first_failure)))
-        if last_success:
-            messages.append('This URL last worked on: %s.' % last_success)
-        else:
-            messages.append('This URL has not worked in the history of this tool.')
-    return ' '.join(messages)
+    results = []
+    for resource, (score, score_reason, format_) in zip(resources, scores):
+        log.info('Score: %s Reason: %s', score, score_reason)
+        archival = context.archivals.get(resource.id)
+        archival_updated = archival.updated.isoformat() \
+            if archival and archival.updated else None
+        results.append({
+            'openness_score': score,
+            'openness_score_reason': score_reason,
+            'format': format_,
+            'archival_timestamp': archival_updated
+            })
+    return results
 
 
-def score_if_link_broken(archival, resource, score_reasons, log):
+def resource_record(resource, log, context):
+    '''Returns the facts about the resource that its score depends on, as a
+    ResourceRecord. Unless the archiver says its link is broken, its data is
+    sniffed for this.'''
+    archival = context.archivals.get(resource.id)
+    record = ResourceRecord(
+        id=resource.id,
+        url=resource.url,
+        format=resource.format,
+        is_open=context.is_open.get(resource.id),
+        archival=ArchivalRecord.from_object(archival),
+        previous_format=get_qa_format(resource.id, context))
+    if not (archival and archival.is_broken):
+        sniff_reasons = []
+        record.sniffed_format, record.sniffed_by_url = \
+            sniff_resource_format(archival, resource, sniff_reasons, log,
+                                  context)
+        record.sniff_reasons = sniff_reasons
+    return record
+
+
+_SCORER = None
+
+
+def get_scorer():
+    '''Returns the Scorer for the configured formats and openness scores,
+    creating it again if they have been reloaded since.'''
+    global _SCORER
+    format_index = lib.format_index()
+    if _SCORER is None or _SCORER.format_index is not format_index:
+        _SCORER = Scorer(format_index, lib.resource_format_scores(),
+                         lib.lookup_format)
+    return _SCORER
+
+
+def sniff_resource_format(archival, resource, sniff_reasons, log,
+                          context=None):
     '''
-    Looks to see if the archiver said it was broken, and if so, writes to
-    the score_reasons and returns a score.
+    Looks inside a data file\'s contents to determine its format.
 
-    Return values:
-      * Returns a tuple: (score, format_)
-      * score is an integer or None if it cannot be determined
-      * format_ is a string or None
-      * is_broken is a boolean
-    '''
-    if archival and archival.is_broken:
-        # Score 0 since we are sure the link is currently broken
-        score_reasons.append(broken_link_error_message(archival))
-        format_ = get_qa_format(resource.id)
-        log.info('Archiver says link is broken. Previous format: %r' % format_)
-        return (0, format_)
-    return (None, None)
-
-def score_by_sniffing_data(archival, resource, score_reasons, log):
-    '''
-    Looks inside a data file\'s contents to determine its format and score.
-
-    It adds strings to score_reasons list about how it came to the conclusion.
+    It adds strings to sniff_reasons list about how it went. context is the
+    ScoringContext, if any, with the cached results of sniffing the file.
 
     Return values:
-      * It returns a tuple: (score, format_string)
+      * It returns a tuple: (format_string, by_url)
       * If it cannot work out the format then format_string is None
-      * If it cannot score it, then score is None
+      * by_url is whether it was sniffed from just the start of the file,
+        fetched from its URL
     '''
     if not archival or not archival.cache_filepath:
-        score_reasons.append('This file had not been downloaded at the time of scoring it.')
-        return (None, None)
+        if archival and archival.status_id == \
+                Status.by_text('Chose not to download'):
+            url_sniffer = get_url_sniffer()
+            if url_sniffer:
+                return (sniff_url_format(archival, resource, url_sniffer,
+                                         sniff_reasons, log, context), True)
+        sniff_reasons.append('This file had not been downloaded at the time of scoring it.')
+        return (None, False)
     # Analyse the cached file
     filepath = archival.cache_filepath
     if not os.path.exists(filepath):
-        score_reasons.append('Cache filepath does not exist: "%s".' % filepath)
-        return (None, None)
+        sniff_reasons.append('Cache filepath does not exist: "%s".' % filepath)
+        return (None, False)
     else:
         if filepath:
-            sniffed_format = sniff_file_format(filepath, log)
-            score = lib.resource_format_scores().get(sniffed_format['format']) \
-                if sniffed_format else None
+            try:
+                sniffed_format = sniff_file_format_cached(filepath, archival,
+                                                          log, context)
+            except SniffLimitExceeded, e:
+                sniff_reasons.append('%s Using other methods to determine file openness.' % e)
+                return (None, False)
+            except SniffError, e:
+                # a bug in a detector, or the sniffing process died
+                log.error('Error sniffing file %s: %s', filepath, e)
+                sniff_reasons.append('The file could not be sniffed due to an error: %s. Using other methods to determine file openness.' % e)
+                return (None, False)
             if sniffed_format:
-                score_reasons.append('Content of file appeared to be format "%s" which receives openness score: %s.' % (sniffed_format['format'], score))
-                return score, sniffed_format['format']
+                return sniffed_format['format'], False
             else:
-                score_reasons.append('The format of the file was not recognized from its contents.')
-                return (None, None)
+                sniff_reasons.append('The format of the file was not recognized from its contents.')
+                return (None, False)
         else:
             # No cache_url
             if archival.status_id == Status.by_text('Chose not to download'):
-                score_reasons.append('File was not downloaded deliberately. Reason: %s. Using other methods to determine file openness.' % \
+                sniff_reasons.append('File was not downloaded deliberately. Reason: %s. Using other methods to determine file openness.' % \
                                      archival.reason)
-                return (None, None)
+                return (None, False)
             elif archival.is_broken is None and archival.status_id:
                 # i.e. 'Download failure' or 'System error during archival'
-                score_reasons.append('A system error occurred during downloading this file. Reason: %s. Using other methods to determine file openness.' % \
+                sniff_reasons.append('A system error occurred during downloading this file. Reason: %s. Using other methods to determine file openness.' % \
                                      archival.reason)
-                return (None, None)
+                return (None, False)
             else:
-                score_reasons.append('This file had not been downloaded at the time of scoring it.')
-                return (None, None)
-
+                sniff_reasons.append('This file had not been downloaded at the time of scoring it.')
+                return (None, False)
+
+
+_URL_SNIFFER = None
+
+
+def get_url_sniffer():
+    '''Returns the UrlSniffer, creating it on first use, or None if
+    qa.sniff_by_url is not enabled.'''
+    global _URL_SNIFFER
+    from pylons import config
+    if not toolkit.asbool(config.get('qa.sniff_by_url', False)):
+        return None
+    if _URL_SNIFFER is None:
+        _URL_SNIFFER = UrlSniffer(
+            prefix_size=int(config.get('qa.sniff_by_url_size', 128)) * 1024,
+            timeout=int(config.get('qa.sniff_by_url_timeout', 10)),
+            max_per_host=int(config.get('qa.sniff_by_url_max_per_host', 2)),
+            cache_seconds=int(config.get('qa.sniff_by_url_cache_seconds',
+                                         300)),
+            sniff_buffer=sniff_buffer_format_isolated,
+            lock_dir=config.get('qa.sniff_by_url_lock_dir'))
+    return _URL_SNIFFER
+
+
+def sniff_url_format(archival, resource, url_sniffer, sniff_reasons, log,
+                     context=None):
+    '''
+    For a file that the archiver chose not to download, fetches the start of
+    it from its URL and looks inside that to determine its format. context is
+    the ScoringContext, if any, to record it in if sniffing goes over a limit.
 
-def score_by_url_extension(resource, score_reasons, log):
+    Returns the format string, or None if it cannot work it out.
+    '''
+    sniff_reasons.append('File was not downloaded deliberately. Reason: %s. Sniffing the first %sKB of it from its URL instead.' %
+                         (archival.reason, url_sniffer.prefix_size / 1024))
+    try:
+        sniffed_format = url_sniffer.sniff(resource.url.strip(), log)
+    except SniffUrlError, e:
+        sniff_reasons.append('Could not fetch the start of the file: %s. Using other methods to determine file openness.' % e)
+        return None
+    except SniffLimitExceeded, e:
+        if context is not None:
+            context.sniff_limit_exceeded.add(resource.id)
+        sniff_reasons.append('%s Using other methods to determine file openness.' % e)
+        return None
+    except SniffError, e:
+        log.error('Error sniffing URL %s: %s', resource.url, e)
+        sniff_reasons.append('The start of the file could not be sniffed due to an error: %s. Using other methods to determine file openness.' % e)
+        return None
+    if not sniffed_format:
+        sniff_reasons.append('The format of the file was not recognized from the start of its contents.')
+        return None
+    return sniffed_format['format']
+
+
+def sniff_file_format_cached(filepath, archival, log, context=None):
+    '''
+    Returns the format of the file, as sniff_file_format does, but reuses
+    the result of sniffing the same file contents before (as identified by
+    the archival's hash), as long as the detectors have not changed since.
+
+    If the context (a ScoringContext) has already fetched the cached result
+    for the file, it is used rather than querying for it. A new result is
+    only added to the session - it is committed along with the QA results
+    (see save_qa_results).
+
+    Raises SniffLimitExceeded if sniffing went over the time or memory limit
+    (and records the archival's resource in context.sniff_limit_exceeded),
+    or if it has done so too many times before.
     '''
-    Looks at the URL for a resource to determine its format and score.
+    from ckan import model
+    from pylons import config
+    from ckanext.qa.model import SniffResult, SlowFile
+
+    key = SniffResult.key_for_file(filepath, archival.hash)
+    prefetched = context is not None and key in context.sniff_cache_keys
+    if prefetched:
+        sniff_result = context.sniff_results.get(key)
+        slow_file = context.slow_files.get(key)
+    else:
+        sniff_result = SniffResult.get(key)
+        slow_file = SlowFile.get(key)
+    if sniff_result and sniff_result.detector_version == DETECTOR_VERSION:
+        log.info('Sniffed format found in cache: %r', sniff_result)
+        return sniff_result.as_format_dict()
+
+    slow_file_threshold = int(config.get('qa.sniff_slow_file_threshold', 2))
+    if slow_file and slow_file.detector_version == DETECTOR_VERSION and \
+            slow_file.failure_count >= slow_file_threshold:
+        log.info('Not sniffing slow file: %r', slow_file)
+        raise SniffLimitExceeded(
+            'Sniffing the file has gone over the limits %s times, so it is '
+            'no longer sniffed. Last time: %s' %
+            (slow_file.failure_count, slow_file.reason))
 
-    It adds strings to score_reasons list about how it came to the conclusion.
+    try:
+        sniffed_format = sniff_file_format_isolated(filepath, log)
+    except SniffLimitExceeded, e:
+        if not slow_file:
+            slow_file = SlowFile(key=key)
+            model.Session.add(slow_file)
+            if prefetched:
+                # for other resources in the batch with the same file
+                context.slow_files[key] = slow_file
+        if slow_file.detector_version != DETECTOR_VERSION:
+            # new, or the detectors have changed since it last failed
+            slow_file.failure_count = 0
+        slow_file.filepath = filepath
+        slow_file.detector_version = DETECTOR_VERSION
+        slow_file.failure_count += 1
+        slow_file.reason = unicode(e)
+        slow_file.updated = datetime.datetime.now()
+        if context is not None:
+            context.sniff_limit_exceeded.add(archival.resource_id)
+        raise
 
-    Return values:
-      * It returns a tuple: (score, format_string)
-      * If it cannot work out the format then format is None
-      * If it cannot score it, then score is None
-    '''
-    extension_variants_ = extension_variants(resource.url.strip())
-    if not extension_variants_:
-        score_reasons.append('Could not determine a file extension in the URL.')
-        return (None, None)
-    for extension in extension_variants_:
-        format_ = format_get(extension)
-        if format_:
-            score = lib.resource_format_scores().get(format_)
-            if score:
-                score_reasons.append('URL extension "%s" relates to format "%s" and receives score: %s.' % (extension, format_, score))
-                return score, format_
-            else:
-                score = 1
-                score_reasons.append('URL extension "%s" relates to format "%s" but a score for that format is not configured, so giving it default score %s.' % (extension, format_, score))
-                return score, format_
-        score_reasons.append('URL extension "%s" is an unknown format.' % extension)
-    return (None, None)
+    if not sniff_result:
+        sniff_result = SniffResult(key=key)
+        model.Session.add(sniff_result)
+        if prefetched:
+            context.sniff_results[key] = sniff_result
+    sniff_result.detector_version = DETECTOR_VERSION
+    sniff_result.format = sniffed_format['format'] if sniffed_format else None
+    sniff_result.container = sniffed_format.get('container') \
+        if sniffed_format else None
+    sniff_result.updated = datetime.datetime.now()
+    return sniffed_format
+
+
+_SNIFF_POOL = None
+
+
+def get_sniff_pool():
+    '''Returns the pool of processes that files are sniffed in, or None if
+    qa.sniff_processes is 0. A Celery worker process starts it when it starts
+    (see preload), else it is started on first use.'''
+    global _SNIFF_POOL
+    from pylons import config
+    size = int(config.get('qa.sniff_processes', 1))
+    if not size:
+        return None
+    if _SNIFF_POOL is None:
+        memory_limit_mb = int(config.get('qa.sniff_memory_limit', 1024))
+        _SNIFF_POOL = SniffPool(
+            sniff_file_format, size=size,
+            timeout=int(config.get('qa.sniff_timeout', 60)),
+            memory_limit=memory_limit_mb * 1024 * 1024 or None)
+    return _SNIFF_POOL
+
+
+def sniff_file_format_isolated(filepath, log):
+    '''Returns the format of the file, as sniff_file_format does, but sniffs
+    it in a helper process, with limits on its time and memory.'''
+    pool = get_sniff_pool()
+    if not pool:
+        return sniff_file_format(filepath, log)
+    return pool.sniff(filepath, log)
+
+
+def sniff_buffer_format_isolated(buf, name, complete, log):
+    '''Returns the format of the start of a file, as sniff_buffer_format
+    does, but sniffs it in a helper process, as sniff_file_format_isolated
+    does for a file.'''
+    pool = get_sniff_pool()
+    if not pool:
+        return sniff_buffer_format(buf, name, complete, log)
+    return pool.run(sniff_buffer_format, (buf, name, complete), log, name)
 
-def extension_variants(url):
-    '''
-    Returns a list of extensions, in order of which would more
-    significant.
 
-    >>> extension_variants('http://dept.gov.uk/coins.data.1996.csv.zip')
-    ['csv.zip', 'zip']
-    >>> extension_variants('http://dept.gov.uk/data.csv?callback=1')
-    ['csv']
+def _update_search_index(package_id, log):
     '''
-    url = url.split('?')[0] # get rid of params
-    url = url.split('/')[-1] # get rid of path - leaves filename
-    split_url = url.split('.')
-    results = []
-    for number_of_sections in [2, 1]:
-        if len(split_url) > number_of_sections:
-            results.append('.'.join(split_url[-number_of_sections:]))
-    return results
+    Tells CKAN to update its search index for a given package. It is done
+    shortly, together with other packages whose QA has changed - see
+    get_reindex_buffer.
+    '''
+    get_reindex_buffer().add(package_id)
+    log.info('Search index update queued for package %s', package_id)
 
 
-def score_by_format_field(resource, score_reasons, log):
-    '''
-    Looks at the format field of a resource to determine its format and score.
+_REINDEX_BUFFER = None
 
-    It adds strings to score_reasons list about how it came to the conclusion.
 
-    Return values:
-      * It returns a tuple: (score, format_string)
-      * If it cannot work out the format then format_string is None
-      * If it cannot score it, then score is None
-    '''
-    format_field = resource.format or ''
-    if not format_field:
-        score_reasons.append('Format field is blank.')
-        return (None, None)
-    format_tuple = ckan_helpers.resource_formats().get(format_field.lower()) or \
-        ckan_helpers.resource_formats().get(lib.munge_format_to_be_canonical(format_field))
-    if not format_tuple:
-        score_reasons.append('Format field "%s" does not correspond to a known format.' % format_field)
-        return (None, None)
-    score = lib.resource_format_scores().get(format_tuple[1])
-    score_reasons.append('Format field "%s" receives score: %s.' %
-                         (format_field, score))
-    return (score, format_tuple[1])
+def get_reindex_buffer():
+    '''Returns the buffer of packages waiting to be search indexed, creating
+    it on first use. They are indexed qa.reindex_window seconds after the
+    first is added, or as soon as qa.reindex_batch_size are waiting.'''
+    global _REINDEX_BUFFER
+    if _REINDEX_BUFFER is None:
+        from pylons import config
+        _REINDEX_BUFFER = ReindexBuffer(
+            index_packages,
+            window=float(config.get('qa.reindex_window', 10)),
+            batch_size=int(config.get('qa.reindex_batch_size', 100)))
+        # in case the process is not a Celery worker process
+        atexit.register(flush_reindex_buffer)
+    return _REINDEX_BUFFER
 
 
-def _update_search_index(package_id, log):
+def flush_reindex_buffer():
+    '''Indexes the packages that are waiting to be, now.'''
+    if _REINDEX_BUFFER is None or not len(_REINDEX_BUFFER):
+        return
+    try:
+        _REINDEX_BUFFER.flush()
+    except Exception, e:
+        _log.error('Search indexing failed: %s: %s', e.__class__.__name__,
+                   unicode(e))
+
+
+def index_packages(package_ids):
     '''
-    Tells CKAN to update its search index for a given package.
+    Tells CKAN to update its search index for the given packages, and then
+    commits the index once.
     '''
     from ckan import model
     from ckan.lib.search.index import PackageSearchIndex
+    # this may be run in the reindex buffer's timer thread
+    register_translator()
     package_index = PackageSearchIndex()
-    context_ = {'model': model, 'ignore_auth': True, 'session': model.Session,
-                'use_cache': False, 'validate': False}
-    package = toolkit.get_action('package_show')(context_, {'id': package_id})
-    package_index.index_package(package, defer_commit=False)
-    log.info('Search indexed %s', package['name'])
+    try:
+        for package_id in package_ids:
+            context_ = {'model': model, 'ignore_auth': True,
+                        'session': model.Session, 'use_cache': False,
+                        'validate': False}
+            try:
+                package = toolkit.get_action('package_show')(
+                    context_, {'id': package_id})
+            except toolkit.ObjectNotFound:
+                _log.warning('Package not found, so not search indexed: %s',
+                             package_id)
+                continue
+            package_index.index_package(package, defer_commit=True)
+        package_index.commit()
+    finally:
+        if threading.current_thread().name != 'MainThread':
+            model.Session.remove()
+    _log.info('Search indexed %i packages', len(package_ids))
+
+
+def save_qa_result(resource_id, qa_result, log, fingerprint=None):
+    """
+    Saves the results of the QA check to the qa table, along with the
+    results of sniffing that are waiting in the session.
+    """
+    import ckan.model as model
+    from ckanext.qa.model import QA
+
+    now = datetime.datetime.now()
+
+    def set_result():
+        qa = QA.get_for_resource(resource_id)
+        if not qa:
+            qa = QA.create(resource_id)
+            model.Session.add(qa)
+        else:
+            log.info('QA from before: %r', qa)
 
+        _set_qa_result(qa, qa_result, now)
+        qa.fingerprint = fingerprint
+    _commit_qa_results(set_result, log)
 
-def save_qa_result(resource_id, qa_result, log):
+    log.info('QA results updated ok')
+
+
+def save_qa_results(package_id, qa_results, log, existing_qas=None,
+                    fingerprints=None, unchanged_resource_ids=()):
     """
-    Saves the results of the QA check to the qa table.
+    Saves the results of the QA checks of a package's resources to the qa
+    table. The existing rows are fetched in one query (unless they are given)
+    and all the results are committed together, along with the results of
+    sniffing that are waiting in the session.
+
+    qa_results - list of (resource_id, qa_result)
+    existing_qas - {resource_id: QA} e.g. from a ScoringContext
+    fingerprints - {resource_id: resource_fingerprint}
+    unchanged_resource_ids - resources that were not scored again because
+                             they are unchanged, so only "updated" is set
     """
     import ckan.model as model
     from ckanext.qa.model import QA
 
     now = datetime.datetime.now()
 
-    qa = QA.get_for_resource(resource_id)
-    if not qa:
-        qa = QA.create(resource_id)
-        model.Session.add(qa)
-    else:
-        log.info('QA from before: %r', qa)
+    fingerprints = fingerprints or {}
+    if existing_qas is None:
+        existing_qas = QA.get_for_resources(
+            [resource_id for resource_id, qa_result in qa_results] +
+            list(unchanged_resource_ids))
+
+    def set_results():
+        for resource_id, qa_result in qa_results:
+            qa = existing_qas.get(resource_id)
+            if not qa:
+                qa = QA.create(resource_id, package_id=package_id)
+                model.Session.add(qa)
+            else:
+                # (QA's repr looks up the package, so only at debug level)
+                log.debug('QA from before: %r', qa)
+            _set_qa_result(qa, qa_result, now)
+            qa.fingerprint = fingerprints.get(resource_id)
+        for resource_id in unchanged_resource_ids:
+            existing_qas[resource_id].updated = now
+    _commit_qa_results(set_results, log)
+
+    log.info('QA results updated ok (%i resources)', len(qa_results))
+
+
+def _commit_qa_results(set_results, log):
+    '''Calls set_results() to put the QA results in the session and commits
+    them, together with the SniffResults and SlowFiles that sniffing left
+    there (see sniff_file_format_cached).
+
+    If another worker cached the result of sniffing the same file in the
+    meantime, the commit fails. Then the session is rolled back, which
+    forgets the sniff cache rows, and the QA results are set and committed
+    again without them.
+    '''
+    import ckan.model as model
+    from sqlalchemy.exc import IntegrityError
+    set_results()
+    try:
+        model.Session.commit()
+    except IntegrityError, e:
+        model.Session.rollback()
+        log.info('Sniffed format already cached by another process, so '
+                 'saving the QA results without it: %s', e)
+        set_results()
+        model.Session.commit()
+
 
+def _set_qa_result(qa, qa_result, now):
     for key in ('openness_score', 'openness_score_reason', 'format'):
         setattr(qa, key, qa_result[key])
-    qa.archival_timestamp == qa_result['archival_timestamp']
+    qa.archival_timestamp = parse_timestamp(qa_result['archival_timestamp'])
     qa.updated = now
 
-    model.Session.commit()
 
-    log.info('QA results updated ok')
+def parse_timestamp(timestamp):
+    '''Returns the datetime for a string given by datetime.isoformat(), or
+    None.'''
+    if not timestamp:
+        return None
+    format_ = '%Y-%m-%dT%H:%M:%S.%f' if '.' in timestamp \
+        else '%Y-%m-%dT%H:%M:%S'
+    return datetime.datetime.strptime(timestamp, format_)
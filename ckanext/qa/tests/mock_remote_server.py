@@ -8,6 +8,7 @@ from time import sleep
 from wsgiref.simple_server import make_server
 import urllib2
 import socket
+import re
 
 class MockHTTPServer(object):
     """
@@ -99,6 +100,9 @@ class MockEchoTestServer(MockHTTPServer):
 
         content=string
         content_var=package.module:variable
+
+    A Range header (e.g. "bytes=0-99") is honoured, with a 206 response, unless
+    ignore_range is given.
     """
 
 
@@ -120,8 +124,19 @@ class MockEchoTestServer(MockHTTPServer):
         headers = [
             item
             for item in request.str_params.items()
-            if item[0] not in ('content', 'status')
+            if item[0] not in ('content', 'status', 'ignore_range')
         ]
+        range_match = re.match(r'bytes=(\d+)-(\d*)$',
+                               environ.get('HTTP_RANGE', ''))
+        if range_match and status == 200 and content and \
+                'ignore_range' not in request.str_params:
+            start = int(range_match.group(1))
+            end = int(range_match.group(2) or len(content) - 1)
+            end = min(end, len(content) - 1)
+            headers.append(('Content-Range', 'bytes %i-%i/%i' %
+                            (start, end, len(content))))
+            content = content[start:end + 1]
+            status = 206
         if content:
             headers += [('Content-Length', str(len(content)))]
         start_response(
@@ -0,0 +1,53 @@
+from nose.tools import assert_equal
+
+from ckanext.qa.coalesce import CoalescingBuffer, merge_qa_requests
+
+RESOURCE_PACKAGE_IDS = {'r1': 'p1', 'r2': 'p1', 'r3': 'p2'}
+
+
+class TestMergeQaRequests:
+    def test_single_resource(self):
+        assert_equal(merge_qa_requests([('priority', 'resource', 'r1')],
+                                       RESOURCE_PACKAGE_IDS),
+                     [('priority', 'p1', 'r1')])
+
+    def test_resources_of_a_package(self):
+        assert_equal(merge_qa_requests([('bulk', 'resource', 'r1'),
+                                        ('bulk', 'resource', 'r3'),
+                                        ('bulk', 'resource', 'r2'),
+                                        ('bulk', 'resource', 'r1')],
+                                       RESOURCE_PACKAGE_IDS),
+                     [('bulk', 'p1', None), ('bulk', 'p2', 'r3')])
+
+    def test_repeated_resource(self):
+        assert_equal(merge_qa_requests([('bulk', 'resource', 'r1'),
+                                        ('bulk', 'resource', 'r1')],
+                                       RESOURCE_PACKAGE_IDS),
+                     [('bulk', 'p1', 'r1')])
+
+    def test_package_and_its_resource(self):
+        assert_equal(merge_qa_requests([('bulk', 'resource', 'r3'),
+                                        ('bulk', 'package', 'p2')],
+                                       RESOURCE_PACKAGE_IDS),
+                     [('bulk', 'p2', None)])
+
+    def test_queues_kept_apart(self):
+        assert_equal(merge_qa_requests([('bulk', 'resource', 'r1'),
+                                        ('priority', 'resource', 'r2')],
+                                       RESOURCE_PACKAGE_IDS),
+                     [('bulk', 'p1', 'r1'), ('priority', 'p1', 'r2')])
+
+    def test_resource_not_found(self):
+        assert_equal(merge_qa_requests([('bulk', 'resource', 'deleted')],
+                                       RESOURCE_PACKAGE_IDS), [])
+
+
+def test_coalescing_buffer():
+    batches = []
+    buffer_ = CoalescingBuffer(batches.append, window=60)
+    for request in [('bulk', 'resource', 'r1'), ('bulk', 'resource', 'r2'),
+                    ('bulk', 'resource', 'r1')]:
+        buffer_.add(request)
+    assert_equal(buffer_.flush(), 2)
+    assert_equal(batches, [[('bulk', 'resource', 'r1'),
+                            ('bulk', 'resource', 'r2')]])
@@ -0,0 +1,151 @@
+import datetime
+from StringIO import StringIO
+
+from nose.tools import assert_equal
+from ckan import model
+from ckan.tests import BaseCase
+try:
+    from ckan.tests.helpers import reset_db
+    from ckan.tests import factories as ckan_factories
+except ImportError:
+    from ckan.new_tests.helpers import reset_db
+    from ckan.new_tests import factories as ckan_factories
+
+from ckanext.qa import tasks
+from ckanext.qa.commands import iter_chunks, iter_active_package_ids, count_active_packages, score_packages_locally, Progress, format_seconds
+from ckanext.qa.reindex import ReindexBuffer
+from ckanext.qa import model as qa_model
+from ckanext.archiver import model as archiver_model
+from ckanext.archiver.model import Archival
+
+
+class TestLocalScoring(BaseCase):
+
+    @classmethod
+    def setup_class(cls):
+        reset_db()
+        archiver_model.init_tables(model.meta.engine)
+        qa_model.init_tables(model.meta.engine)
+
+    def setup(self):
+        self.indexed = []
+        tasks._REINDEX_BUFFER = ReindexBuffer(self.indexed.extend, window=60)
+
+    def teardown(self):
+        tasks._REINDEX_BUFFER = None
+
+    def test_score_packages_locally(self):
+        package_ids = [
+            ckan_factories.Dataset(license_id='uk-ogl', resources=[
+                {'url': 'http://test.com/a.csv', 'format': 'CSV'},
+                {'url': 'http://test.com/b.xls', 'format': 'XLS'}])['id']
+            for i in range(2)]
+        packages_done, resources_scored, errors = \
+            score_packages_locally((package_ids + ['missing'], False))
+        assert_equal((packages_done, resources_scored), (3, 4))
+        assert_equal(len(errors), 1)
+        assert 'Package ID not found: missing' in errors[0], errors
+        # indexed together, at the end of the chunk
+        assert_equal(self.indexed, package_ids)
+        qa = qa_model.QA.get_for_resource(
+            model.Package.get(package_ids[0]).resources[0].id)
+        assert_equal(qa.openness_score, 3)
+
+    def test_iter_active_package_ids(self):
+        package = ckan_factories.Dataset()
+        deleted_package = ckan_factories.Dataset()
+        model.Package.get(deleted_package['id']).state = 'deleted'
+        model.Session.commit()
+        package_ids = list(iter_active_package_ids(batch_size=1))
+        assert package['id'] in package_ids
+        assert deleted_package['id'] not in package_ids
+        assert_equal(count_active_packages(), len(package_ids))
+
+    def test_iter_active_package_ids_in_group(self):
+        group = ckan_factories.Group()
+        package = ckan_factories.Dataset(groups=[{'name': group['name']}])
+        ckan_factories.Dataset()
+        assert_equal(list(iter_active_package_ids(group['id'])),
+                     [package['id']])
+        assert_equal(count_active_packages(group['id']), 1)
+
+
+class TestStaleResources(BaseCase):
+
+    def setup(self):
+        # each test expects just its own stale resources
+        reset_db()
+        archiver_model.init_tables(model.meta.engine)
+        qa_model.init_tables(model.meta.engine)
+
+    def _resource(self, scored=None, archived=None, views=()):
+        '''views - (tracking_date, recent_views) of the dataset's tracking
+        summaries'''
+        package = ckan_factories.Dataset(resources=[
+            {'url': 'http://test.com/a.csv'}])
+        resource_id = package['resources'][0]['id']
+        for tracking_date, recent_views in views:
+            model.Session.add(model.TrackingSummary(
+                url='/dataset/%s/%s' % (package['name'], tracking_date),
+                package_id=package['id'], tracking_type='page',
+                count=recent_views, running_total=recent_views,
+                recent_views=recent_views, tracking_date=tracking_date))
+        if scored:
+            qa = qa_model.QA.create(resource_id)
+            qa.updated = scored
+            model.Session.add(qa)
+        if archived:
+            archival = Archival.create(resource_id)
+            archival.updated = archived
+            model.Session.add(archival)
+        model.Session.commit()
+        return resource_id
+
+    def test_get_stale_resources(self):
+        day = datetime.timedelta(days=1)
+        now = datetime.datetime.now() + day
+        up_to_date = self._resource(scored=now, archived=now - day)
+        rearchived = self._resource(scored=now - day, archived=now)
+        rearchived_earlier = self._resource(scored=now - 2 * day,
+                                            archived=now)
+        not_scored = self._resource(archived=now)
+        stale_ids = [row[0] for row in
+                     qa_model.get_stale_resources(limit=10)]
+        assert_equal(stale_ids, [not_scored, rearchived_earlier, rearchived])
+        assert up_to_date not in stale_ids
+        assert_equal(len(qa_model.get_stale_resources(limit=1)), 1)
+
+    def test_get_stale_resources_by_recent_views(self):
+        day = datetime.timedelta(days=1)
+        now = datetime.datetime.now() + day
+        today = datetime.date.today()
+        not_viewed = self._resource(scored=now - 2 * day, archived=now)
+        viewed = self._resource(scored=now - day, archived=now,
+                                views=[(today - day, 1), (today, 5)])
+        # only the latest tracking summary counts
+        viewed_before = self._resource(scored=now - day, archived=now,
+                                       views=[(today - 10 * day, 100)])
+        rows = qa_model.get_stale_resources(limit=10)
+        assert_equal([row[0] for row in rows],
+                     [viewed, not_viewed, viewed_before])
+        assert_equal([row[5] for row in rows], [5, 0, 0])
+
+
+def test_iter_chunks():
+    assert_equal(list(iter_chunks(iter(range(5)), 2)), [[0, 1], [2, 3], [4]])
+    assert_equal(list(iter_chunks([], 2)), [])
+
+
+def test_progress():
+    out = StringIO()
+    progress = Progress(10, interval=3600, out=out)
+    progress.update(4, 20)
+    # not printed until the interval has passed
+    assert_equal(out.getvalue(), '')
+    progress.print_summary()
+    assert out.getvalue().startswith('4/10 datasets (20 resources scored) - '), out.getvalue()
+    assert 'ETA ' in out.getvalue(), out.getvalue()
+
+
+def test_format_seconds():
+    assert_equal(format_seconds(3725.2), '1:02:05')
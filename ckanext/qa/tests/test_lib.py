@@ -0,0 +1,116 @@
+import os
+import time
+import datetime
+import json
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+from pylons import config
+
+from ckanext.qa import lib
+from ckanext.qa.lib import format_index, sniffer_format_index, lookup_format, reload_format_index_if_changed, resource_format_scores_version, plan_rescoring
+
+
+class TestFormatIndex:
+    def test_extension(self):
+        assert_equal(format_index()['csv'], ('CSV', 3))
+
+    def test_mime_type(self):
+        assert_equal(format_index()['application/vnd.ms-excel'], ('XLS', 2))
+
+    def test_lookup_alias(self):
+        assert_equal(lookup_format('Excel'), ('XLS', 2))
+
+    def test_lookup_munged(self):
+        assert_equal(lookup_format(' .CSV '), ('CSV', 3))
+        # the result is remembered
+        assert_equal(lookup_format(' .CSV '), ('CSV', 3))
+
+    def test_lookup_unknown(self):
+        assert_equal(lookup_format('ZAR'), None)
+        assert_equal(lookup_format(''), None)
+
+    def test_scored_format_not_in_resource_formats(self):
+        # TTL and ICS have scores, but are not in ckan's resource_formats,
+        # so a format field or URL extension of them is not recognised
+        assert_equal(lookup_format('TTL'), None)
+        assert 'ics' not in format_index()
+        # but the sniffer can name them
+        assert_equal(sniffer_format_index()['ttl'], ('TTL', 5))
+        assert_equal(sniffer_format_index()['ics'], ('ICS', 3))
+
+
+class TestReloadFormatIndex:
+    @classmethod
+    def setup_class(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.scores_filepath = os.path.join(cls.tmp_dir, 'scores.json')
+        cls.original_scores_filepath = \
+            config.get('qa.resource_format_openness_scores_json')
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.tmp_dir)
+        if cls.original_scores_filepath:
+            config['qa.resource_format_openness_scores_json'] = \
+                cls.original_scores_filepath
+        else:
+            config.pop('qa.resource_format_openness_scores_json', None)
+        lib._RESOURCE_FORMAT_SCORES = None
+        lib._FORMAT_INDEX = None
+        lib._RESOURCE_FORMAT_SCORES_VERSION = None
+
+    def write_scores(self, scores, mtime):
+        with open(self.scores_filepath, 'w') as f:
+            json.dump(scores, f)
+        os.utime(self.scores_filepath, (mtime, mtime))
+
+    def test_reload(self):
+        config['qa.resource_format_openness_scores_json'] = \
+            self.scores_filepath
+        lib._RESOURCE_FORMAT_SCORES = None
+        lib._FORMAT_INDEX = None
+        self.write_scores([['CSV', 3]], time.time() - 10)
+        assert_equal(lookup_format('csv'), ('CSV', 3))
+
+        # unchanged
+        reload_format_index_if_changed()
+        assert_equal(lookup_format('csv'), ('CSV', 3))
+
+        self.write_scores([['CSV', 2]], time.time())
+        assert_equal(lookup_format('csv'), ('CSV', 3))
+        reload_format_index_if_changed()
+        assert_equal(lookup_format('csv'), ('CSV', 2))
+
+    def test_scores_version(self):
+        config['qa.resource_format_openness_scores_json'] = \
+            self.scores_filepath
+        lib._RESOURCE_FORMAT_SCORES = None
+        lib._FORMAT_INDEX = None
+        lib._RESOURCE_FORMAT_SCORES_VERSION = None
+        self.write_scores([['CSV', 3], ['XLS', 2]], time.time() - 10)
+        version = resource_format_scores_version()
+        self.write_scores([['XLS', 2], ['CSV', 3]], time.time() - 5)
+        reload_format_index_if_changed()
+        # the same scores
+        assert_equal(resource_format_scores_version(), version)
+
+        self.write_scores([['CSV', 2], ['XLS', 2]], time.time())
+        reload_format_index_if_changed()
+        assert resource_format_scores_version() != version
+
+
+def test_plan_rescoring():
+    day = datetime.timedelta(days=1)
+    scored = datetime.datetime(2015, 1, 1)
+    stale_resources = [
+        ('r1', 'p1', None, None, None, 0),
+        ('r2', 'p2', scored, scored + day, None, 10),
+        ('r3', 'p1', scored, None, scored + day, 0),
+        ]
+    assert_equal(plan_rescoring(stale_resources), [
+        ('p1', [('r1', 'not scored'),
+                ('r3', 'modified since it was scored')]),
+        ('p2', [('r2', 'archived since it was scored')]),
+        ])
@@ -0,0 +1,71 @@
+import time
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.qa.reindex import ReindexBuffer
+
+
+class FakeSearchIndex(object):
+    '''Stands in for the search index, recording what is indexed.'''
+    def __init__(self):
+        self.indexed = []
+        self.commits = 0
+        self.broken = False
+
+    def index_packages(self, package_ids):
+        if self.broken:
+            raise Exception('Search index unavailable')
+        self.indexed.extend(package_ids)
+        self.commits += 1
+
+
+class TestReindexBuffer:
+    def setup(self):
+        self.index = FakeSearchIndex()
+
+    def test_coalesced(self):
+        buffer_ = ReindexBuffer(self.index.index_packages, window=60)
+        for package_id in ('a', 'b', 'a', 'c', 'b'):
+            buffer_.add(package_id)
+        assert_equal(self.index.indexed, [])
+        assert_equal(buffer_.flush(), 3)
+        assert_equal(self.index.indexed, ['a', 'b', 'c'])
+        assert_equal(self.index.commits, 1)
+        assert_equal(buffer_.flush(), 0)
+        assert_equal(self.index.commits, 1)
+
+    def test_batch_size(self):
+        buffer_ = ReindexBuffer(self.index.index_packages, window=60,
+                                batch_size=2)
+        buffer_.add('a')
+        buffer_.add('a')
+        assert_equal(self.index.indexed, [])
+        buffer_.add('b')
+        assert_equal(self.index.indexed, ['a', 'b'])
+        assert_equal(len(buffer_), 0)
+
+    def test_window(self):
+        buffer_ = ReindexBuffer(self.index.index_packages, window=0.1)
+        buffer_.add('a')
+        buffer_.add('b')
+        assert_equal(self.index.indexed, [])
+        deadline = time.time() + 5
+        while not self.index.indexed and time.time() < deadline:
+            time.sleep(0.05)
+        assert_equal(self.index.indexed, ['a', 'b'])
+        assert_equal(self.index.commits, 1)
+
+    def test_no_window(self):
+        buffer_ = ReindexBuffer(self.index.index_packages, window=0)
+        buffer_.add('a')
+        assert_equal(self.index.indexed, ['a'])
+
+    def test_kept_when_indexing_fails(self):
+        buffer_ = ReindexBuffer(self.index.index_packages, window=60)
+        buffer_.add('a')
+        self.index.broken = True
+        assert_raises(Exception, buffer_.flush)
+        buffer_.add('b')
+        self.index.broken = False
+        assert_equal(buffer_.flush(), 2)
+        assert_equal(self.index.indexed, ['a', 'b'])
@@ -0,0 +1,145 @@
+import datetime
+import logging
+
+from nose.tools import assert_equal
+
+from ckanext.qa.scoring import Scorer, ResourceRecord, ArchivalRecord, broken_link_error_message
+
+log = logging.getLogger(__name__)
+
+FORMAT_SCORES = {'CSV': 3, 'XLS': 2, 'RDF': 4, 'TXT': 1}
+FORMAT_INDEX = {
+    'csv': ('CSV', 3),
+    'xls': ('XLS', 2),
+    'excel': ('XLS', 2),
+    'rdf': ('RDF', 4),
+    'txt': ('TXT', 1),
+    'zip': ('ZIP', None),
+}
+
+
+def broken_archival(**kwargs):
+    archival = ArchivalRecord(
+        is_broken=True, status='Download error',
+        reason='Server returned 500 error',
+        updated=datetime.datetime(2008, 10, 10),
+        first_failure=datetime.datetime(2008, 10, 1), failure_count=16)
+    for key, value in kwargs.items():
+        setattr(archival, key, value)
+    return archival
+
+
+class TestScorer:
+    def setup(self):
+        self.scorer = Scorer(FORMAT_INDEX, FORMAT_SCORES)
+
+    def score(self, **kwargs):
+        kwargs.setdefault('url', 'http://site.com/data')
+        kwargs.setdefault('is_open', True)
+        return self.scorer.score(ResourceRecord(**kwargs), log)
+
+    def test_sniffed(self):
+        score, reason, format_ = self.score(
+            sniffed_format='CSV', url='http://site.com/data.xls',
+            sniff_reasons=['Sniffed.'])
+        assert_equal((score, format_), (3, 'CSV'))
+        assert_equal(reason, 'Sniffed. Content of file appeared to be format "CSV" which receives openness score: 3.')
+
+    def test_sniffed_by_url(self):
+        score, reason, format_ = self.score(sniffed_format='CSV',
+                                            sniffed_by_url=True)
+        assert_equal(reason, 'Content of the start of the file appeared to be format "CSV" which receives openness score: 3.')
+
+    def test_sniffed_format_not_scored(self):
+        # falls back on the URL, and its format
+        score, reason, format_ = self.score(sniffed_format='ZAR',
+                                            url='http://site.com/data.xls')
+        assert_equal((score, format_), (2, 'XLS'))
+        assert 'format "ZAR" which receives openness score: None.' in reason, reason
+
+    def test_by_extension(self):
+        score, reason, format_ = self.score(
+            url=' http://site.com/data.csv?a=1 ', sniff_reasons=[
+                'The format of the file was not recognized from its contents.'])
+        assert_equal((score, format_), (3, 'CSV'))
+        assert_equal(reason, 'The format of the file was not recognized from its contents. URL extension "csv" relates to format "CSV" and receives score: 3.')
+
+    def test_extension_not_scored(self):
+        score, reason, format_ = self.score(url='http://site.com/data.zip')
+        assert_equal((score, format_), (1, 'ZIP'))
+        assert 'a score for that format is not configured, so giving it default score 1.' in reason, reason
+
+    def test_by_format_field(self):
+        score, reason, format_ = self.score(url='http://site.com/data.zar',
+                                            format='Excel')
+        assert_equal((score, format_), (2, 'XLS'))
+        assert_equal(reason, 'URL extension "zar" is an unknown format. Format field "Excel" receives score: 2.')
+
+    def test_format_field_not_scored(self):
+        # a known format, but without a score, is kept rather than the
+        # previous format
+        scorer = Scorer(FORMAT_INDEX, FORMAT_SCORES,
+                        lambda name: ('ZAR', None) if name == 'ZAR' else None)
+        score, reason, format_ = scorer.score(ResourceRecord(
+            url='http://site.com/data', format='ZAR', is_open=True,
+            previous_format='CSV'))
+        assert_equal((score, format_), (1, 'ZAR'))
+        assert_equal(reason, 'Could not determine a file extension in the URL. Format field "ZAR" receives score: None. Could not understand the file format, therefore score is 1.')
+
+    def test_lookup_format(self):
+        scorer = Scorer(FORMAT_INDEX, FORMAT_SCORES,
+                        lambda name: FORMAT_INDEX.get(name.strip('. ').lower()))
+        score, reason, format_ = scorer.score(ResourceRecord(
+            url='http://site.com/data', format=' .CSV ', is_open=True))
+        assert_equal(format_, 'CSV')
+
+    def test_no_format_clues(self):
+        score, reason, format_ = self.score(previous_format='CSV')
+        assert_equal((score, format_), (1, 'CSV'))
+        assert_equal(reason, 'Could not determine a file extension in the URL. Format field is blank. Could not understand the file format, therefore score is 1.')
+
+    def test_not_open(self):
+        score, reason, format_ = self.score(sniffed_format='CSV',
+                                            is_open=False)
+        assert_equal((score, reason, format_), (0, 'License not open', 'CSV'))
+
+    def test_broken(self):
+        score, reason, format_ = self.score(
+            archival=broken_archival(), is_open=False, previous_format='',
+            url='http://site.com/data.csv')
+        assert_equal((score, format_), (0, None))
+        assert_equal(reason, 'File could not be downloaded. Reason: Download error. Error details: Server returned 500 error. Attempted on 10/10/2008. Tried 16 times since 01/10/2008. This URL has not worked in the history of this tool.')
+
+    def test_broken_previous_format(self):
+        score, reason, format_ = self.score(
+            archival=broken_archival(
+                failure_count=1, last_success=datetime.datetime(2008, 10, 1)),
+            previous_format='CSV')
+        assert_equal((score, format_), (0, 'CSV'))
+        assert reason.endswith('This URL worked the previous time: 01/10/2008.'), reason
+
+    def test_tuple(self):
+        assert_equal(self.scorer.score((None, 'http://site.com/a.csv', None, True)),
+                     (3, 'URL extension "csv" relates to format "CSV" and receives score: 3.', 'CSV'))
+
+    def test_score_records(self):
+        records = [ResourceRecord(url='http://site.com/a.%s' % extension,
+                                  is_open=True)
+                   for extension in ('csv', 'xls', 'rdf')]
+        assert_equal([score for score, reason, format_ in
+                      self.scorer.score_records(records, log)], [3, 2, 4])
+
+
+def test_archival_record_from_object():
+    class Archival(object):
+        is_broken = True
+        status = 'Download error'
+        reason = 'Server returned 404 error'
+        updated = datetime.datetime(2008, 10, 10)
+        last_success = None
+        failure_count = 1
+        first_failure = datetime.datetime(2008, 10, 10)
+    archival = ArchivalRecord.from_object(Archival())
+    assert_equal(broken_link_error_message(archival),
+                 broken_link_error_message(Archival()))
+    assert_equal(ArchivalRecord.from_object(None), None)
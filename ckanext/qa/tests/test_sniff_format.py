@@ -1,9 +1,18 @@
 import os
 import logging
+import codecs
+import tempfile
+import shutil
+import time
+import gzip
+import bz2
+import tarfile
+import zipfile
+import StringIO
 
 from nose.tools import assert_equal
 
-from ckanext.qa.sniff_format import sniff_file_format, is_json, is_ttl, turtle_regex
+from ckanext.qa.sniff_format import sniff_file_format, is_json, is_ttl, turtle_regex, count_turtle_triples, FilePrefix, JsonSniffer, get_binary_format, DecompressingFile, Detector, get_detectors, COST_CHEAP, sniff_tabular_format, MarkupSignature, XmlRootSniffer, get_xml_root_format
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger('ckan.sniff')
@@ -137,6 +146,11 @@ class TestSniffFormat:
     #    self.check_format('torrent')
     def test_psv(self):
         self.check_format('psv')
+    def test_tsv(self):
+        self.check_format('tsv')
+    def test_csv_semicolon_separated(self):
+        # with decimal commas, as is usual where semicolons separate CSV
+        self.check_format('csv', 'elec00-semicolon-separated.csv')
     def test_wms_1_3(self):
         self.check_format('wms', 'afbi_get_capabilities.wms')
     def test_wms_1_1_1(self):
@@ -176,6 +190,26 @@ def test_is_json():
     # false positives of the algorithm:
     #assert not is_json('[{"cat": [1]}2, 2]', log)
 
+def test_json_sniffer_chunks():
+    def feed_in_chunks(buf, chunk_size):
+        sniffer = JsonSniffer(log)
+        for i in range(0, len(buf), chunk_size):
+            result = sniffer.feed(buf[i:i + chunk_size])
+            if result is not None:
+                return result
+        return sniffer.feed('', final=True)
+    for buf in ('-5.4e-5', '[5, 6]', '{"cat": [1, 2], "dog": 5}',
+                '{"cat": [1, 2}]', '4.', '"hello"]', '[' * 50):
+        for chunk_size in (1, 2, 3, 7):
+            assert_equal(feed_in_chunks(buf, chunk_size), is_json(buf, log))
+
+def test_json_sniffer_decides_early():
+    sniffer = JsonSniffer(log)
+    assert_equal(sniffer.feed('[1, 2, 3'), None)
+    assert_equal(sniffer.feed(', 4, 5'), True)
+    sniffer = JsonSniffer(log)
+    assert_equal(sniffer.feed('<html>'), False)
+
 def test_turtle_regex():
     template = '<subject> <predicate> %s .'
     assert turtle_regex().search(template % '<url>')
@@ -206,8 +240,338 @@ def test_turtle_regex():
     assert not turtle_regex().search(template % 'prefix:node')
 
 
+def test_count_turtle_triples():
+    template = '<subject> <predicate> %s .'
+    for obj in ('<url>', '"a literal"', '"translation"@ru',
+                '"literal type"^^<http://www.w3.org/2001/XMLSchema#string>',
+                '"literal typed with prefix"^^xsd:string',
+                "'single quotes'",
+                '"""triple quotes but not multiline"""',
+                "'''triple quotes but not multiline'''",
+                '12', '1.12', '.12', '12E12', '-4.2E-9', 'false',
+                '_:blank_node'):
+        assert_equal(count_turtle_triples(template % obj, 5), 1)
+    assert_equal(count_turtle_triples('<s> <p> <o> ;\n <p> <o> .', 5), 2)
+    assert_equal(count_turtle_triples('<s> <p> <o>;<p> <o>.', 5), 2)
+    # Include triples which are part of a nest:
+    assert_equal(count_turtle_triples('<s> <p> <o> ;', 5), 1)
+    assert_equal(count_turtle_triples('<s> <p> <o>;', 5), 1)
+    assert_equal(count_turtle_triples(' ;<p> <o>.', 5), 1)
+    assert_equal(count_turtle_triples(';\n<p> <o>.', 5), 1)
+    assert_equal(count_turtle_triples(';\n<p> <o>;', 5), 1)
+    assert_equal(count_turtle_triples('<s> <p> <o>. rubbish', 5), 0)
+    assert_equal(count_turtle_triples(template % 'word', 5), 0)
+    assert_equal(count_turtle_triples(template % 'prefix:node', 5), 0)
+    # stops counting at max_triples
+    assert_equal(count_turtle_triples('<s> <p> <o> .\n' * 10, 5), 5)
+
+
+def test_count_turtle_triples__pathological():
+    # these took turtle_regex() seconds or more, growing exponentially
+    start = time.time()
+    assert_equal(count_turtle_triples('"x"' + ' "x"' * 2500, 5), 0)
+    assert_equal(count_turtle_triples(';' + ' "x"' * 2500, 5), 0)
+    assert time.time() - start < 1
+
+
 def test_is_ttl__num_triples():
     triple = '<subject> <predicate> <object>; <predicate> <object>.'
     assert not is_ttl('\n'.join([triple]*2), log)
     assert is_ttl('\n'.join([triple]*5), log)
 
+
+def test_get_binary_format():
+    fixture_data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    for filename, expected_format in (
+            ('bis-quarterly-publications-dg-expenses-jul-sep-2010.doc', 'DOC'),
+            ('directors-org-chart-march-2012.ppt', 'PPT'),
+            ('ukti-admin-spend-nov-2011.xls', 'XLS'),  # no app name
+            ('August-2010.xls', 'XLS'),  # BIFF3
+            ('HS2-ARP-00-GI-RW-00434_RCL_V4.shp', 'SHP'),
+            ):
+        filepath = os.path.join(fixture_data_dir, filename)
+        # a small max_size means the file is read with seeks, from disk
+        with FilePrefix(filepath, max_size=1000) as prefix:
+            format_ = get_binary_format(prefix.fileobj(), log)
+        assert_equal(format_, {'format': expected_format})
+    assert_equal(get_binary_format(StringIO.StringIO('not binary'), log),
+                 None)
+
+def test_file_prefix():
+    handle, filepath = tempfile.mkstemp()
+    os.write(handle, 'a,b\r\nc,d\re,f\n' * 10)
+    os.close(handle)
+    try:
+        with FilePrefix(filepath, max_size=50) as prefix:
+            assert_equal(prefix.read(4), 'a,b\r')
+            assert_equal(prefix.text(12), 'a,b\nc,d\ne,f\n')
+            assert not prefix.complete
+            assert_equal(len(prefix.read(1000)), 50)
+            assert_equal(prefix.fileobj().read(), open(filepath).read())
+        with FilePrefix(filepath) as prefix:
+            assert_equal(prefix.read(1000), open(filepath).read())
+            assert prefix.complete
+    finally:
+        os.remove(filepath)
+
+
+def test_compressed_formats():
+    fixture_data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    csv_filepath = os.path.join(fixture_data_dir, 'elec00.csv')
+    csv = open(csv_filepath, 'rb').read()
+    tmp_dir = tempfile.mkdtemp()
+    def path(filename):
+        return os.path.join(tmp_dir, filename)
+    try:
+        gzip_file = gzip.open(path('data.csv.gz'), 'wb')
+        gzip_file.write(csv)
+        gzip_file.close()
+        bz2_file = bz2.BZ2File(path('data.bz2'), 'wb')
+        bz2_file.write(csv)
+        bz2_file.close()
+        tar = tarfile.open(path('data.tar.gz'), 'w:gz')
+        tar.add(csv_filepath, 'data.csv')
+        tar.close()
+        # the data is chosen over the readme, rather than the first file
+        readme_filepath = path('README.txt')
+        open(readme_filepath, 'wb').write('About the data\n')
+        tar = tarfile.open(path('readme-first.tar.gz'), 'w:gz')
+        tar.add(readme_filepath, 'README.txt')
+        tar.add(csv_filepath, 'data.csv')
+        tar.close()
+        tar = tarfile.open(path('no-extensions.tar'), 'w')
+        tar.add(readme_filepath, 'README')
+        tar.add(csv_filepath, 'data')
+        tar.close()
+        zip = zipfile.ZipFile(path('no-extensions.zip'), 'w',
+                              zipfile.ZIP_DEFLATED)
+        zip.writestr('README', 'See the data')
+        zip.writestr('data', csv)
+        zip.close()
+        zip = zipfile.ZipFile(path('misleading.zip'), 'w')
+        zip.writestr('data.csv',
+                      '<html><head><title>Not found</title></head></html>')
+        zip.close()
+        zip = zipfile.ZipFile(path('nested.zip'), 'w')
+        zip.write(path('data.csv.gz'), 'data.csv.gz')
+        zip.close()
+        for filename, format_, container in (
+                ('data.csv.gz', 'CSV', 'GZ'),
+                ('data.bz2', 'CSV', 'BZ2'),
+                ('data.tar.gz', 'CSV', 'TAR.GZ'),
+                ('readme-first.tar.gz', 'CSV', 'TAR.GZ'),
+                ('no-extensions.tar', 'CSV', 'TAR'),
+                ('no-extensions.zip', 'CSV', 'ZIP'),
+                ('misleading.zip', 'HTML', 'ZIP'),
+                ('nested.zip', 'CSV', 'GZ.ZIP'),
+                ):
+            sniffed_format = sniff_file_format(path(filename), log)
+            assert_equal(sniffed_format['format'], format_)
+            assert_equal(sniffed_format['container'], container)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_decompressing_file():
+    import StringIO
+    import zlib
+    data = os.urandom(100000)  # i.e. incompressible
+    compressed = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    compressed = compressed.compress(data) + compressed.flush()
+    fileobj = StringIO.StringIO(compressed)
+    decompressing_file = DecompressingFile(
+        fileobj, zlib.decompressobj(16 + zlib.MAX_WBITS))
+    assert_equal(decompressing_file.peek(4), data[:4])
+    assert_equal(decompressing_file.read(5), data[:5])
+    assert_equal(decompressing_file.read(2), data[5:7])
+    # only the start of the compressed data has been read
+    assert fileobj.tell() < len(compressed)
+    # a bomb is not decompressed beyond what is read
+    bomb = zlib.compress('\0' * 10000000)
+    decompressing_file = DecompressingFile(StringIO.StringIO(bomb),
+                                           zlib.decompressobj())
+    assert_equal(decompressing_file.read(10), '\0' * 10)
+    assert len(decompressing_file._buf) < 1000
+    # it can appear to end early
+    decompressing_file = DecompressingFile(StringIO.StringIO(bomb),
+                                           zlib.decompressobj(), limit=15)
+    assert_equal(decompressing_file.read(10), '\0' * 10)
+    assert_equal(decompressing_file.read(10), '\0' * 5)
+    assert_equal(decompressing_file.read(10), '')
+
+def test_detector_applies_to():
+    detector = Detector('test', None, mime_types=('text/*', None),
+                        formats=('TXT', None))
+    assert detector.applies_to('text/plain', 'TXT')
+    assert detector.applies_to('text/x-unknown', None)
+    assert detector.applies_to(None, None)
+    assert not detector.applies_to('text/html', 'HTML')
+    assert not detector.applies_to('application/zip', None)
+    detector = Detector('test', None, formats=('HTML',))
+    assert detector.applies_to('text/html', 'HTML')
+    assert detector.applies_to('application/xhtml+xml', 'HTML')
+    assert not detector.applies_to('text/html', None)
+
+def test_detector_detect():
+    handle, filepath = tempfile.mkstemp()
+    os.write(handle, 'a\r\nb' + ' ' * 100)
+    os.close(handle)
+    bufs = []
+    def func(buf, log):
+        bufs.append(buf)
+        return True
+    try:
+        with FilePrefix(filepath) as prefix:
+            detector = Detector('test', func, prefix_size=3, format='TXT')
+            assert_equal(detector.detect(prefix, log), {'format': 'TXT'})
+            detector = Detector('test', func, prefix_size=3, text=True)
+            detector.detect(prefix, log)
+            detector = Detector('test', func, prefix_size=None)
+            detector.detect(prefix, log)
+            assert_equal(bufs, ['a\r\n', 'a\nb', prefix])
+    finally:
+        os.remove(filepath)
+
+def test_detectors_ordered_by_cost():
+    detectors = get_detectors()
+    costs = [detector.cost for detector in detectors]
+    assert_equal(costs, sorted(costs))
+    assert_equal(costs[0], COST_CHEAP)
+    names = [detector.name for detector in detectors]
+    assert_equal(len(names), len(set(names)))
+    # JSON can look like CSV, so must come first
+    assert names.index('is_json') < names.index('sniff_tabular_format')
+
+def test_sniff_tabular_format():
+    rows = [['1', 'Smith, J', '3.4'], ['2', 'Jones, A', '5.6']] * 10
+    def tabular(delimiter, rows=rows):
+        return '\n'.join(delimiter.join(row) for row in rows)
+    for buf, expected_format in (
+            (tabular(',', [['"%s"' % cell for cell in row] for row in rows]),
+             'CSV'),
+            (tabular('\t'), 'TSV'),  # despite the commas
+            (tabular('|'), 'PSV'),
+            (tabular(';'), 'CSV'),
+            ('a,b,c\n"multi\nline, with a comma",5,6\n7,8,9', 'CSV'),
+            # truncated in a quoted field
+            ('a,b\nc,d\ne,"f\ng, h, i, j, k, l, m, n', 'CSV'),
+            ('Title\n\tIndented by\ttabs\n\tand more\n', None),
+            ('Some text; with semicolons.\nAnd more; text\n\nEnd.', None),
+            (codecs.BOM_UTF16_LE + u'"a,b"\n"c,d"\n"e,f"'.encode('utf-16-le'),
+             None),
+            ):
+        format_ = sniff_tabular_format(buf, log)
+        assert_equal(format_ and format_['format'], expected_format)
+
+def test_markup_signature():
+    markup = MarkupSignature(
+        '\xef\xbb\xbf<?xml version="1.0"?>\n<!-- comment -->\n'
+        '<!DOCTYPE rdf:RDF>\n<rdf:RDF xmlns="http://a" xmlns:rdf="http://b">'
+        '<a about="#x">\n<b\nproperty="y"/></a>')
+    assert markup.declaration
+    assert_equal(markup.doctype, ' rdf:RDF')
+    assert_equal(markup.root_tag_name, 'rdf:RDF')
+    assert_equal(markup.root_name(), 'rdf:rdf')
+    assert_equal(markup.namespaces, {None: 'http://a', 'rdf': 'http://b'})
+    assert markup.has_rdfa()
+
+    markup = MarkupSignature('<html><p>about="#x" property="y"</p></html>')
+    assert not markup.declaration
+    assert_equal(markup.root_name(), 'html')
+    assert not markup.has_rdfa()  # not attributes
+
+    markup = MarkupSignature('Just text')
+    assert_equal(markup.root_name(), None)
+    assert not markup.has_rdfa()
+
+def test_markup_signature_has_rdfa__pathological():
+    # each attribute outside a tag used to search back to the start of the
+    # buffer for the tag, taking seconds for a large prefix
+    start = time.time()
+    markup = MarkupSignature('<html property="y">' +
+                             ' about="#x"' * 10000 + ' <p about="#x">')
+    assert markup.has_rdfa()
+    markup = MarkupSignature('<html>' + ' about="#x" property="y"' * 10000)
+    assert not markup.has_rdfa()
+    assert time.time() - start < 1
+
+def xml_root_in_chunks(buf, chunk_size):
+    sniffer = XmlRootSniffer()
+    for i in range(0, len(buf), chunk_size):
+        if sniffer.feed(buf[i:i + chunk_size]) is not None:
+            break
+    sniffer.feed('', final=True)
+    return sniffer
+
+def test_xml_root_sniffer():
+    buf = ('\xef\xbb\xbf<?xml version="1.0"?>\n<!-- <fake> -- comment -->\n'
+           '<?xml-stylesheet href="a.xsl"?>\n'
+           '<!DOCTYPE rdf:RDF SYSTEM "http://a/rdf.dtd" [\n'
+           '  <!ENTITY a "<fake>"> <!-- ]> -->\n]>\n'
+           '<rdf:RDF xmlns="http://a" xmlns:rdf="http://b"\n'
+           '  xsi:schemaLocation="http://b http://b/rdf.xsd" a=\'>\'>'
+           '<a/></rdf:RDF>')
+    for chunk_size in (1, 2, 3, 7, 1000):
+        sniffer = xml_root_in_chunks(buf, chunk_size)
+        assert_equal(sniffer.result, True)
+        assert sniffer.declaration
+        assert_equal(sniffer.doctype, 'rdf:RDF')
+        assert_equal(sniffer.root_tag_name, 'rdf:RDF')
+        assert_equal(sniffer.root_name(), 'rdf:rdf')
+        assert_equal(sniffer.namespaces, {None: 'http://a', 'rdf': 'http://b'})
+        assert_equal(sniffer.root_namespace(), 'http://b')
+        assert_equal(sniffer.schema_locations,
+                     ['http://a/rdf.dtd', 'http://b/rdf.xsd'])
+
+    sniffer = xml_root_in_chunks('<kml xmlns="http://k"/>', 5)
+    assert not sniffer.declaration
+    assert_equal(sniffer.root_name(), 'kml')
+    assert_equal(sniffer.root_namespace(), 'http://k')
+
+def test_xml_root_sniffer__not_xml():
+    for buf in ('Just text', '<http://a> <http://b> "c" .', '<!-- comment',
+                '<?xml version="1.0"?>', '<root a="1"', '<<', ''):
+        for chunk_size in (1, 3, 1000):
+            sniffer = xml_root_in_chunks(buf, chunk_size)
+            assert_equal(sniffer.result, False, buf)
+            assert_equal(sniffer.root_name(), None)
+
+def test_xml_root_sniffer__long_prolog():
+    # only a little of a long comment is held in memory, while looking for
+    # the end of it
+    sniffer = XmlRootSniffer()
+    assert_equal(sniffer.feed('<!-- '), None)
+    for i in range(100):
+        assert_equal(sniffer.feed('x' * 10000 + '-'), None)
+        assert len(sniffer._pending) < 10
+    assert_equal(sniffer.feed('-><root>'), True)
+    assert_equal(sniffer.root_name(), 'root')
+
+def test_get_xml_root_format():
+    def root_format(buf):
+        sniffer = XmlRootSniffer()
+        sniffer.feed(buf, final=True)
+        return get_xml_root_format(sniffer)
+    assert_equal(root_format('<rdf:RDF xmlns:rdf="x">'), 'RDF')
+    assert_equal(root_format(
+        '<r:RDF xmlns:r="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'),
+        'RDF')
+    assert_equal(root_format(
+        '<Description xmlns="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'),
+        None)
+    assert_equal(root_format('<feed xmlns="http://www.w3.org/2005/Atom">'),
+                 'Atom Feed')
+    assert_equal(root_format(
+        '<places xmlns:kml="http://www.opengis.net/kml/2.2">'), None)
+    assert_equal(root_format(
+        '<kml:kml xmlns:kml="http://earth.google.com/kml/2.1">'), 'KML')
+    assert_equal(root_format('<rss version="2.0">'), 'RSS')
+    assert_equal(root_format('<iati-activities>'), 'IATI')
+    assert_equal(root_format(
+        '<activities xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+        'xsi:noNamespaceSchemaLocation="http://x/iati-activities-schema.xsd">'),
+        'IATI')
+    assert_equal(root_format(
+        '<!DOCTYPE WMT_MS_Capabilities SYSTEM '
+        '"http://schemas.opengis.net/wms/1.1.1/capabilities_1_1_1.dtd">'
+        '<Capabilities>'), 'WMS')
+    assert_equal(root_format('<data>'), None)
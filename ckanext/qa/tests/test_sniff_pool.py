@@ -0,0 +1,110 @@
+import os
+import time
+import errno
+import mmap
+import logging
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.qa.sniff_pool import SniffPool, SniffError, SniffTimeout, SniffMemoryError
+
+log = logging.getLogger(__name__)
+
+
+def fake_sniff(filepath, log):
+    if filepath == 'slow':
+        time.sleep(60)
+    elif filepath == 'big':
+        return 'x' * (200 * 1024 * 1024)
+    elif filepath == 'enomem':
+        raise mmap.error(errno.ENOMEM, 'Cannot allocate memory')
+    elif filepath == 'bad':
+        raise ValueError('bad file')
+    elif filepath == 'crash':
+        os._exit(1)
+    elif filepath == 'pid':
+        return os.getpid()
+    elif filepath == 'ppid':
+        return os.getppid()
+    return {'format': filepath.upper()}
+
+
+def fake_sniff_buffer(buf, name, log):
+    return {'format': buf.upper(), 'name': name}
+
+
+class TestSniffPool:
+    def setup(self):
+        self.pool = SniffPool(fake_sniff, size=1, timeout=1,
+                              memory_limit=100 * 1024 * 1024)
+
+    def teardown(self):
+        self.pool.close()
+
+    def test_sniff(self):
+        assert_equal(self.pool.sniff('csv', log), {'format': 'CSV'})
+        assert_equal(self.pool.sniff('xls', log), {'format': 'XLS'})
+
+    def test_sniffed_in_another_process(self):
+        pid = self.pool.sniff('pid', log)
+        assert pid != os.getpid()
+        # the same helper is reused
+        assert_equal(self.pool.sniff('pid', log), pid)
+
+    def test_timeout(self):
+        start = time.time()
+        assert_raises(SniffTimeout, self.pool.sniff, 'slow', log)
+        assert time.time() - start < 5
+        # the helper is replaced
+        assert_equal(self.pool.sniff('csv', log), {'format': 'CSV'})
+
+    def test_memory_limit(self):
+        pid = self.pool.sniff('pid', log)
+        assert_raises(SniffMemoryError, self.pool.sniff, 'big', log)
+        assert_equal(self.pool.sniff('csv', log), {'format': 'CSV'})
+        assert self.pool.sniff('pid', log) != pid
+
+    def test_memory_limit_is_a_budget(self):
+        # the limit is on top of the address space the helper starts with,
+        # which is more than this limit
+        self.pool.close()
+        self.pool = SniffPool(fake_sniff, size=1, timeout=1,
+                              memory_limit=1024 * 1024)
+        assert_equal(self.pool.sniff('csv', log), {'format': 'CSV'})
+
+    def test_memory_limit_os_error(self):
+        assert_raises(SniffMemoryError, self.pool.sniff, 'enomem', log)
+        assert_equal(self.pool.sniff('csv', log), {'format': 'CSV'})
+
+    def test_run(self):
+        assert_equal(self.pool.run(fake_sniff_buffer, ('csv', 'http://a/'),
+                                   log, 'http://a/'),
+                     {'format': 'CSV', 'name': 'http://a/'})
+        # within the same limits
+        assert_raises(SniffTimeout, self.pool.run, fake_sniff, ('slow',),
+                      log, 'slow')
+        assert_equal(self.pool.sniff('csv', log), {'format': 'CSV'})
+
+    def test_error(self):
+        with assert_raises(SniffError) as cm:
+            self.pool.sniff('bad', log)
+        assert_equal(str(cm.exception), 'ValueError: bad file')
+        assert_equal(self.pool.sniff('csv', log), {'format': 'CSV'})
+
+    def test_helper_dies(self):
+        assert_raises(SniffError, self.pool.sniff, 'crash', log)
+        assert_equal(self.pool.sniff('csv', log), {'format': 'CSV'})
+
+    def test_helpers_forked_by_fork_server(self):
+        ppid = self.pool.sniff('ppid', log)
+        assert ppid not in (os.getpid(), 1)
+        # including the one that replaces a helper that timed out
+        assert_raises(SniffTimeout, self.pool.sniff, 'slow', log)
+        assert_equal(self.pool.sniff('ppid', log), ppid)
+
+    def test_several_helpers(self):
+        self.pool.close()
+        self.pool = SniffPool(fake_sniff, size=3, timeout=1)
+        assert_raises(SniffTimeout, self.pool.sniff, 'slow', log)
+        assert_equal(self.pool.sniff('csv', log), {'format': 'CSV'})
+        assert_equal(len(self.pool.idle), 3)
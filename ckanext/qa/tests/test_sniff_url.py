@@ -0,0 +1,140 @@
+import os
+import shutil
+import logging
+import tempfile
+from urllib import urlencode
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.qa.sniff_url import UrlSniffer, SniffUrlError, HostLimiter, ResultCache
+from ckanext.qa.sniff_format import sniff_buffer_format
+from mock_remote_server import MockEchoTestServer
+
+log = logging.getLogger(__name__)
+
+CSV_ROW = '2011,Hampshire,1.5,"Blue, green"\n'
+BIG_CSV = 'Year,Area,Value,Colours\n' + CSV_ROW * 10000
+SMALL_CSV = 'Year,Area,Value,Colours\n' + CSV_ROW * 10
+
+
+def mock_url(server_address, **params):
+    return '%s/?%s' % (server_address, urlencode(sorted(params.items())))
+
+
+class TestUrlSniffer:
+    def setup(self):
+        self.lock_dir = tempfile.mkdtemp()
+        self.sniffer = UrlSniffer(prefix_size=1024, timeout=5,
+                                  lock_dir=self.lock_dir)
+
+    def teardown(self):
+        shutil.rmtree(self.lock_dir)
+
+    def test_sniff(self):
+        with MockEchoTestServer().serve() as server_address:
+            url = mock_url(server_address,
+                           content_var='test_sniff_url:BIG_CSV')
+            format_ = self.sniffer.sniff(url, log)
+        assert_equal(format_['format'], 'CSV')
+
+    def test_fetch_prefix_range(self):
+        with MockEchoTestServer().serve() as server_address:
+            url = mock_url(server_address,
+                           content_var='test_sniff_url:BIG_CSV')
+            buf, complete = self.sniffer.fetch_prefix(url)
+        assert_equal(buf, BIG_CSV[:1024])
+        assert_equal(complete, False)
+
+    def test_fetch_prefix_range_ignored(self):
+        with MockEchoTestServer().serve() as server_address:
+            url = mock_url(server_address, ignore_range=1,
+                           content_var='test_sniff_url:BIG_CSV')
+            buf, complete = self.sniffer.fetch_prefix(url)
+        assert_equal(buf, BIG_CSV[:1024])
+        assert_equal(complete, False)
+
+    def test_fetch_prefix_whole_file(self):
+        with MockEchoTestServer().serve() as server_address:
+            url = mock_url(server_address,
+                           content_var='test_sniff_url:SMALL_CSV')
+            buf, complete = self.sniffer.fetch_prefix(url)
+        assert_equal(buf, SMALL_CSV)
+        assert_equal(complete, True)
+
+    def test_error_status(self):
+        with MockEchoTestServer().serve() as server_address:
+            url = mock_url(server_address, status=404)
+            assert_raises(SniffUrlError, self.sniffer.sniff, url, log)
+
+    def test_sniff_buffer_error(self):
+        def sniff_buffer(buf, url, complete, log):
+            raise ValueError('bad file')
+        self.sniffer.sniff_buffer = sniff_buffer
+        with MockEchoTestServer().serve() as server_address:
+            url = mock_url(server_address, content='{"a": [1, 2, 3]}')
+            assert_raises(ValueError, self.sniffer.sniff, url, log)
+            # the error is not remembered
+            self.sniffer.sniff_buffer = sniff_buffer_format
+            assert_equal(self.sniffer.sniff(url, log)['format'], 'JSON')
+
+    def test_cached(self):
+        with MockEchoTestServer().serve() as server_address:
+            url = mock_url(server_address, content='{"a": [1, 2, 3]}')
+            assert_equal(self.sniffer.sniff(url, log)['format'], 'JSON')
+        # the server has gone, but the result is remembered
+        assert_equal(self.sniffer.sniff(url, log)['format'], 'JSON')
+
+
+class TestHostLimiter:
+    def setup(self):
+        self.lock_dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.lock_dir)
+
+    def test_limit(self):
+        limiter = HostLimiter(max_per_host=1, lock_dir=self.lock_dir)
+        with limiter.limit('a.com', timeout=1):
+            with limiter.limit('b.com', timeout=1):
+                pass
+            assert_raises(SniffUrlError, limiter.limit('a.com', timeout=0.1).__enter__)
+        with limiter.limit('a.com', timeout=1):
+            pass
+
+    def test_limit_shared_between_processes(self):
+        limiter = HostLimiter(max_per_host=2, lock_dir=self.lock_dir)
+        acquired_read, acquired_write = os.pipe()
+        done_read, done_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # another worker, with a request to a.com in progress until the
+            # test is done
+            try:
+                os.close(done_write)
+                with HostLimiter(max_per_host=2,
+                                 lock_dir=self.lock_dir).limit('a.com', 1):
+                    os.write(acquired_write, 'x')
+                    os.read(done_read, 1)
+            finally:
+                os._exit(0)
+        os.close(done_read)
+        try:
+            assert_equal(os.read(acquired_read, 1), 'x')
+            with limiter.limit('a.com', timeout=1):
+                assert_raises(SniffUrlError,
+                              limiter.limit('a.com', timeout=0.1).__enter__)
+        finally:
+            os.close(done_write)
+            os.waitpid(pid, 0)
+        with limiter.limit('a.com', timeout=1):
+            with limiter.limit('a.com', timeout=1):
+                pass
+
+
+def test_result_cache_expires():
+    cache = ResultCache(seconds=-1)
+    cache.set('http://a.com/', None)
+    assert_equal(cache.get('http://a.com/'), (False, None))
+    cache = ResultCache(seconds=60)
+    cache.set('http://a.com/', None)
+    assert_equal(cache.get('http://a.com/'), (True, None))
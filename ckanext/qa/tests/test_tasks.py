@@ -1,9 +1,13 @@
 import requests
 import logging
+import errno
+import mmap
 import urllib
 import datetime
 
+import sqlalchemy
 from nose.tools import assert_equal
+from pylons import config
 from ckan import model
 from ckan.tests import BaseCase
 from ckan.logic import get_action
@@ -16,12 +20,16 @@ except ImportError:
     from ckan.new_tests import factories as ckan_factories
 
 import ckanext.qa.tasks
-from ckanext.qa.tasks import resource_score, extension_variants
+from ckanext.qa.tasks import resource_score, extension_variants, save_qa_result, save_qa_results, parse_timestamp, ScoringContext, score_package, update_package, QAError
+from ckanext.qa.sniff_pool import SniffTimeout
+from ckanext.qa.sniff_format import DETECTOR_VERSION
+from ckanext.qa.reindex import ReindexBuffer
 import ckanext.archiver
 import ckanext.archiver.tasks
 from ckanext.qa import model as qa_model
 from ckanext.archiver import model as archiver_model
 from ckanext.archiver.model import Archival, Status
+from mock_remote_server import MockEchoTestServer
 
 log = logging.getLogger(__name__)
 
@@ -37,19 +45,46 @@ ckanext.qa.tasks.get_cached_resource_filepath = mock_get_cached_resource_filepat
 # actual sniffing
 sniffed_format = None
 def mock_sniff_file_format(filepath, log):
+    if isinstance(sniffed_format, Exception):
+        raise sniffed_format
     return sniffed_format
 ckanext.qa.tasks.sniff_file_format = mock_sniff_file_format
-def set_sniffed_format(format_name):
+def set_sniffed_format(format_name, clear_cache=True):
     global sniffed_format
     if format_name:
         format_tuple = ckan_helpers.resource_formats().get(format_name.lower())
         sniffed_format = {'format': format_tuple[1]}
     else:
         sniffed_format = None
+    if clear_cache:
+        # the test resources all share the same cache_filepath, so forget
+        # the result of sniffing it previously
+        model.Session.query(qa_model.SniffResult).delete()
+        model.Session.query(qa_model.SlowFile).delete()
+        model.Session.commit()
+def set_sniff_error(exception):
+    global sniffed_format
+    sniffed_format = exception
 
 TODAY = datetime.datetime(year=2008, month=10, day=10)
 TODAY_STR = TODAY.isoformat()
 
+
+class QueryCounter(object):
+    '''Counts the SQL statements run in a with block.'''
+    def __enter__(self):
+        self.count = 0
+        sqlalchemy.event.listen(model.meta.engine, 'before_cursor_execute',
+                                self._count)
+        return self
+
+    def __exit__(self, *args):
+        sqlalchemy.event.remove(model.meta.engine, 'before_cursor_execute',
+                                self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
 class TestTask(BaseCase):
 
     @classmethod
@@ -133,6 +168,93 @@ class TestResourceScore(BaseCase):
         assert result['format'] == 'CSV', result
         assert result['archival_timestamp'] == TODAY_STR, result
 
+    def test_by_sniff_cached(self):
+        set_sniffed_format('CSV')
+        result = resource_score(self._test_resource(), log)
+        assert_equal(result['format'], 'CSV')
+        # the file has not changed, so the sniffer is not run again
+        set_sniffed_format('XLS', clear_cache=False)
+        result = resource_score(self._test_resource(), log)
+        assert_equal(result['format'], 'CSV')
+        # unless the detectors have been upgraded since
+        sniff_result = model.Session.query(qa_model.SniffResult).one()
+        sniff_result.detector_version -= 1
+        model.Session.commit()
+        result = resource_score(self._test_resource(), log)
+        assert_equal(result['format'], 'XLS')
+
+    def test_by_sniff_timeout(self):
+        set_sniffed_format(None)
+        set_sniff_error(SniffTimeout('Sniffing the file took longer than the time limit of 60 seconds.'))
+        result = resource_score(self._test_resource('http://site.com/filename.xls'), log)
+        assert 'took longer than the time limit of 60 seconds. Using other methods' in result['openness_score_reason'], result
+        # falls back on the URL
+        assert_equal(result['format'], 'XLS')
+        slow_file = model.Session.query(qa_model.SlowFile).one()
+        assert_equal(slow_file.failure_count, 1)
+        # after timing out twice, it is not sniffed again
+        result = resource_score(self._test_resource('http://site.com/filename.xls'), log)
+        set_sniffed_format('CSV', clear_cache=False)
+        result = resource_score(self._test_resource('http://site.com/filename.xls'), log)
+        assert 'no longer sniffed' in result['openness_score_reason'], result
+        assert_equal(result['format'], 'XLS')
+
+    def _resource_score_in_sniff_pool(self, resource):
+        # sniffs in a helper process, rather than in this one, as
+        # test-core.ini has it
+        original_sniff_processes = config.get('qa.sniff_processes')
+        config['qa.sniff_processes'] = '1'
+        ckanext.qa.tasks._SNIFF_POOL = None
+        try:
+            return resource_score(resource, log)
+        finally:
+            if ckanext.qa.tasks._SNIFF_POOL:
+                ckanext.qa.tasks._SNIFF_POOL.close()
+            ckanext.qa.tasks._SNIFF_POOL = None
+            if original_sniff_processes is not None:
+                config['qa.sniff_processes'] = original_sniff_processes
+            else:
+                config.pop('qa.sniff_processes', None)
+
+    def test_by_sniff_error_in_pool(self):
+        set_sniffed_format(None)
+        set_sniff_error(ValueError('bad file'))
+        result = self._resource_score_in_sniff_pool(
+            self._test_resource('http://site.com/filename.xls'))
+        assert 'The file could not be sniffed due to an error: ValueError: bad file. Using other methods' in result['openness_score_reason'], result
+        # falls back on the URL
+        assert_equal(result['format'], 'XLS')
+
+    def test_by_sniff_out_of_memory_in_pool(self):
+        set_sniffed_format(None)
+        # as mmap raises when it goes over the address space limit
+        set_sniff_error(mmap.error(errno.ENOMEM, 'Cannot allocate memory'))
+        result = self._resource_score_in_sniff_pool(
+            self._test_resource('http://site.com/filename.xls'))
+        assert 'Sniffing the file needed more than the memory limit of 1024MB. Using other methods' in result['openness_score_reason'], result
+        assert_equal(result['format'], 'XLS')
+        slow_file = model.Session.query(qa_model.SlowFile).one()
+        assert_equal(slow_file.failure_count, 1)
+
+    def test_by_sniffing_url(self):
+        csv = 'Year,Area,Value\n' + '2011,Hampshire,1.5\n' * 10
+        config['qa.sniff_by_url'] = 'true'
+        try:
+            with MockEchoTestServer().serve() as server_address:
+                url = '%s/?%s' % (server_address, urllib.urlencode({'content': csv}))
+                res = self._test_resource(url, format=None, cached=False)
+                archival = Archival.get_for_resource(res.id)
+                archival.status_id = Status.by_text('Chose not to download')
+                archival.reason = 'Content-length 2000000000 exceeds maximum allowed value 50000000'
+                model.Session.commit()
+                result = resource_score(res, log)
+        finally:
+            del config['qa.sniff_by_url']
+        assert_equal(result['format'], 'CSV')
+        assert_equal(result['openness_score'], 3)
+        assert 'Sniffing the first 128KB of it from its URL instead.' in result['openness_score_reason'], result
+        assert 'Content of the start of the file appeared to be format "CSV"' in result['openness_score_reason'], result
+
     def test_not_archived(self):
         result = resource_score(self._test_resource(archived=False, cached=False, format=None), log)
         # falls back on previous QA data detailing failed attempts
@@ -250,6 +372,351 @@ class TestResourceScore(BaseCase):
         assert_equal(result['openness_score_reason'], 'File could not be downloaded. Reason: Download error. Error details: Server returned 404 error. Attempted on 10/10/2008. This URL worked the previous time: 01/10/2008.')
 
 
+class TestSaveQaResults(BaseCase):
+
+    @classmethod
+    def setup_class(cls):
+        reset_db()
+        archiver_model.init_tables(model.meta.engine)
+        qa_model.init_tables(model.meta.engine)
+
+    def _qa_result(self, score, format_):
+        return {'openness_score': score,
+                'openness_score_reason': 'Score %s' % score,
+                'format': format_,
+                'archival_timestamp': TODAY_STR}
+
+    def test_save_qa_results(self):
+        pkg = ckan_factories.Dataset(resources=[
+            {'url': 'http://test.com/1.csv', 'format': 'CSV'},
+            {'url': 'http://test.com/2.xls', 'format': 'XLS'}])
+        res_ids = [res['id'] for res in pkg['resources']]
+        # the first resource was scored before
+        qa = qa_model.QA.create(res_ids[0])
+        qa.openness_score = 1
+        model.Session.add(qa)
+        model.Session.commit()
+        qa_id = qa.id
+
+        save_qa_results(pkg['id'], [(res_ids[0], self._qa_result(3, 'CSV')),
+                                    (res_ids[1], self._qa_result(2, 'XLS'))],
+                        log)
+
+        qas = qa_model.QA.get_for_resources(res_ids)
+        assert_equal(len(qas), 2)
+        assert_equal(qas[res_ids[0]].id, qa_id)
+        assert_equal([(qas[id_].openness_score, qas[id_].format,
+                       qas[id_].openness_score_reason,
+                       qas[id_].archival_timestamp, qas[id_].package_id)
+                      for id_ in res_ids],
+                     [(3, 'CSV', 'Score 3', TODAY, pkg['id']),
+                      (2, 'XLS', 'Score 2', TODAY, pkg['id'])])
+
+    def test_same_as_save_qa_result(self):
+        pkg = ckan_factories.Dataset(resources=[
+            {'url': 'http://test.com/1.csv', 'format': 'CSV'},
+            {'url': 'http://test.com/2.csv', 'format': 'CSV'}])
+        res_ids = [res['id'] for res in pkg['resources']]
+        save_qa_result(res_ids[0], self._qa_result(3, 'CSV'), log)
+        save_qa_results(pkg['id'], [(res_ids[1], self._qa_result(3, 'CSV'))],
+                        log)
+        qa_dicts = [qa_model.QA.get_for_resource(id_).as_dict()
+                    for id_ in res_ids]
+        for qa_dict in qa_dicts:
+            for key in ('id', 'resource_id', 'created', 'updated'):
+                del qa_dict[key]
+        assert_equal(qa_dicts[0], qa_dicts[1])
+
+
+class TestLoadConfig:
+    def setup(self):
+        import ckan.config.environment
+        self.loads = []
+        self.original_load_environment = \
+            ckan.config.environment.load_environment
+        ckan.config.environment.load_environment = \
+            lambda *args: self.loads.append(args)
+        ckanext.qa.tasks._LOADED_CONFIG = None
+
+    def teardown(self):
+        import ckan.config.environment
+        ckan.config.environment.load_environment = \
+            self.original_load_environment
+        ckanext.qa.tasks._LOADED_CONFIG = None
+
+    def test_loaded_once_per_process(self):
+        ckanext.qa.tasks.load_config(config['__file__'])
+        ckanext.qa.tasks.load_config(config['__file__'])
+        assert_equal(len(self.loads), 1)
+
+    def test_translator_registered_once_per_thread(self):
+        ckanext.qa.tasks.register_translator()
+        translator = ckanext.qa.tasks.translator_obj
+        ckanext.qa.tasks.register_translator()
+        assert ckanext.qa.tasks.translator_obj is translator
+
+
+class TestScoringContext(BaseCase):
+
+    @classmethod
+    def setup_class(cls):
+        reset_db()
+        archiver_model.init_tables(model.meta.engine)
+        qa_model.init_tables(model.meta.engine)
+
+    def _package(self, num_resources, license_id='uk-ogl'):
+        '''Returns a package whose resources' links are all broken.'''
+        pkg = ckan_factories.Dataset(license_id=license_id, resources=[
+            {'url': 'http://test.com/%i.csv' % i, 'format': 'CSV'}
+            for i in range(num_resources)])
+        for res in pkg['resources']:
+            archival = Archival.create(res['id'])
+            archival.updated = TODAY
+            archival.status_id = Status.by_text('Download error')
+            archival.reason = 'Server returned 500 error'
+            archival.first_failure = TODAY
+            archival.failure_count = 1
+            archival.is_broken = True
+            model.Session.add(archival)
+        model.Session.commit()
+        model.Session.remove()
+        return model.Package.get(pkg['id'])
+
+    def _archived_package(self, num_resources):
+        '''Returns a package whose resources have all been downloaded, each
+        file with different contents.'''
+        pkg = ckan_factories.Dataset(license_id='uk-ogl', resources=[
+            {'url': 'http://test.com/%i' % i, 'format': ''}
+            for i in range(num_resources)])
+        for i, res in enumerate(pkg['resources']):
+            archival = Archival.create(res['id'])
+            archival.updated = TODAY
+            archival.status_id = Status.by_text('Archived successfully')
+            archival.cache_filepath = __file__  # just needs to exist
+            archival.hash = u'%s%i' % (pkg['id'], i)
+            archival.is_broken = False
+            model.Session.add(archival)
+        model.Session.commit()
+        model.Session.remove()
+        return model.Package.get(pkg['id'])
+
+    def _score_package(self, package):
+        '''Returns the number of queries that scoring the package's
+        resources took, and the results.'''
+        resources = package.resources
+        with QueryCounter() as counter:
+            context = ScoringContext(resources)
+            results = [resource_score(resource, log, context)
+                       for resource in resources]
+        return counter.count, results
+
+    def test_queries_per_package(self):
+        num_queries, results = self._score_package(self._package(1))
+        assert_equal(num_queries, 3)
+        num_queries, results = self._score_package(self._package(5))
+        assert_equal(num_queries, 3)
+        assert_equal([result['openness_score'] for result in results],
+                     [0] * 5)
+
+    def test_queries_per_package_sniff_cached(self):
+        set_sniffed_format('CSV')
+        package_id = self._archived_package(5).id
+        self._score_package(model.Package.get(package_id))
+        model.Session.commit()
+        model.Session.remove()
+
+        # the files are unchanged, so the results are found in the cache
+        set_sniffed_format('XLS', clear_cache=False)
+        num_queries, results = self._score_package(
+            model.Package.get(package_id))
+        # archivals, qas, licenses, sniff results and slow files
+        assert_equal(num_queries, 5)
+        assert_equal([result['format'] for result in results], ['CSV'] * 5)
+
+    def test_sniff_results_saved_with_qa_results(self):
+        set_sniffed_format('CSV')
+        package = self._archived_package(5)
+        num_queries, results = self._score_package(package)
+        # the new sniff results are not written while scoring
+        assert_equal(num_queries, 5)
+        set_sniffed_format('CSV', clear_cache=False)
+        score_package(package, log)
+        assert_equal(model.Session.query(qa_model.SniffResult).count(), 5)
+        assert_equal([qa.format for qa in
+                      qa_model.QA.get_for_package(package.id)], ['CSV'] * 5)
+
+    def test_sniff_result_cached_by_another_process(self):
+        set_sniffed_format(None)
+        package = self._archived_package(1)
+        key = u'hash:%s' % Archival.get_for_resource(
+            package.resources[0].id).hash
+
+        def sniff_file_format(filepath, log):
+            # another worker sniffs the same file contents meanwhile
+            model.meta.engine.execute(
+                qa_model.SniffResult.__table__.insert().values(
+                    key=key, detector_version=DETECTOR_VERSION,
+                    format=u'XLS'))
+            return {'format': 'CSV'}
+        ckanext.qa.tasks.sniff_file_format = sniff_file_format
+        try:
+            score_package(package, log)
+        finally:
+            ckanext.qa.tasks.sniff_file_format = mock_sniff_file_format
+        # the QA results are saved, just not this worker's sniff result
+        assert_equal(qa_model.QA.get_for_resource(package.resources[0].id)
+                     .format, 'CSV')
+        assert_equal(qa_model.SniffResult.get(key).format, 'XLS')
+
+    def test_same_results_as_without_context(self):
+        package = self._package(2, license_id=None)
+        qa = qa_model.QA.create(package.resources[0].id)
+        qa.format = 'CSV'
+        model.Session.add(qa)
+        model.Session.commit()
+        num_queries, results = self._score_package(package)
+        assert_equal(results,
+                     [resource_score(resource, log)
+                      for resource in package.resources])
+        assert_equal([result['format'] for result in results], ['CSV', None])
+
+    def test_license_open(self):
+        for license_id, is_open in (('uk-ogl', True), (None, False)):
+            package = self._package(1, license_id=license_id)
+            context = ScoringContext(package.resources)
+            assert_equal(context.is_open, {package.resources[0].id: is_open})
+
+
+class TestSessionBetweenTasks(BaseCase):
+
+    @classmethod
+    def setup_class(cls):
+        reset_db()
+        archiver_model.init_tables(model.meta.engine)
+        qa_model.init_tables(model.meta.engine)
+
+    def setup(self):
+        import ckan.config.environment
+        self.original_load_environment = \
+            ckan.config.environment.load_environment
+        ckan.config.environment.load_environment = lambda *args: None
+        ckanext.qa.tasks._LOADED_CONFIG = None
+        self.indexed = []
+        ckanext.qa.tasks._REINDEX_BUFFER = ReindexBuffer(self.indexed.extend,
+                                                         window=60)
+
+    def teardown(self):
+        import ckan.config.environment
+        ckan.config.environment.load_environment = \
+            self.original_load_environment
+        ckanext.qa.tasks._LOADED_CONFIG = None
+        ckanext.qa.tasks._REINDEX_BUFFER = None
+
+    def test_resource_changed_between_tasks(self):
+        pkg = ckan_factories.Dataset(license_id='uk-ogl', resources=[
+            {'url': 'http://test.com/a.csv', 'format': ''}])
+        resource_id = pkg['resources'][0]['id']
+        # the objects that the first task loads are still referenced
+        package = model.Package.get(pkg['id'])
+        update_package(config['__file__'], pkg['id'], incremental=True)
+        assert_equal(qa_model.QA.get_for_resource(resource_id).format, 'CSV')
+
+        # changed by another process
+        model.meta.engine.execute(
+            model.resource_table.update()
+            .where(model.resource_table.c.id == resource_id)
+            .values(url='http://test.com/a.xls'))
+        update_package(config['__file__'], pkg['id'], incremental=True)
+        assert_equal(qa_model.QA.get_for_resource(resource_id).format, 'XLS')
+        assert package.resources[0].url.endswith('.csv')
+
+    def test_session_ended_after_error(self):
+        try:
+            update_package(config['__file__'], 'missing-package-id')
+        except QAError:
+            pass
+        else:
+            assert 0, 'QAError not raised'
+        assert not model.Session.registry.has()
+
+
+class TestIncrementalScoring(BaseCase):
+
+    @classmethod
+    def setup_class(cls):
+        reset_db()
+        archiver_model.init_tables(model.meta.engine)
+        qa_model.init_tables(model.meta.engine)
+
+    def _package(self):
+        pkg = ckan_factories.Dataset(license_id='uk-ogl', resources=[
+            {'url': 'http://test.com/a.csv', 'format': 'CSV'}])
+        archival = Archival.create(pkg['resources'][0]['id'])
+        archival.cache_filepath = __file__  # just needs to exist
+        archival.updated = TODAY
+        model.Session.add(archival)
+        model.Session.commit()
+        return model.Package.get(pkg['id'])
+
+    def test_unchanged_resource_skipped(self):
+        set_sniffed_format('CSV')
+        package = self._package()
+        assert_equal(score_package(package, log, incremental=True), 1)
+        qa = qa_model.QA.get_for_resource(package.resources[0].id)
+        assert qa.fingerprint
+        updated = qa.updated
+
+        assert_equal(score_package(package, log, incremental=True), 0)
+        qa = qa_model.QA.get_for_resource(package.resources[0].id)
+        assert qa.updated > updated
+        assert_equal(qa.openness_score, 3)
+
+        # not incremental, as with --force
+        assert_equal(score_package(package, log), 1)
+
+    def test_rearchived_resource_scored(self):
+        set_sniffed_format('CSV')
+        package = self._package()
+        assert_equal(score_package(package, log, incremental=True), 1)
+        archival = Archival.get_for_resource(package.resources[0].id)
+        archival.updated = TODAY + datetime.timedelta(days=1)
+        model.Session.commit()
+        assert_equal(score_package(package, log, incremental=True), 1)
+
+    def test_sniff_by_url_config_changed(self):
+        set_sniffed_format('CSV')
+        package = self._package()
+        assert_equal(score_package(package, log, incremental=True), 1)
+        config['qa.sniff_by_url'] = 'true'
+        try:
+            assert_equal(score_package(package, log, incremental=True), 1)
+        finally:
+            del config['qa.sniff_by_url']
+
+    def test_sniff_timeout_scored_again(self):
+        set_sniffed_format(None)
+        set_sniff_error(SniffTimeout('Sniffing the file took longer than the time limit of 60 seconds.'))
+        package = self._package()
+        assert_equal(score_package(package, log, incremental=True), 1)
+        qa = qa_model.QA.get_for_resource(package.resources[0].id)
+        assert_equal(qa.fingerprint, None)
+
+        # the next attempt may not time out
+        set_sniffed_format('CSV', clear_cache=False)
+        assert_equal(score_package(package, log, incremental=True), 1)
+        qa = qa_model.QA.get_for_resource(package.resources[0].id)
+        assert qa.fingerprint
+        assert_equal(qa.format, 'CSV')
+        assert_equal(score_package(package, log, incremental=True), 0)
+
+
+def test_parse_timestamp():
+    assert_equal(parse_timestamp(TODAY_STR), TODAY)
+    timestamp = datetime.datetime(2008, 10, 10, 12, 30, 5, 123)
+    assert_equal(parse_timestamp(timestamp.isoformat()), timestamp)
+    assert_equal(parse_timestamp(None), None)
+
+
 class TestExtensionVariants:
     def test_0_normal(self):
         assert_equal(extension_variants('http://dept.gov.uk/coins-data-1996.csv'),